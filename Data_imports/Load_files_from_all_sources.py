@@ -11,41 +11,195 @@
 # Licence:     Tous droits réservés
 # -------------------------------------------------------------------------------
 
+from __future__ import print_function, division
 import os
 import argparse
 import time
 import logging
 import logging.handlers
+import multiprocessing
+from Queue import Empty
+import resource
+import runpy
+import traceback
 import sys
 sys.path.append('../')
 from optidb.model import *
 from utils.logging_utils import BackupFileHandler
-from utils import YearMonth
-
-__version__ = 'V1.0.1'
+from utils import utcnow
+
+__version__ = 'V2.0.2'
+
+# Import program of each provider:
+# - argv: 'joined' if the program expects all the year_months in a single 'YYYY-MM, YYYY-MM' argument,
+#   'list' if it expects one argument per year_month
+# - max_memory_mb: limit of the address space of the process (not for the programs using Chrome, which reserves a
+#   lot of virtual memory)
+# - max_cpu_seconds: limit of CPU time of the process
+loaders = {
+    'USA': dict(module='load_files_from_USA', argv='list', max_memory_mb=None, max_cpu_seconds=4 * 3600),
+    'Brazil': dict(module='load_files_from_Brazil', argv='joined', max_memory_mb=4096, max_cpu_seconds=3600),
+    'Ireland': dict(module='load_files_from_Ireland', argv='joined', max_memory_mb=None, max_cpu_seconds=3600),
+    'Colombia': dict(module='load_files_from_Colombia', argv='joined', max_memory_mb=4096, max_cpu_seconds=3600),
+    'Mexico': dict(module='load_files_from_Mexico', argv='joined', max_memory_mb=None, max_cpu_seconds=3600),
+    'Eurostat': dict(module='load_files_from_Eurostat', argv='joined', max_memory_mb=4096, max_cpu_seconds=3600),
+    'Australia': dict(module='load_files_from_Australia', argv='joined', max_memory_mb=None, max_cpu_seconds=3600),
+    'India': dict(module='load_files_from_India', argv='list', max_memory_mb=None, max_cpu_seconds=3600),
+}
 
 
 class Provider(Model):
     __collection__ = 'provider'
 
 
-def launch_import(year_months, selected_providers):
-    providers = {
-        'USA': 'load_files_from_USA.py',
-        'Brazil': 'load_files_from_Brazil.py',
-        'Ireland': 'load_files_from_Ireland.py',
-        'Colombia': 'load_files_from_Colombia.py',
-        'Mexico': 'load_files_from_Mexico.py'
-    }
-    for prov in providers:
-        if prov in selected_providers:
-            os.system('python %s %s' % providers.get(prov), YearMonth(year_months))
+class External_Segment_Tmp(Model):
+    __collection__ = 'external_segment_laurent_tests'
+
+
+class Import_Run(Model):
+    __collection__ = 'import_runs'
+
+
+def set_limits(loader):
+    """
+    Apply the resource limits of a provider to the current process
+    :param loader: dict, value of loaders
+    """
+    if loader.get('max_memory_mb'):
+        limit = loader['max_memory_mb'] * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if loader.get('max_cpu_seconds'):
+        resource.setrlimit(resource.RLIMIT_CPU, (loader['max_cpu_seconds'], loader['max_cpu_seconds']))
+
+
+def run_loader(provider, year_months):
+    """
+    Run the import program of a provider, as if it was launched from the command line, in the current process
+    (a process started for this provider only)
+    :param provider: key of loaders
+    :param year_months: list of year_months (YYYY-MM)
+    :return: dict with the provider, its status ('success' or 'failed'), the error if any, and the wall time
+    """
+    loader = loaders[provider]
+    start = time.time()
+    set_limits(loader)
+    # The import programs set their own logging handlers (and log file)
+    root_log = logging.getLogger()
+    for handler in root_log.handlers[:]:
+        root_log.removeHandler(handler)
+
+    if loader['argv'] == 'list':
+        sys.argv = [loader['module'] + '.py'] + list(year_months)
+    else:
+        sys.argv = [loader['module'] + '.py', ', '.join(year_months)]
+    status, error = 'success', None
+    try:
+        runpy.run_module(loader['module'], run_name='__main__', alter_sys=True)
+    except SystemExit as e:
+        if e.code:
+            status, error = 'failed', 'exit code %s' % e.code
+    except BaseException:
+        status, error = 'failed', traceback.format_exc()
+    return dict(provider=provider, status=status, error=error, wall_time=time.time() - start)
+
+
+def loader_process(provider, year_months, results):
+    """
+    Target of the process of a provider: run its import program and send the result to the main process
+    :param results: multiprocessing.Queue
+    """
+    results.put(run_loader(provider, year_months))
+
+
+def process_failure(provider, process, start):
+    """
+    :return: result of a provider whose process ended without sending its result (killed by a signal, for example
+    when its CPU time limit is reached)
+    """
+    if process.exitcode < 0:
+        error = 'killed by signal %d' % -process.exitcode
+    else:
+        error = 'exit code %s' % process.exitcode
+    return dict(provider=provider, status='failed', error=error, wall_time=time.time() - start)
+
+
+def count_rows(provider, year_months, since):
+    """
+    :param since: utc datetime of the start of the provider's import
+    :return: number of lines of the provider (and its sub-providers, ex: 'Eurostat-fr') for the year_months, inserted
+    or modified by its import (the import programs set 'modified' on each line they write)
+    """
+    query = {'provider': {'$regex': '^%s' % provider}, 'year_month': {'$in': year_months},
+             '$or': [{'inserted': {'$gte': since}}, {'modified': {'$gte': since}}]}
+    return External_Segment_Tmp.find(query).count()
+
+
+def launch_import(year_months, selected_providers, nb_processes=4):
+    """
+    Run the import programs of the selected providers concurrently, each one in its own process, and record the
+    status, number of lines and wall time of each provider in the 'import_runs' collection
+    :param year_months: list of year_months (YYYY-MM)
+    :param selected_providers: list of provider names (from the provider collection, ex: 'USA', 'India - domestic')
+    :param nb_processes: number of providers imported at the same time
+    :return: dict of the results per provider
+    """
+    providers = [prov for prov in sorted(loaders)
+                 if any(name.startswith(prov) for name in selected_providers)]
+    run_query = {'started': utcnow()}
+    Import_Run.update(query=run_query, update={'$set': dict(year_months=year_months, providers=providers,
+                                                           status='running')}, upsert=True)
+    log.info('Importing %s for %s with %d processes', providers, year_months, nb_processes)
+
+    results = dict()
+    # A new process for each provider: the import programs keep their state in module globals. A process killed by
+    # its resource limits does not send its result, its exit code is recorded instead.
+    queue = multiprocessing.Queue()
+    waiting = list(providers)
+    running = dict()
+    received = dict()
+    while waiting or running:
+        while waiting and len(running) < nb_processes:
+            prov = waiting.pop(0)
+            process = multiprocessing.Process(target=loader_process, args=(prov, year_months, queue), name=prov)
+            running[prov] = (process, time.time(), utcnow())
+            process.start()
+        try:
+            result = queue.get(timeout=1)
+            received[result['provider']] = result
+        except Empty:
+            pass
+        for prov, (process, start, started) in list(running.items()):
+            if process.is_alive():
+                continue
+            # The result is sent before the process ends
+            while prov not in received and not queue.empty():
+                result = queue.get()
+                received[result['provider']] = result
+            process.join()
+            del running[prov]
+            result = received.pop(prov, None) or process_failure(prov, process, start)
+            result['rows'] = count_rows(prov, year_months, started)
+            results[prov] = result
+            log.info('%(provider)s: %(status)s, %(rows)d lines, %(wall_time).0f seconds', result)
+            if result['error']:
+                log.error('%s failed: %s', prov, result['error'])
+            Import_Run.update(query=run_query, update={'$set': {'results.%s' % prov: result}})
+
+    failed = [prov for prov, result in results.items() if result['status'] != 'success']
+    Import_Run.update(query=run_query, update={'$set': dict(status='failed' if failed else 'success',
+                                                           ended=utcnow())})
+    return results
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Launching "load_files_from" programs for year_month')
     parser.add_argument('year_months', type=str, nargs='+', help='Year_month(s) to download ([YYYY-MM, YYYY-MM...]')
-    parser.add_argument('to_process', type=bool, default=False, help='Restrict to the list of providers that are processed')
+    parser.add_argument('-t', '--to_process', dest='to_process', action='store_true',
+                        help='Restrict to the list of providers that are processed')
+    parser.add_argument('-p', '--providers', dest='providers', nargs='+', default=None,
+                        help='Restrict to these providers (%s)' % ', '.join(sorted(loaders)))
+    parser.add_argument('-n', '--processes', dest='nb_processes', type=int, default=4,
+                        help='Number of providers imported at the same time')
 
     p = parser.parse_args()
 
@@ -59,18 +213,17 @@ if __name__ == '__main__':
     log = logging.getLogger('Load_files_from_all_sources')
     log.info('Launching "load_files_from" programs for year_month, version %s - %r',  __version__, p)
 
-    year_months = p.year_months
-    if p.to_process:
-        selected_providers = Provider.find({'import_process': True})
-    else:
-        selected_providers = Provider.find({})
+    year_months = [ym.strip() for yms in p.year_months for ym in yms.split(',') if ym.strip()]
 
     start_time = time.time()
     Model.init_db(def_w=True)
+    if p.providers:
+        selected_providers = p.providers
+    elif p.to_process:
+        selected_providers = [pr['provider'] for pr in Provider.find({'import_process': True})]
+    else:
+        selected_providers = [pr['provider'] for pr in Provider.find({})]
 
-    launch_import(year_months, selected_providers)
-    log.info("\n\n--- %s seconds to load files from %d sources ---", time.time() - start_time, len(selected_providers))
+    results = launch_import(year_months, selected_providers, p.nb_processes)
+    log.info("\n\n--- %s seconds to load files from %d sources ---", time.time() - start_time, len(results))
     log.info('End')
-
-
-
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / airport_names
+# Purpose:     Names of the airports and cities ('query_names', and 'query_providers.<provider>' for the names used by a
+#              provider) loaded once from the database and indexed in memory, so that the import programs can find the
+#              codes of the names of their files without querying the airports for each row.
+#              The results are kept for the names already looked up. Optionally, the names not found are matched to
+#              the closest known name (trigram similarity), the matches being logged to be checked.
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import logging
+import re
+import sys
+from collections import defaultdict
+sys.path.append('../')
+from optidb.model import *
+
+log = logging.getLogger('airport_names')
+
+AIRPORT_NAMES = dict()
+
+
+def clean_name(name):
+    """
+    :param name: name of an airport or city, as found in a file
+    :return: the name as saved in 'query_names': lower case, without dots, and cut at the first '-', '/' or ','
+    """
+    return re.split(r'[-/,]', name.lower().replace('.', ''), 1)[0].strip()
+
+
+def trigrams(name):
+    padded = '  %s ' % name
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def names_of(value):
+    """
+    :return: list of the names of a field (single name or list of names)
+    """
+    if not value:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+class AirportNameIndex(object):
+    """
+    Codes of the airports and cities (with their country) keyed by their 'query_names' and by their names for a provider
+    """
+    def __init__(self, airports, provider, fuzzy=False, min_similarity=0.6):
+        """
+        :param airports: iterable of airport records with 'code', 'country', 'query_names' and 'query_providers'
+        :param provider: name of the provider, for the names of 'query_providers'
+        :param fuzzy: if True, the names not found are matched to the closest 'query_names'
+        :param min_similarity: minimal similarity (share of common trigrams) of a fuzzy match
+        """
+        self.provider = provider
+        self.fuzzy = fuzzy
+        self.min_similarity = min_similarity
+        self.by_query_name = defaultdict(list)
+        self.by_provider_name = defaultdict(list)
+        for airport in airports:
+            if not airport.get('code'):
+                continue
+            entry = (airport['code'], airport.get('country'))
+            for name in names_of(airport.get('query_names')):
+                self.by_query_name[name].append(entry)
+            for name in names_of((airport.get('query_providers') or {}).get(provider)):
+                self.by_provider_name[name].append(entry)
+        self.by_trigram = defaultdict(set)
+        if fuzzy:
+            for name in self.by_query_name:
+                for trigram in trigrams(name):
+                    self.by_trigram[trigram].add(name)
+        self.cache = dict()
+
+    @classmethod
+    def from_db(cls, provider, fuzzy=False, min_similarity=0.6):
+        provider_tag = 'query_providers.%s' % provider
+        query = {'code_type': {'$in': ['city', 'airport']},
+                 '$or': [{'query_names': {'$ne': None}}, {provider_tag: {'$ne': None}}]}
+        projection = {'_id': 0, 'code': 1, 'country': 1, 'query_names': 1, provider_tag: 1}
+        return cls(Airport.find(query, projection), provider, fuzzy, min_similarity)
+
+    def closest_name(self, city_clean, country=None):
+        """
+        :return: the 'query_names' with the most trigrams in common with the name (of an airport of the country, if
+        any), or None if none is similar enough
+        """
+        name_trigrams = trigrams(city_clean)
+        common = defaultdict(int)
+        for trigram in name_trigrams:
+            for name in self.by_trigram.get(trigram, ()):
+                common[name] += 1
+        best, best_similarity = None, self.min_similarity
+        for name, nb_common in sorted(common.items()):
+            similarity = nb_common / (len(name_trigrams) + len(trigrams(name)) - nb_common)
+            if similarity >= best_similarity and self.codes(self.by_query_name[name], country):
+                best, best_similarity = name, similarity
+        return best
+
+    @staticmethod
+    def codes(entries, country=None):
+        return set(code for code, airport_country in entries if country is None or airport_country == country)
+
+    def find(self, name, country=None):
+        """
+        Look up a name in 'query_names', then in the names of the provider
+        :param name: an upper case string
+        :param country: ISO2 code of the country of the airports (None: any country)
+        :return: set of airport codes (or None)
+        """
+        key = (name, country)
+        if key not in self.cache:
+            city_clean = clean_name(name)
+            codes = self.codes(self.by_query_name.get(city_clean, ()), country)
+            if not codes:
+                codes = self.codes(self.by_provider_name.get(name.strip(), ()), country)
+            if not codes and self.fuzzy:
+                closest = self.closest_name(city_clean, country)
+                if closest is not None:
+                    codes = self.codes(self.by_query_name[closest], country)
+                    log.warning('%r not found, matched to %r: %s', name, closest, sorted(codes))
+            self.cache[key] = codes or None
+        return self.cache[key]
+
+
+def get_airport_names(provider, fuzzy=False, reload=False):
+    """
+    Load the names index of a provider on first call (the database must be initialized), then share it
+    :param provider: name of the provider
+    :param fuzzy: if True, the names not found are matched to the closest known name (only used on first call)
+    :param reload: boolean, force a new load from the database
+    :return: AirportNameIndex
+    """
+    if provider not in AIRPORT_NAMES or reload:
+        AIRPORT_NAMES[provider] = AirportNameIndex.from_db(provider, fuzzy)
+        log.info('Airport names index of %s: %d query names, %d provider names', provider,
+                 len(AIRPORT_NAMES[provider].by_query_name), len(AIRPORT_NAMES[provider].by_provider_name))
+    return AIRPORT_NAMES[provider]
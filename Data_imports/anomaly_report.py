@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / anomaly_report
+# Purpose:     Collect the anomalies met during an import (unknown airports or airlines, airports in another country
+#              than in the file...) along with the number of passengers concerned, and report them at the end.
+#              Passengers are summed in plain dictionaries during the import; the report is only built once, and
+#              saved in the 'import_anomalies' collection so anomalies can be followed from one run to the other.
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import logging
+import sys
+sys.path.append('../')
+import pandas as pd
+from optidb.model import *
+from utils import utcnow
+
+log = logging.getLogger('anomaly_report')
+
+
+class Import_Anomaly(Model):
+    __collection__ = 'import_anomalies'
+
+
+class AnomalyCollector(object):
+    """
+    Passengers per (code, info_type) of the lines rejected or flagged during an import.
+    The descriptive information (name, city, countries...) of the first occurrence of each (code, info_type) is kept.
+    """
+    def __init__(self, name, provider, columns=()):
+        """
+        :param name: name of the report (ex: 'wrong_airports', 'unknown_airlines')
+        :param provider: string
+        :param columns: names of the descriptive columns, for the display of the report
+        """
+        self.name = name
+        self.provider = provider
+        self.columns = list(columns)
+        self.run_date = utcnow()
+        self.passengers = dict()
+        self.infos = dict()
+
+    def __len__(self):
+        return len(self.passengers)
+
+    def add(self, code, pax, info_type=None, info=None):
+        """
+        :param code: the code (or name) that could not be treated
+        :param pax: number of passengers concerned
+        :param info_type: kind of anomaly (ex: 'missing', 'country', 'state')
+        :param info: dict of descriptive information, only kept for the first occurrence
+        """
+        key = (code, info_type)
+        if key not in self.passengers:
+            self.passengers[key] = 0
+            self.infos[key] = info or dict()
+        self.passengers[key] += pax
+
+    def add_frame(self, frame):
+        """
+        Add anomalies identified on whole columns
+        :param frame: DataFrame with 'code' and 'passengers' columns, and optionally 'info_type' and descriptive columns
+        """
+        info_columns = [c for c in frame.columns if c not in ('code', 'info_type', 'passengers')]
+        for rec in frame.to_dict('records'):
+            info = dict((c, rec[c]) for c in info_columns)
+            self.add(rec['code'], rec['passengers'], rec.get('info_type'), info)
+
+    def report(self):
+        """
+        :return: DataFrame of the anomalies, sorted by decreasing number of passengers
+        """
+        records = []
+        for key, pax in self.passengers.items():
+            rec = dict(self.infos[key])
+            rec.update(code=key[0], info_type=key[1], passengers=pax)
+            records.append(rec)
+        columns = ['code'] + self.columns + ['info_type', 'passengers']
+        report = pd.DataFrame.from_records(records, columns=columns)
+        return report.sort_values('passengers', ascending=False)
+
+    def save(self):
+        """
+        Store the anomalies in the 'import_anomalies' collection, one document per (code, info_type) and per run
+        """
+        def log_bulk(self):
+            log.info('  store import_anomalies: %r', self.nresult)
+
+        with Import_Anomaly.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
+            for key, pax in self.passengers.items():
+                query = dict(provider=self.provider, report=self.name, run_date=self.run_date,
+                             code=key[0], info_type=key[1])
+                bulk.find(query).upsert().update_one({'$set': dict(passengers=int(pax), info=self.infos[key])})
+        log.info('stored %s anomalies: %r', self.name, bulk.nresult)
+
+    def log_report(self, logger, description):
+        """
+        Log the full report (if there is any anomaly) and save it in database
+        :param logger: the logger of the import program
+        :param description: description of the anomalies (ex: 'wrong or unknown airports')
+        """
+        if len(self) == 0:
+            return
+        report = self.report()
+        logger.warning("%s %s (check the reasons why): \n%s", len(report.index), description,
+                       report.to_string(index=False))
+        self.save()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / browser_pool
+# Purpose:     Headless Chrome sessions shared by the programs that need a browser to reach the providers' files.
+#              A session is started on first use and reused by the next downloads (instead of starting and closing
+#              Chrome for each file), with at most 'size' browsers alive at the same time.
+#              Each download sets the directory where the browser saves its files, so that several providers (or
+#              several months of a provider) can be downloaded at once in separate directories.
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import atexit
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from Queue import Queue, Empty
+from selenium import webdriver
+
+log = logging.getLogger('browser_pool')
+
+BROWSER_POOL = None
+
+
+class BrowserPool(object):
+    """
+    Pool of Chrome webdrivers. Use it through session():
+        with pool.session(download_dir) as driver:
+            driver.get(url)
+    """
+    def __init__(self, size=2, headless=True, implicit_wait=10):
+        """
+        :param size: maximum number of browsers alive at the same time (other sessions wait for a free browser)
+        :param headless: boolean, run Chrome without display
+        :param implicit_wait: seconds the drivers wait for elements to appear
+        """
+        self.size = size
+        self.headless = headless
+        self.implicit_wait = implicit_wait
+        self.idle = Queue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def start_driver(self):
+        options = webdriver.ChromeOptions()
+        if self.headless:
+            options.add_argument('--headless')
+            options.add_argument('--no-sandbox')
+            options.add_argument('--disable-gpu')
+        options.add_experimental_option("prefs", {
+            "download.prompt_for_download": False,
+        })
+        driver = webdriver.Chrome(chrome_options=options)
+        driver.implicitly_wait(self.implicit_wait)
+        # Chrome DevTools commands are needed to change the download directory of a running browser
+        driver.command_executor._commands['send_command'] = ('POST', '/session/$sessionId/chromium/send_command')
+        log.info('Chrome started (%d browsers max)', self.size)
+        return driver
+
+    @staticmethod
+    def set_download_dir(driver, download_dir):
+        if not os.path.isdir(download_dir):
+            os.makedirs(download_dir)
+        driver.execute('send_command', {'cmd': 'Browser.setDownloadBehavior',
+                                        'params': {'behavior': 'allow', 'downloadPath': os.path.abspath(download_dir)}})
+
+    @staticmethod
+    def reset(driver):
+        """
+        Close the windows opened during the session and leave the page, before the driver goes back to the pool
+        """
+        for handle in driver.window_handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(driver.window_handles[0])
+        driver.get('about:blank')
+
+    @staticmethod
+    def quit_driver(driver):
+        try:
+            driver.quit()
+        except Exception:
+            log.exception('Could not quit Chrome')
+
+    @contextmanager
+    def session(self, download_dir=None):
+        """
+        Borrow a browser from the pool (waiting for one to be free if 'size' browsers are already in use).
+        A browser that raised an exception during the session is not reused.
+        :param download_dir: directory where the browser saves the downloaded files (created if needed)
+        :return: webdriver
+        """
+        self.slots.acquire()
+        driver = None
+        try:
+            try:
+                driver = self.idle.get_nowait()
+            except Empty:
+                driver = self.start_driver()
+            if download_dir:
+                self.set_download_dir(driver, download_dir)
+            yield driver
+            self.reset(driver)
+            self.idle.put(driver)
+        except Exception:
+            if driver is not None:
+                self.quit_driver(driver)
+            raise
+        finally:
+            self.slots.release()
+
+    def close(self):
+        """
+        Quit all the idle browsers
+        """
+        while True:
+            try:
+                self.quit_driver(self.idle.get_nowait())
+            except Empty:
+                break
+
+
+def get_browser_pool(size=2):
+    """
+    Pool shared by all the downloads of the program, created on first call. Browsers are quit when the program exits.
+    :param size: maximum number of browsers alive at the same time (only used on first call)
+    :return: BrowserPool
+    """
+    global BROWSER_POOL
+    if BROWSER_POOL is None:
+        BROWSER_POOL = BrowserPool(size)
+        atexit.register(BROWSER_POOL.close)
+    return BROWSER_POOL
+
+
+def browser_session(download_dir=None):
+    """
+    Shortcut for get_browser_pool().session(download_dir)
+    """
+    return get_browser_pool().session(download_dir)
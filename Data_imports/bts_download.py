@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / bts_download
+# Purpose:     Download the T-100 segment files of the Bureau of Transportation Statistics (Table_ID=293) with plain
+#              HTTP requests: the download form is read once, then submitted for each year_month with the same fields
+#              as a browser would send, and the returned zip file is streamed to disk.
+#              The csv member of the zip is then read directly from the archive, without being extracted.
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import calendar
+import logging
+import os
+import urllib
+import urllib2
+import urlparse
+import zipfile
+from bs4 import BeautifulSoup
+
+log = logging.getLogger('bts_download')
+
+form_url = 'https://www.transtats.bts.gov/DL_SelectFields.asp?Table_ID=293'
+# Used if the form does not give its action (the form is usually submitted by javascript)
+default_action = 'DownLoad_Table.asp?Table_ID=293&Has_Group=3&Is_Zipped=0'
+
+
+def get_form(url=form_url):
+    """
+    Read the download form of the table
+    :param url: url of the form
+    :return: tuple (action url, list of (name, value) of the hidden fields, list of the variables of the table)
+    """
+    soup = BeautifulSoup(urllib2.urlopen(url).read(), 'html.parser')
+    form = soup.find('form') or soup
+    action = urlparse.urljoin(url, form.get('action') or default_action)
+    hidden_fields = [(i['name'], i.get('value', '')) for i in form.find_all('input', type='hidden') if i.get('name')]
+    variables = [i['value'] for i in form.find_all('input', type='checkbox')
+                 if i.get('name') == 'VarName' and i.get('value')]
+    return action, hidden_fields, variables
+
+
+def get_form_data(hidden_fields, variables, year, month):
+    """
+    Fields sent by the form when all the variables of a year_month are selected
+    :param hidden_fields: list of (name, value), as returned by get_form
+    :param variables: list of variable names
+    :param year: integer or string
+    :param month: integer or string
+    :return: list of (name, value)
+    """
+    fields = dict(hidden_fields)
+    year, month = int(year), int(month)
+    # The query is built by the javascript of the page from the selected variables, year and month
+    sql = ' SELECT %s FROM  %s WHERE Month =%d AND YEAR=%d' % (','.join(variables), fields.get('RawDataTable', ''),
+                                                             month, year)
+    data = [(k, v) for k, v in hidden_fields
+            if k not in ('sqlstr', 'varlist', 'XYEAR', 'FREQUENCY', 'time', 'timename')]
+    data.extend([('sqlstr', sql), ('varlist', ','.join(variables)), ('XYEAR', str(year)), ('FREQUENCY', str(month)),
+                 ('time', calendar.month_name[month]), ('timename', 'Month')])
+    data.extend(('VarName', v) for v in variables)
+    return data
+
+
+def download_month(year, month, path, form=None):
+    """
+    Submit the form for a year_month and stream the returned zip file to path
+    :param year: integer or string
+    :param month: integer or string
+    :param path: path of the zip file
+    :param form: tuple returned by get_form (read from the website if not given)
+    :return: path
+    """
+    action, hidden_fields, variables = form or get_form()
+    data = urllib.urlencode(get_form_data(hidden_fields, variables, year, month))
+    response = urllib2.urlopen(urllib2.Request(action, data))
+    tmp_path = path + '.part'
+    with open(tmp_path, 'wb') as f_out:
+        while True:
+            chunk = response.read(1 << 20)
+            if not chunk:
+                break
+            f_out.write(chunk)
+    response.close()
+    os.rename(tmp_path, path)
+    log.info('%s downloaded (%d bytes)', os.path.basename(path), os.path.getsize(path))
+    return path
+
+
+class ZipMember(object):
+    """
+    File object of a member of a zip file, closing the archive with the member:
+        with ZipMember(zip_path, name) as f:
+            for line in f: ...
+    """
+    def __init__(self, zip_path, name):
+        self.archive = zipfile.ZipFile(zip_path, 'r')
+        try:
+            self.member = self.archive.open(name)
+        except Exception:
+            self.archive.close()
+            raise
+
+    def __iter__(self):
+        return iter(self.member)
+
+    def read(self, *args):
+        return self.member.read(*args)
+
+    def readline(self, *args):
+        return self.member.readline(*args)
+
+    def close(self):
+        try:
+            self.member.close()
+        finally:
+            self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_csv_member(zip_path):
+    """
+    :param zip_path: path of a zip file downloaded from the BTS
+    :return: ZipMember of the csv file in the zip, decompressed while it is read (closing it closes the archive)
+    """
+    with zipfile.ZipFile(zip_path, 'r') as archive:
+        csv_name = [f for f in archive.namelist() if f.lower().endswith('.csv')][0]
+    return ZipMember(zip_path, csv_name)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / bulk_writer
+# Purpose:     Bulk writes shared by the threads of a pool, without lock: each thread adds its operations to its own
+#              buffer (same methods as the bulks of the models: find(...).update_one(...), find(...).upsert()...,
+#              insert(...)), full buffers are sent through a bounded queue to a dedicated thread that executes them
+#              with the bulks of the model.
+#              When the queue is full, the threads adding operations wait for the writer (backpressure), so that the
+#              memory used by the pending operations stays bounded.
+#              The numbers of operations in flight (queued, not executed yet) and flushed are available in stats(), to
+#              tune the size of the pool against the database.
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import logging
+import threading
+import time
+from Queue import Queue, Full
+
+log = logging.getLogger('bulk_writer')
+
+
+class Operation(object):
+    """
+    Operation on the documents selected by a query, recorded in a buffer (same methods as the bulks of the models)
+    """
+    def __init__(self, buffer, query):
+        self.buffer = buffer
+        self.query = query
+        self.is_upsert = False
+
+    def upsert(self):
+        self.is_upsert = True
+        return self
+
+    def update_one(self, update):
+        self.buffer.add(('update_one', self.query, update, self.is_upsert))
+
+
+class Buffer(object):
+    """
+    Operations of a thread. Only this thread writes in the buffer (and in its counters)
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.operations = []
+        self.queued = 0
+        self.waiting_time = 0.
+
+    def add(self, operation):
+        self.operations.append(operation)
+        if len(self.operations) >= self.writer.batch_size:
+            self.send()
+
+    def send(self):
+        """
+        Send the operations to the writer, waiting if its queue is full
+        """
+        if self.operations:
+            operations, self.operations = self.operations, []
+            self.queued += len(operations)
+            try:
+                self.writer.queue.put_nowait(operations)
+            except Full:
+                start = time.time()
+                self.writer.queue.put(operations)
+                self.waiting_time += time.time() - start
+
+
+class BulkWriter(object):
+    """
+    Use it as a bulk of the model, from any thread:
+        with BulkWriter(Model, 1000) as bulk, ThreadPool(20) as pool:
+            pool.add_task(f, bulk)   # f calls bulk.find(query).update_one(update) or bulk.insert(doc)
+    The operations still in the buffers are sent when the writer is closed (after the pool has finished).
+    """
+    def __init__(self, model, batch_size=1000, queue_size=8, execute_callback=None):
+        """
+        :param model: model of the collection
+        :param batch_size: number of operations sent to the writer at once, and executed in one bulk
+        :param queue_size: maximum number of batches waiting for the writer
+        :param execute_callback: function(bulk), called after each execution of a bulk (as for the bulks of the models)
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.execute_callback = execute_callback
+        self.queue = Queue(maxsize=queue_size)
+        self.local = threading.local()
+        self.buffers = []
+        self.flushed = 0
+        self.nresult = dict()
+        self.error = None
+        self.thread = threading.Thread(target=self.write, name='bulk_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def buffer(self):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            buffer = self.local.buffer = Buffer(self)
+            self.buffers.append(buffer)
+        return buffer
+
+    def find(self, query):
+        return Operation(self.buffer, query)
+
+    def insert(self, document):
+        self.buffer.add(('insert', document, None, False))
+
+    def write(self):
+        """
+        Loop of the writer thread: execute the batches of operations until None is received
+        """
+        while True:
+            operations = self.queue.get()
+            if operations is None:
+                break
+            if self.error is None:
+                try:
+                    self.execute(operations)
+                except Exception as e:
+                    # Keep on reading the queue, so that the threads adding operations are not blocked
+                    log.exception('Bulk write failed')
+                    self.error = e
+            self.flushed += len(operations)
+
+    def execute(self, operations):
+        with self.model.unordered_bulk(self.batch_size, execute_callback=self.execute_callback) as bulk:
+            for kind, query, update, upsert in operations:
+                if kind == 'insert':
+                    bulk.insert(query)
+                else:
+                    operation = bulk.find(query)
+                    if upsert:
+                        operation = operation.upsert()
+                    operation.update_one(update)
+        if isinstance(bulk.nresult, dict):
+            for key, value in bulk.nresult.items():
+                if isinstance(value, (int, long)):
+                    self.nresult[key] = self.nresult.get(key, 0) + value
+
+    def stats(self):
+        """
+        :return: dict with the numbers of operations buffered (not sent yet), in flight (sent, not executed yet) and
+        flushed (executed), the number of threads having a buffer, and the time spent waiting for the writer
+        """
+        queued = sum(buffer.queued for buffer in self.buffers)
+        return dict(buffered=sum(len(buffer.operations) for buffer in self.buffers),
+                    in_flight=queued - self.flushed, flushed=self.flushed, threads=len(self.buffers),
+                    waiting_time=sum(buffer.waiting_time for buffer in self.buffers))
+
+    def close(self):
+        """
+        Send the operations left in the buffers, wait for the writer to execute them, and raise its error if any.
+        To be called once all the threads have finished adding operations.
+        """
+        for buffer in self.buffers:
+            buffer.send()
+        self.queue.put(None)
+        self.thread.join()
+        log.info('bulk writer closed: %r', self.stats())
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not hide the original exception
+            try:
+                self.close()
+            except Exception:
+                log.exception('Bulk writer error after %s', exc_type.__name__)
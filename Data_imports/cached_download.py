@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / cached_download
+# Purpose:     Download files into a local directory with a pool of threads, and keep the ETag / Last-Modified
+#              headers of each file next to it (<file>.meta) so that unchanged files are not downloaded again.
+#              Files can also be taken from a local mirror directory (for offline runs), in which case the
+#              modification date of the mirrored file plays the part of the Last-Modified header.
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import json
+import logging
+import os
+import sys
+import urllib
+import urllib2
+from Queue import Queue
+sys.path.append('../')
+from utils import utcnow
+from utils.threads import ThreadPool
+
+log = logging.getLogger('cached_download')
+
+
+def read_meta(path):
+    """
+    :param path: path of the downloaded file
+    :return: dict of the headers stored at the last download (empty if the file was never downloaded)
+    """
+    if not (os.path.isfile(path) and os.path.isfile(path + '.meta')):
+        return dict()
+    with open(path + '.meta') as f:
+        return json.load(f)
+
+
+def fetch(url, path):
+    """
+    Download url into path, unless the server (or the mirror) tells the file did not change since the last download
+    :param url: http(s) url, or file:// url of a mirrored file
+    :param path: local path of the file
+    :return: boolean, True if the file was (re)downloaded
+    """
+    meta = read_meta(path)
+    request = urllib2.Request(url)
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            return False
+        raise
+    headers = response.info()
+    etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+    # Servers ignoring conditional requests (and file:// urls) still send the headers
+    if meta and (etag or last_modified) and meta.get('etag') == etag and meta.get('last_modified') == last_modified:
+        response.close()
+        return False
+
+    tmp_path = path + '.part'
+    with open(tmp_path, 'wb') as f_out:
+        while True:
+            chunk = response.read(1 << 20)
+            if not chunk:
+                break
+            f_out.write(chunk)
+    response.close()
+    os.rename(tmp_path, path)
+    with open(path + '.meta', 'w') as f:
+        json.dump(dict(url=url, etag=etag, last_modified=last_modified, downloaded=utcnow().isoformat()), f)
+    return True
+
+
+def fetch_all(files, dest_dir, nb_workers=8, mirror_dir=None):
+    """
+    Download files in parallel, and yield each of them as soon as it is available, so that the caller can process
+    the first files while the next ones are being downloaded.
+    :param files: list of (url, filename) tuples
+    :param dest_dir: directory where the files (and their .meta) are stored
+    :param nb_workers: number of parallel downloads
+    :param mirror_dir: if set, files are taken from mirror_dir/<filename> instead of their url
+    :return: generator of (url, path, error) tuples, in the order of completion. error is None if the file is
+    available in path, else the exception raised during the download.
+    """
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    done = Queue()
+
+    def download(url, filename):
+        path = os.path.join(dest_dir, filename)
+        source = url
+        if mirror_dir:
+            source = 'file:' + urllib.pathname2url(os.path.abspath(os.path.join(mirror_dir, filename)))
+        try:
+            if fetch(source, path):
+                log.info('downloaded %s', filename)
+            else:
+                log.info('%s unchanged since last download', filename)
+            done.put((url, path, None))
+        except Exception as e:
+            log.exception('could not download %s', source)
+            done.put((url, path, e))
+
+    with ThreadPool(nb_workers) as pool:
+        for url, filename in files:
+            pool.add_task(download, url, filename)
+        for _ in files:
+            yield done.get()
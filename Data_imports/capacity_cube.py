@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / capacity_cube
+# Purpose:     Active capacities of capacity_initial_data, summed per month with a single aggregation (per origin,
+#              destination, operating airline and ref_code) and kept in memory, to answer the capacity aggregations that
+#              were sent to the database for each external line (treat_sources_scope) or route (Mexico).
+#              Queries are the same match dictionaries as for the database (see get_match in treat_sources_scope),
+#              and give the same results.
+#              A month is loaded on first use, and reloaded when its capacities have changed in the database
+#              (number of active records, total capacity or last record differ from the ones of the loaded month).
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import logging
+import threading
+import time
+from collections import defaultdict
+
+log = logging.getLogger('capacity_cube')
+
+CAPACITY_CUBE = None
+
+cell_fields = ('year_month', 'origin', 'destination', 'operating_airline', 'operating_airline_ref_code', 'record_ok')
+# Fields of the groups returned by CapacityCube.capacities (same as the former aggregation)
+group_fields = ('origin', 'destination', 'operating_airline_ref_code', 'operating_airline', 'year_month')
+supported_conditions = set(cell_fields) | {'active_rec', 'capacity', '$or'}
+
+
+def matches(value, condition):
+    """
+    :param value: value of a field of a record
+    :param condition: value or {'$in': [values]}
+    :return: True if the query {field: condition} selects the record
+    """
+    if isinstance(condition, dict):
+        return any(matches(value, c) for c in condition['$in'])
+    if isinstance(value, list):
+        return value == condition or condition in value
+    return value == condition
+
+
+def condition_values(condition):
+    """
+    :return: list of the values allowed by a condition (value or {'$in': [values]})
+    """
+    return condition['$in'] if isinstance(condition, dict) else [condition]
+
+
+def hashable(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+class MonthCapacity(object):
+    """
+    Capacities of a year_month, per (origin, destination, operating_airline, operating_airline_ref_code, record_ok)
+    and separately for the positive capacities, indexed by origin, destination and (origin, destination), with the set
+    of the routes (origin, destination) having a positive capacity
+    """
+    def __init__(self, year_month, cells, fingerprint=None):
+        """
+        :param year_month: YYYY-MM
+        :param cells: iterable of dicts with the cell_fields, 'positive' (capacity > 0) and 'capacity'
+        :param fingerprint: value returned by CapacityCube.fingerprint when the cells were loaded
+        """
+        self.year_month = year_month
+        self.fingerprint = fingerprint
+        self.checked = time.time()
+        self.cells = list(cells)
+        self.by_origin = defaultdict(list)
+        self.by_destination = defaultdict(list)
+        self.by_od = defaultdict(list)
+        self.routes = set()
+        for i, cell in enumerate(self.cells):
+            self.by_origin[cell['origin']].append(i)
+            self.by_destination[cell['destination']].append(i)
+            self.by_od[(cell['origin'], cell['destination'])].append(i)
+            if cell['positive']:
+                self.routes.add((hashable(cell['origin']), hashable(cell['destination'])))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def branch_cells(self, branch):
+        """
+        :param branch: dict with optional 'origin' and 'destination' conditions
+        :return: set of the indexes of the cells satisfying the conditions
+        """
+        origins = condition_values(branch['origin']) if 'origin' in branch else None
+        destinations = condition_values(branch['destination']) if 'destination' in branch else None
+        if origins is not None and destinations is not None:
+            return {i for o in set(origins) for d in set(destinations) for i in self.by_od.get((o, d), ())}
+        if origins is not None:
+            return {i for o in set(origins) for i in self.by_origin.get(o, ())}
+        if destinations is not None:
+            return {i for d in set(destinations) for i in self.by_destination.get(d, ())}
+        return set(range(len(self.cells)))
+
+    def select(self, match):
+        """
+        :param match: query on capacity_initial_data (year_month and active_rec are not checked here)
+        :return: list of the cells satisfying the query
+        """
+        if '$or' in match:
+            branches = match['$or']
+        else:
+            branches = [dict((k, v) for k, v in match.items() if k in ('origin', 'destination'))]
+        indexes = set()
+        for branch in branches:
+            indexes.update(self.branch_cells(branch))
+
+        conditions = [(k, match[k]) for k in ('operating_airline', 'operating_airline_ref_code', 'record_ok')
+                      if k in match]
+        positive_only = 'capacity' in match
+        return [self.cells[i] for i in sorted(indexes)
+                if (self.cells[i]['positive'] or not positive_only) and
+                all(matches(self.cells[i].get(k), c) for k, c in conditions)]
+
+
+class CapacityCube(object):
+    """
+    Active capacities of the months used by the program, loaded on demand
+    """
+    def __init__(self, capacity_model, check_interval=300):
+        """
+        :param capacity_model: model of the capacity_initial_data collection
+        :param check_interval: seconds after which a loaded month is checked for changes in the database
+        """
+        self.capacity_model = capacity_model
+        self.check_interval = check_interval
+        self.months = dict()
+        self.lock = threading.Lock()
+
+    def fingerprint(self, year_month):
+        """
+        :return: tuple (number of active records, total capacity, last _id) of the month, changed by any import
+        """
+        result = list(self.capacity_model.aggregate([
+            {'$match': {'year_month': year_month, 'active_rec': True}},
+            {'$group': {'_id': None, 'count': {'$sum': 1}, 'capacity': {'$sum': '$capacity'},
+                        'last_id': {'$max': '$_id'}}}
+        ]))
+        if not result:
+            return None
+        return result[0]['count'], result[0]['capacity'], result[0]['last_id']
+
+    def load(self, year_month):
+        """
+        :return: MonthCapacity read from the database
+        """
+        fingerprint = self.fingerprint(year_month)
+        group = dict((k, '$%s' % k) for k in cell_fields)
+        group['positive'] = {'$gt': ['$capacity', 0]}
+        cells = self.capacity_model.aggregate([
+            {'$match': {'year_month': year_month, 'active_rec': True}},
+            {'$group': {'_id': group, 'capacity': {'$sum': '$capacity'}}}
+        ])
+
+        def process_cell(cell):
+            cell.update(cell.pop('_id'))
+            return cell
+
+        month = MonthCapacity(year_month, (process_cell(cell) for cell in cells), fingerprint)
+        log.info('%d capacity cells loaded for %s', len(month), year_month)
+        return month
+
+    def month(self, year_month):
+        """
+        :return: MonthCapacity of the year_month, (re)loaded if needed
+        """
+        with self.lock:
+            month = self.months.get(year_month)
+            if month is not None and time.time() - month.checked > self.check_interval:
+                if self.fingerprint(year_month) == month.fingerprint:
+                    month.checked = time.time()
+                else:
+                    log.info('Capacities of %s have changed', year_month)
+                    month = None
+            if month is None:
+                month = self.months[year_month] = self.load(year_month)
+            return month
+
+    def invalidate(self, year_month=None):
+        """
+        Forget a month (all the months by default), to reload it on next use
+        """
+        with self.lock:
+            if year_month is None:
+                self.months.clear()
+            else:
+                self.months.pop(year_month, None)
+
+    def routes(self, year_month):
+        """
+        :param year_month: YYYY-MM
+        :return: set of the (origin, destination) with a positive active capacity in the year_month
+        """
+        return self.month(year_month).routes
+
+    def capacities(self, match):
+        """
+        Same result as the aggregation of capacity_initial_data with this match, grouped by origin, destination,
+        operating_airline_ref_code, operating_airline and year_month
+        :param match: dict returned by get_match(unique, for_segments=False, with_ref_code=True), with active_rec=True
+        and optionally capacity={'$gt': 0}
+        :return: list of dicts with the group_fields and 'capacity'
+        """
+        unsupported = set(match) - supported_conditions
+        if unsupported or match.get('active_rec') is not True or match.get('capacity', {'$gt': 0}) != {'$gt': 0}:
+            raise ValueError('Unsupported conditions in capacity match: %r' % match)
+
+        groups = dict()
+        for year_month in set(condition_values(match['year_month'])):
+            for cell in self.month(year_month).select(match):
+                key = tuple(hashable(cell.get(k)) for k in group_fields)
+                if key not in groups:
+                    groups[key] = dict((k, cell.get(k)) for k in group_fields)
+                    groups[key]['capacity'] = 0
+                groups[key]['capacity'] += cell['capacity']
+        return list(groups.values())
+
+
+def get_capacity_cube(capacity_model, check_interval=300):
+    """
+    Cube shared by the whole program, created on first call
+    :param capacity_model: model of the capacity_initial_data collection
+    :param check_interval: seconds after which a loaded month is checked for changes (only used on first call)
+    :return: CapacityCube
+    """
+    global CAPACITY_CUBE
+    if CAPACITY_CUBE is None:
+        CAPACITY_CUBE = CapacityCube(capacity_model, check_interval)
+    return CAPACITY_CUBE
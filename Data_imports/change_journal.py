@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / change_journal
+# Purpose:     Append-only journal of the changes made to new_segment_initial_data by a run of treat_sources_scope,
+#              to undo the run without scanning the history of the segments:
+#              - update: id of the segment, values before and after the update, line of external_segment applied
+#              - create: line of external_segment and date of the segments it created (their loaded_from_record and
+#                loaded_from_date)
+#              - remove: complete segment removed (segments created by former runs, created again)
+#              undo_run replays the journal of a run backwards, in unordered bulks executed in parallel: removed
+#              segments are inserted again, created ones removed, and updated ones set back to their former values
+#              (their history entries of the run are pulled).
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import logging
+from collections import defaultdict
+from bulk_writer import BulkWriter
+from utils.threads import ThreadPool
+
+log = logging.getLogger('change_journal')
+
+
+class ChangeJournal(object):
+    """
+    Journal of a run, written through a BulkWriter (can be used from the threads of a pool):
+        with ChangeJournal(Journal, 'run name', '2016-01') as journal:
+            journal.updated(segment_id, before, after, line_id)
+    """
+    def __init__(self, journal_model, run, year_month, batch_size=1000):
+        """
+        :param journal_model: model of the journal collection
+        :param run: name of the run
+        :param year_month: year_month treated by the run (YYYY-MM)
+        :param batch_size: number of entries written at once
+        """
+        self.journal_model = journal_model
+        self.run = run
+        self.year_month = year_month
+        self.writer = BulkWriter(journal_model, batch_size)
+
+    def add(self, kind, **entry):
+        self.writer.insert(dict(entry, run=self.run, year_month=self.year_month, kind=kind))
+
+    def updated(self, segment_id, before, after, line_id):
+        """
+        :param segment_id: _id of the segment
+        :param before: dict of the values of the segment before the update
+        :param after: dict of the values set by the update
+        :param line_id: _id of the line of external_segment applied
+        """
+        self.add('update', segment=segment_id, before=before, after=after, line=line_id)
+
+    def created(self, line_id, loaded_from_date):
+        """
+        :param line_id: _id of the line of external_segment
+        :param loaded_from_date: loaded_from_date of the segments created from this line
+        """
+        self.add('create', line=line_id, loaded_from_date=loaded_from_date)
+
+    def remove(self, segment_model, query):
+        """
+        Remove segments, and journal the ones that were not created by this run.
+        To be called when no other thread adds entries to the journal.
+        :param segment_model: model of the new_segment_initial_data collection
+        :param query: query of the segments to remove
+        :return: result of the removal
+        """
+        # The entries still buffered are written first, to see the segments created by this run
+        self.flush()
+        created = set((entry['line'], entry['loaded_from_date'])
+                      for entry in self.journal_model.find({'run': self.run, 'year_month': self.year_month,
+                                                            'kind': 'create'}, {'line': 1, 'loaded_from_date': 1}))
+        nb_removed = 0
+        for segment in segment_model.find(query):
+            origin = ((segment.get('loaded_from_record') or {}).get('_id'), segment.get('loaded_from_date'))
+            if origin not in created:
+                self.add('remove', segment=segment['_id'], before=dict(segment))
+                nb_removed += 1
+        # The removed segments must be journaled before being removed
+        self.flush()
+        log.info('%d removed segments journaled', nb_removed)
+        return segment_model.remove(query)
+
+    def flush(self):
+        """
+        Write the entries added so far
+        """
+        self.writer.close()
+        self.writer = BulkWriter(self.journal_model, self.writer.batch_size)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.writer.__exit__(exc_type, exc_value, traceback)
+
+
+def undo_entries(segment_model, kind, entries, run, batch_size=1000):
+    """
+    Undo a part of the journal of a run, in one unordered bulk
+    :param segment_model: model of the new_segment_initial_data collection
+    :param kind: kind of the entries ('update', 'create' or 'remove')
+    :param entries: list of entries of the journal
+    :param run: name of the run
+    :return: number of segments inserted again, removed or restored
+    """
+    if kind == 'create':
+        lines = defaultdict(list)
+        for entry in entries:
+            lines[entry['loaded_from_date']].append({'_id': entry['line']})
+        nb_removed = 0
+        for loaded_from_date, line_ids in lines.items():
+            result = segment_model.remove({'source': 'external_source', 'loaded_from_date': loaded_from_date,
+                                           'loaded_from_record': {'$in': line_ids}})
+            log.info('  undo create: %r', result)
+            nb_removed += (result or {}).get('n', 0)
+        return nb_removed
+
+    def log_bulk(self):
+        log.info('  undo %s: %r', kind, self.nresult)
+
+    with segment_model.unordered_bulk(batch_size, execute_callback=log_bulk) as bulk:
+        for entry in entries:
+            if kind == 'remove':
+                bulk.insert(entry['before'])
+            else:
+                bulk.find({'_id': entry['segment']}).update_one({'$set': entry['before'],
+                                                                 '$pull': {'updated': {'run': run}}})
+    return (bulk.nresult or {}).get('nInserted' if kind == 'remove' else 'nMatched', 0)
+
+
+def undo_run(journal_model, segment_model, run, year_month=None, nb_threads=4, batch_size=1000):
+    """
+    Undo the changes of a run: the removed segments are inserted again, then the created segments are removed, then
+    the updated segments get back their values before the run (the first values journaled for each segment)
+    :param journal_model: model of the journal collection
+    :param segment_model: model of the new_segment_initial_data collection
+    :param run: name of the run
+    :param year_month: year_month of the run (all the year_months of the run by default)
+    :param nb_threads: number of bulks executed at the same time
+    :param batch_size: number of entries per bulk
+    :return: dict {kind: number of segments inserted again, removed or restored}
+    """
+    query = {'run': run}
+    if year_month is not None:
+        query['year_month'] = year_month
+    result = dict()
+    for kind in ('remove', 'create', 'update'):
+        entries = list(journal_model.find(dict(query, kind=kind)))
+        if kind == 'update':
+            # A segment updated several times by the run gets back its values before the first update
+            first = dict()
+            for entry in sorted(entries, key=lambda e: e['_id']):
+                first.setdefault(entry['segment'], entry)
+            entries = list(first.values())
+        log.info('Undo %d %s entries of run %r', len(entries), kind, run)
+        # The pool does not return the results nor the exceptions of its tasks
+        applied, errors = [], []
+
+        def undo_task(part):
+            try:
+                applied.append(undo_entries(segment_model, kind, part, run, batch_size))
+            except Exception as e:
+                log.exception('Undo of %d %s entries failed', len(part), kind)
+                errors.append(e)
+
+        with ThreadPool(nb_threads) as pool:
+            for i in range(0, len(entries), batch_size):
+                pool.add_task(undo_task, entries[i:i + batch_size])
+        if errors:
+            raise errors[0]
+        result[kind] = sum(applied)
+        log.info('Undo %s: %d of %d entries applied', kind, result[kind], len(entries))
+    return result
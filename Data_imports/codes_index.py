@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / codes_index
+# Purpose:     Airports' codes loaded once from the database and indexed by internal code, IATA code and ICAO code,
+#              so that the import programs can translate one code into another without scanning the airports.
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import logging
+import sys
+sys.path.append('../')
+from optidb.model import *
+
+log = logging.getLogger('codes_index')
+
+CODES_INDEX = None
+
+
+class AirportCodesIndex(object):
+    """
+    Dictionaries of the airports (with their country) keyed by 'code', 'iata_code' and 'icao_code'
+    """
+    fields = ('code', 'iata_code', 'icao_code', 'country', 'state', 'city', 'name')
+
+    def __init__(self, airports):
+        """
+        :param airports: iterable of airport records (with at least some of the fields above)
+        """
+        self.by_code = dict()
+        self.by_iata = dict()
+        self.by_icao = dict()
+        for airport in airports:
+            if airport.get('code'):
+                self.by_code[airport['code']] = airport
+            if airport.get('iata_code'):
+                self.by_iata[airport['iata_code']] = airport
+            if airport.get('icao_code'):
+                self.by_icao[airport['icao_code']] = airport
+
+    @classmethod
+    def from_db(cls):
+        query = {'$or': [{'code': {'$ne': None}}, {'iata_code': {'$ne': None}}, {'icao_code': {'$ne': None}}]}
+        projection = dict((f, 1) for f in cls.fields)
+        projection['_id'] = 0
+        return cls(Airport.find(query, projection))
+
+    def icao_to_iata(self, icao_code):
+        airport = self.by_icao.get(icao_code)
+        return airport.get('iata_code') if airport else None
+
+    def icao_to_code(self, icao_code):
+        airport = self.by_icao.get(icao_code)
+        return airport.get('code') if airport else None
+
+    def iata_to_icao(self, iata_code):
+        airport = self.by_iata.get(iata_code)
+        return airport.get('icao_code') if airport else None
+
+    def code_to_iata(self, code):
+        airport = self.by_code.get(code)
+        return airport.get('iata_code') if airport else None
+
+    def country(self, code):
+        """
+        :param code: internal airport code
+        :return: ISO2 country code of the airport (or None)
+        """
+        airport = self.by_code.get(code)
+        return airport.get('country') if airport else None
+
+
+def get_codes_index(reload=False):
+    """
+    Load the airports' codes index on first call (the database must be initialized), then share it
+    :param reload: boolean, force a new load from the database
+    :return: AirportCodesIndex
+    """
+    global CODES_INDEX
+    if CODES_INDEX is None or reload:
+        CODES_INDEX = AirportCodesIndex.from_db()
+        log.info('Airport codes index: %d codes, %d iata codes, %d icao codes',
+                 len(CODES_INDEX.by_code), len(CODES_INDEX.by_iata), len(CODES_INDEX.by_icao))
+    return CODES_INDEX
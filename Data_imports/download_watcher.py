@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / download_watcher
+# Purpose:     Wait for the file downloaded by a browser to be complete, instead of sleeping for a fixed time and
+#              then taking the latest file of the directory (which may be a stale file, or a partial one).
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import logging
+import os
+import time
+
+log = logging.getLogger('download_watcher')
+
+# Extensions of the files written by the browsers while downloading
+partial_extensions = ('.crdownload', '.part', '.download', '.tmp')
+
+
+class DownloadTimeout(Exception):
+    pass
+
+
+def list_files(directory):
+    """
+    :param directory: download directory
+    :return: set of the file names in the directory, to be taken before the download is triggered
+    """
+    return set(os.listdir(directory))
+
+
+def wait_for_download(directory, before, timeout=900, poll=1):
+    """
+    Poll the directory until a new file (not in before) is completely downloaded: no partial file is left in the
+    directory, and the size of the new file did not change since the previous poll.
+    :param directory: download directory
+    :param before: set of the file names present before the download was triggered (see list_files)
+    :param timeout: maximum number of seconds to wait
+    :param poll: number of seconds between two checks
+    :return: full path of the downloaded file
+    """
+    start = time.time()
+    sizes = dict()
+    while time.time() - start < timeout:
+        new_files = [f for f in list_files(directory) - before if not f.startswith('.')]
+        partial = [f for f in new_files if f.endswith(partial_extensions)]
+        complete = [f for f in new_files if not f.endswith(partial_extensions)]
+        if complete and not partial:
+            name = max(complete, key=lambda f: os.path.getmtime(os.path.join(directory, f)))
+            size = os.path.getsize(os.path.join(directory, name))
+            if size > 0 and sizes.get(name) == size:
+                log.info('%s downloaded in %.0f seconds', name, time.time() - start)
+                return os.path.join(directory, name)
+            sizes[name] = size
+        time.sleep(poll)
+    raise DownloadTimeout('No complete download in %s after %d seconds' % (directory, timeout))
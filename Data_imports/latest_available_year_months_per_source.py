@@ -21,7 +21,6 @@ import urllib
 import urllib2
 import traceback
 from bs4 import BeautifulSoup
-from selenium import webdriver
 import locale
 import pandas as pd
 from datetime import datetime
@@ -32,6 +31,7 @@ sys.path.append('../')
 from optidb.model import *
 from utils.logging_utils import BackupFileHandler
 from utils import YearMonth
+from browser_pool import browser_session
 
 __version__ = 'V1.0.1'
 
@@ -178,21 +178,18 @@ def update_latest_available_dates(providers):
         provider = 'India - domestic'
         log.info('  ----- Finding latest available year_month for %s' % provider)
         url = 'http://dgca.nic.in/pub/pub-ind.htm'
-        # Set chrome options and reach the website
-        options = webdriver.ChromeOptions()
-        driver = webdriver.Chrome(chrome_options=options)
-        driver.implicitly_wait(10)
-        driver.get(url)
-        driver.find_element_by_css_selector("a[href*=%s]" % 'CITYPAIR').click()
-        yms = []
-        for ym in driver.find_elements_by_link_text('Click'):
-            if 'xls' not in ym.get_attribute('href'):
-                continue
-            yms.append(ym.get_attribute('href').split('.xls')[0].split('%20')[-2:])
+        # Reach the website with a browser of the pool
+        with browser_session() as driver:
+            driver.get(url)
+            driver.find_element_by_css_selector("a[href*=%s]" % 'CITYPAIR').click()
+            yms = []
+            for ym in driver.find_elements_by_link_text('Click'):
+                if 'xls' not in ym.get_attribute('href'):
+                    continue
+                yms.append(ym.get_attribute('href').split('.xls')[0].split('%20')[-2:])
         ym_list = []
         for ym in yms:
             ym_list.append(ym[1].encode() + '-' + english_months.get(ym[0].encode().translate(None, ' .,/').lower(), '00'))
-        driver.close()
         max_year_month = max(ym_list)
         Provider.update(query={'provider': provider}, update={'$set': {'latest_ym_available': max_year_month}})
 
@@ -201,19 +198,16 @@ def update_latest_available_dates(providers):
         provider = 'India - intl'
         log.info('  ----- Finding latest available year_month for %s' % provider)
         url = 'http://dgca.nic.in/pub/pub-ind.htm'
-        # Set chrome options and reach the website
-        options = webdriver.ChromeOptions()
-        driver = webdriver.Chrome(chrome_options=options)
-        driver.implicitly_wait(10)
-        driver.get(url)
-        # Click on the international section link
-        driver.find_elements_by_xpath("//*[contains(text(), 'International Traffic')]")[0].click()
-        # Find all quarters
-        yms = []
-        for link in driver.find_elements_by_partial_link_text(''):
-            yms.append(str(link.get_attribute('href').split('%20')[-1].split('.')[0]) + '-' +
-                         english_months.get(link.text.split('-')[-1].lower()))
-        driver.close()
+        # Reach the website with a browser of the pool
+        with browser_session() as driver:
+            driver.get(url)
+            # Click on the international section link
+            driver.find_elements_by_xpath("//*[contains(text(), 'International Traffic')]")[0].click()
+            # Find all quarters
+            yms = []
+            for link in driver.find_elements_by_partial_link_text(''):
+                yms.append(str(link.get_attribute('href').split('%20')[-1].split('.')[0]) + '-' +
+                           english_months.get(link.text.split('-')[-1].lower()))
         max_year_month = max(yms)
         Provider.update(query={'provider': provider}, update={'$set': {'latest_ym_available': max_year_month}})
 
@@ -14,7 +14,6 @@
 from __future__ import print_function
 import time
 import argparse
-from selenium import webdriver
 from selenium.common.exceptions import NoSuchElementException
 import locale
 import logging
@@ -25,6 +24,11 @@ sys.path.append('../')
 from optidb.model import *
 from utils import utcnow
 from utils.logging_utils import BackupFileHandler
+from segment_accumulator import SegmentAccumulator
+from download_watcher import list_files, wait_for_download
+from browser_pool import browser_session
+from codes_index import get_codes_index
+from airport_names import get_airport_names
 import pandas as pd
 import numpy as np
 from unidecode import unidecode
@@ -60,34 +64,25 @@ def get_international_file():
     # Only download the file once
     if end_name not in os.listdir(tmp_dir):
 
-        # Set chrome options and reach the website
-        options = webdriver.ChromeOptions()
-        options.add_experimental_option("prefs", {
-            "download.default_directory": tmp_dir,
-            "download.prompt_for_download": False,
-        })
-        driver = webdriver.Chrome(chrome_options=options)
-        driver.implicitly_wait(10)
-        driver.get(international_url)
-
-        # Download the international file for city pairs up to current date
-        try:
-            driver.find_element_by_xpath("//a[contains(@href, 'CityPairs') and contains(@href, 'Current')]")
-        except:
-            log.info("International file not found")
-            driver.close()
-            pass
-        else:
-            # Click on the right excel file's link
-            driver.find_element_by_xpath(
-                "//a[contains(@href, 'CityPairs') and contains(@href, 'Current') and contains(@href, 'xls')]").click()
-            time.sleep(240)  # Wait until file has finished downloading
-            # Identify latest downloaded excel file name, and rename to "Australia_international.xlsx"
-            xlsx_name = max([tmp_dir + "/" + f for f in os.listdir(tmp_dir)], key=os.path.getctime)
-            os.rename(os.path.join(tmp_dir, xlsx_name), os.path.join(tmp_dir, end_name))
-            log.info("%s downloaded", end_name)
+        # Reach the website with a browser of the pool
+        with browser_session(tmp_dir) as driver:
+            driver.get(international_url)
 
-            driver.close()
+            # Download the international file for city pairs up to current date
+            try:
+                driver.find_element_by_xpath("//a[contains(@href, 'CityPairs') and contains(@href, 'Current')]")
+            except:
+                log.info("International file not found")
+                pass
+            else:
+                # Click on the right excel file's link
+                before = list_files(tmp_dir)
+                driver.find_element_by_xpath("//a[contains(@href, 'CityPairs') and contains(@href, 'Current')"
+                                             " and contains(@href, 'xls')]").click()
+                # Wait until file has finished downloading, and rename it to "Australia_international.xlsx"
+                xlsx_name = wait_for_download(tmp_dir, before)
+                os.rename(xlsx_name, os.path.join(tmp_dir, end_name))
+                log.info("%s downloaded", end_name)
 
 
 def get_domestic_file():
@@ -98,38 +93,30 @@ def get_domestic_file():
     end_name = "Australia_domestic.xlsx"
     # Only download the file once
     if end_name not in os.listdir(tmp_dir):
-        # Set chrome options and reach the website
-        options = webdriver.ChromeOptions()
-        options.add_experimental_option("prefs", {
-            "download.default_directory": tmp_dir,
-            "download.prompt_for_download": False,
-        })
-        driver = webdriver.Chrome(chrome_options=options)
-        driver.implicitly_wait(10)
-        driver.get(domestic_url)
-
-        # Download the domestic file for city pairs up to current date
-        try:
-            driver.find_elements_by_xpath("//a[contains(@href, 'TopRoutes') and contains(@href, 'zip')]")
-        except:
-            log.info("Domestic file not found")
-            driver.close()
-            pass
-        else:
-            # Click on the right excel file's link
-            driver.find_elements_by_xpath("//a[contains(@href, 'TopRoutes') and contains(@href, 'zip')]")[0].click()
-            time.sleep(120)  # Wait until file has finished downloading
-            # Identify latest downloaded zip file name, extract and rename new file to "Australia_domestic.xlsx"
-            zip_name = max([tmp_dir + "/" + f for f in os.listdir(tmp_dir)], key=os.path.getctime)
-            zip_ref = zipfile.ZipFile(zip_name, 'r')
-            zip_ref.extractall(tmp_dir)
-            zip_ref.close()
-            os.remove(zip_name)
-            xlsx_name = max([tmp_dir + "/" + f for f in os.listdir(tmp_dir)], key=os.path.getctime)
-            os.rename(os.path.join(tmp_dir, xlsx_name), os.path.join(tmp_dir, end_name))
-            log.info("%s downloaded", end_name)
-
-            driver.close()
+        # Reach the website with a browser of the pool
+        with browser_session(tmp_dir) as driver:
+            driver.get(domestic_url)
+
+            # Download the domestic file for city pairs up to current date
+            try:
+                driver.find_elements_by_xpath("//a[contains(@href, 'TopRoutes') and contains(@href, 'zip')]")
+            except:
+                log.info("Domestic file not found")
+                pass
+            else:
+                # Click on the right excel file's link
+                before = list_files(tmp_dir)
+                driver.find_elements_by_xpath("//a[contains(@href, 'TopRoutes') and contains(@href, 'zip')]")[0].click()
+                # Wait until file has finished downloading, extract and rename the excel file
+                # to "Australia_domestic.xlsx"
+                zip_name = wait_for_download(tmp_dir, before)
+                zip_ref = zipfile.ZipFile(zip_name, 'r')
+                xlsx_name = [f for f in zip_ref.namelist() if f.lower().endswith(('.xls', '.xlsx'))][0]
+                zip_ref.extract(xlsx_name, tmp_dir)
+                zip_ref.close()
+                os.remove(zip_name)
+                os.rename(os.path.join(tmp_dir, xlsx_name), os.path.join(tmp_dir, end_name))
+                log.info("%s downloaded", end_name)
 
 
 def download_files(year_months):
@@ -156,42 +143,23 @@ def find_airports_by_name(name, perimeter):
     """
     This function looks up the name of an airport or city in the Excel file based on the Australia-specific
     field of "provider_query", or on "query_names".
+    The names are looked up in the index of the airports' names, loaded once (see airport_names).
     Failures of this function are reported at the end of the algorithm to enrich (manually) the "provider_query" with
     the help of submit_query_providers() function.
     :param name: an upper case string
     :param perimeter: string (indication of international or mexican-only airports)
     :return: airport code (or None)
     """
-    if perimeter == "australian":
-        city_clean = name.lower().replace('.', '').split('-')[0].split('/')[0].split(',')[0].strip()
-        airports = pd.DataFrame.from_records(
-            list(Airport.find({'query_names': city_clean, 'code_type': {'$in': ['city','airport']}, 'country': 'AU'},
-                              {'_id': 0, 'code': 1, 'name': 1, 'city': 1})))
-        if airports.empty:
-            airports = pd.DataFrame.from_records(
-                list(Airport.find({provider_tag: name.strip(), 'code_type': {'$in': ['city','airport']}, 'country': 'AU'},
-                                  {'_id': 0, 'code': 1, 'name': 1, 'city': 1})))
-    else:
-        city_clean = name.lower().replace('.', '').split('-')[0].split('/')[0].split(',')[0].strip()
-        airports = pd.DataFrame.from_records(
-            list(Airport.find({'query_names': city_clean, 'code_type': {'$in': ['city','airport']}},
-                              {'_id': 0, 'code': 1, 'name': 1, 'city': 1})))
-        if airports.empty:
-            airports = pd.DataFrame.from_records(
-                list(Airport.find({provider_tag: name.strip(), 'code_type': {'$in': ['city','airport']}},
-                                  {'_id': 0, 'code': 1, 'name': 1, 'city': 1})))
-    return set(airports['code']) if not airports.empty else None
+    country = 'AU' if perimeter == "australian" else None
+    return get_airport_names(provider).find(name, country)
 
 
 def get_airports_codes():
     """
-    Get a dictionary of all airport codes for reference throughout import algorithm
-    :return:
+    Get a dictionary of all airports keyed by code, taken from the codes index shared by the import programs
+    :return: dict
     """
-    airports_codes = Airport.find({'code': {"$ne": None}},
-                                  {'code': 1, 'iata_code': 1, 'icao_code': 1, 'country': 1, 'state': 1,
-                                   'city': 1, 'name': 1, '_id': 0})
-    return dict((i.code, i) for i in airports_codes if i.code)
+    return get_codes_index().by_code
 
 
 def submit_query_providers():
@@ -302,7 +270,8 @@ def get_data(xlsx_files, year_months):
         log.info('  store external_segment: %r', self.nresult)
 
     for xlsx_f in xlsx_files:  # loop through each file
-        previous_data = pd.DataFrame(columns=['origin', 'destination', 'year_month', 'passengers'])
+        # Sum the domestic passengers of the lines with the same tuple, so each one is sent to the bulk only once
+        accumulator = SegmentAccumulator()
         row_nb = 0
         if "domestic" in xlsx_f:
             perimeter = "domestic"
@@ -337,18 +306,6 @@ def get_data(xlsx_files, year_months):
                     if not check_airport(airport_destination, passengers, perimeter):
                         continue
 
-                    if ((previous_data['origin'] == airport_origin) &
-                            (previous_data['destination'] == airport_destination)
-                            & (previous_data['year_month'] == year_month)).any():
-                        new_row = False
-                        # Add to Excel file's total_pax the "passenger" integer you get from filtering
-                        # previous_data on other columns
-                        passengers += int(previous_data['passengers'][
-                                              (previous_data['origin'] == airport_origin) &
-                                              (previous_data['destination'] == airport_destination) &
-                                              (previous_data['year_month'] == year_month)])
-                    else:
-                        new_row = True
                     dic = dict(provider=full_provider,
                                data_type='airport',
                                airline=['*'],
@@ -361,19 +318,7 @@ def get_data(xlsx_files, year_months):
                                raw_rec=dict(row), both_ways=False,
                                from_line=row_index, from_filename=xlsx_f, url=domestic_url)
 
-                    new_data = pd.Series({'origin': airport_origin, 'destination': airport_destination,
-                                          'year_month': year_month, 'passengers': passengers}).to_frame()
-                    if new_row:
-                        previous_data = previous_data.append(new_data.T, ignore_index=True)
-                    else:
-                        previous_data['passengers'][
-                            (previous_data['origin'] == airport_origin) &
-                            (previous_data['destination'] == airport_destination) &
-                            (previous_data['year_month'] == year_month)] = passengers  # Modify previous_data's pax
-
-                    query = dict((k, dic[k]) for k in ('origin', 'destination', 'year_month', 'provider',
-                                                       'data_type', 'airline'))
-                    bulk.find(query).upsert().update_one({'$set': dic, '$setOnInsert': dict(inserted=now)})
+                    accumulator.add((airport_origin, airport_destination, year_month), passengers, dic)
                     if row_nb % 1000 == 0:
                         print('{0:.3g}'.format(float(row_nb) / float(all_rows) * 100) + '%')
 
@@ -421,7 +366,8 @@ def get_data(xlsx_files, year_months):
                                raw_rec=dict(row), both_ways=False,
                                from_line=row_index, from_filename=xlsx_f, url=domestic_url)
                         query = dict((k, dic_in[k]) for k in ('origin', 'destination', 'year_month', 'provider', 'data_type'))
-                        bulk.find(query).upsert().update_one({'$set': dic_in, '$setOnInsert': dict(inserted=now)})
+                        bulk.find(query).upsert().update_one({'$set': dict(dic_in, modified=now),
+                                                              '$setOnInsert': dict(inserted=now)})
 
                     if way_out:
                         dic_out = dict(provider=full_provider,
@@ -435,7 +381,10 @@ def get_data(xlsx_files, year_months):
                                   raw_rec=dict(row), both_ways=False,
                                   from_line=row_index, from_filename=xlsx_f, url=domestic_url)
                         query = dict((k, dic_out[k]) for k in ('origin', 'destination', 'year_month', 'provider', 'data_type'))
-                        bulk.find(query).upsert().update_one({'$set': dic_out, '$setOnInsert': dict(inserted=now)})
+                        bulk.find(query).upsert().update_one({'$set': dict(dic_out, modified=now),
+                                                              '$setOnInsert': dict(inserted=now)})
+
+            accumulator.upsert(bulk, now)
         log.info('stored: %r', bulk.nresult)
 
 
@@ -448,6 +397,8 @@ def print_full(x):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Load data from Brazil')
     parser.add_argument('year_months', type=str, nargs='+', help='Year_month(s) to download ([YYYY-MM, YYYY-MM...]')
+    parser.add_argument('--fuzzy_names', dest='fuzzy_names', action='store_true',
+                        help='If present, match the unknown airport names to the closest known names')
 
     p = parser.parse_args()
 
@@ -465,6 +416,7 @@ if __name__ == '__main__':
     start_time = time.time()
 
     Model.init_db(def_w=True)
+    get_airport_names(provider, fuzzy=p.fuzzy_names)
 
     year_months = p.year_months[0].split(', ')
     # submit_query_providers()   # update "provider_query" tags with previously unidentified airports
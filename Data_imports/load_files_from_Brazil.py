@@ -27,6 +27,9 @@ from utils.logging_utils import BackupFileHandler
 import csv
 import pandas as pd
 import determine_airline_ref_code as ref_code
+from segment_accumulator import SegmentAccumulator
+from anomaly_report import AnomalyCollector
+from codes_index import get_codes_index
 
 provider = 'Brazil'
 __version__ = 'V1.0.0'
@@ -46,13 +49,10 @@ class External_Segment_Tmp(Model):
 
 def get_airports_codes():
     """
-    Get a dictionary of all airport codes for reference throughout import algorithm
-    :return:
+    Get a dictionary of all airports keyed by icao_code, taken from the codes index shared by the import programs
+    :return: dict
     """
-    airports_codes = Airport.find({'icao_code': {"$ne": None}},
-                                  {'code': 1, 'iata_code': 1, 'icao_code': 1, 'country': 1,
-                                   'city': 1, 'name': 1, '_id': 0})
-    return dict((i.icao_code, i) for i in airports_codes if i.icao_code)
+    return get_codes_index().by_icao
 
 
 def get_airport_by_icao(airport_icao_code, airport_name, pax):
@@ -63,16 +63,10 @@ def get_airport_by_icao(airport_icao_code, airport_name, pax):
     :param airport_name: a string name
     :return: the same airport's iata_code
     """
-    global unknown_icao_codes
     p = AIRPORTS_CODES.get(airport_icao_code)
     if p is None:
-        # If airport was already identified, add the current passengers to the registered ones in the dataframe
-        if airport_icao_code in unknown_icao_codes['code'].values:
-            unknown_icao_codes.loc[unknown_icao_codes['code'] == airport_icao_code, 'passengers'] += pax
-        # If airport is identified for the first time, save it in the dataframe
-        else:
-            info = pd.Series({'code': airport_icao_code, 'name': airport_name, 'passengers': pax})
-            unknown_icao_codes = unknown_icao_codes.append(info, ignore_index=True)
+        # Add the current passengers to the ones already registered for this airport
+        unknown_icao_codes.add(airport_icao_code, pax, 'missing', {'name': airport_name})
         return None
     return p['iata_code']
 
@@ -95,16 +89,10 @@ def get_airline_by_icao(airline_icao, airline_name, pax):
     :param airline_name: a string name
     :return: the same airline's iata_code
     """
-    global unknown_airline_codes
     t = AIRLINES_BY_ICAO.get(airline_icao)
     if t is None:
-        # If airline was already identified, add the current passengers to the registered ones in the dataframe
-        if airline_icao in unknown_airline_codes['code'].values:
-            unknown_airline_codes.loc[unknown_airline_codes['code'] == airline_icao, 'passengers'] += pax
-        # If airport is identified for the first time, save it in the dataframe
-        else:
-            info = pd.Series({'code': airline_icao, 'name': airline_name, 'passengers': pax})
-            unknown_airline_codes = unknown_airline_codes.append(info, ignore_index=True)
+        # Add the current passengers to the ones already registered for this airline
+        unknown_airline_codes.add(airline_icao, pax, 'missing', {'name': airline_name})
         return None
     return t['iata_code']
 
@@ -184,7 +172,8 @@ def get_data(csv_files, year_months):
                 dict_reader = csv.DictReader(csv_file)
                 all_rows = len(list(csv.DictReader(open('%s/%s' % (tmp_dir, csv_f)))))
                 row_nb = 0
-                previous_data = pd.DataFrame(columns=['origin', 'destination', 'year_month', 'airline', 'ref_code', 'passengers'])
+                accumulator = SegmentAccumulator()
+                checked_year_months = set()
 
                 with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
 
@@ -226,7 +215,8 @@ def get_data(csv_files, year_months):
                         if year_month not in year_months:
                             continue
 
-                        if year_month not in previous_data['year_month'].values:
+                        if year_month not in checked_year_months:
+                            checked_year_months.add(year_month)
                             if External_Segment_Tmp.find_one({'year_month': year_month, 'provider': provider}):
                                 log.warning("This year_month (%s) already exists for provider %s", year_month, provider)
 
@@ -234,23 +224,6 @@ def get_data(csv_files, year_months):
                                                                          airport_destination,
                                                                          YearMonth(year_month))
 
-                        if ((previous_data['origin'] == airport_origin) &
-                                (previous_data['destination'] == airport_destination)
-                                & (previous_data['year_month'] == year_month)
-                                & (previous_data['airline'] == row_airline)
-                                & (previous_data['ref_code'] == airline_ref_code)).any():
-                            new_row = False
-                            # Add to Excel file's total_pax the number of passengers you get from
-                            # filtering previous_data on other columns
-                            total_pax += int(previous_data['passengers'][
-                                (previous_data['origin'] == airport_origin) &
-                                (previous_data['destination'] == airport_destination)
-                                & (previous_data['year_month'] == year_month)
-                                & (previous_data['airline'] == row_airline)
-                                & (previous_data['ref_code'] == airline_ref_code)])
-                        else:
-                            new_row = True
-
                         dic = dict(provider=provider,
                                    data_type='airport',
                                    airline=[row_airline],
@@ -266,24 +239,13 @@ def get_data(csv_files, year_months):
                                    from_filename=csv_f,
                                    url=full_url)
 
-                        new_data = pd.Series({'origin': airport_origin, 'destination': airport_destination,
-                                              'year_month': year_month, 'airline': row_airline,
-                                              'ref_code': airline_ref_code, 'passengers': total_pax}).to_frame()
-                        if new_row:
-                            previous_data = previous_data.append(new_data.T, ignore_index=True)
-                        else:
-                            previous_data['passengers'][
-                                (previous_data['origin'] == airport_origin) &
-                                (previous_data['destination'] == airport_destination) &
-                                (previous_data['airline'] == row_airline) &
-                                (previous_data['ref_code'] == airline_ref_code) &
-                                (previous_data['year_month'] == year_month)] = total_pax  # Modify previous_data's pax
-
-                        query = dict((k, dic[k]) for k in ('origin', 'destination', 'year_month', 'provider',
-                                                           'data_type', 'airline'))
-                        bulk.find(query).upsert().update_one({'$set': dic, '$setOnInsert': dict(inserted=now)})
+                        # Add the passengers to the ones of previous lines with the same tuple
+                        accumulator.add((airport_origin, airport_destination, year_month, row_airline,
+                                         airline_ref_code), total_pax, dic)
                         if row_nb % 1000 == 0:
                             print('{0:.3g}'.format(float(row_nb) / float(all_rows) * 100) + '%')
+
+                    accumulator.upsert(bulk, now)
                 log.info('stored: %r', bulk.nresult)
 
 
@@ -323,17 +285,12 @@ if __name__ == '__main__':
 
     AIRPORTS_CODES = get_airports_codes()
     AIRLINES_BY_ICAO = get_airline_codes()
-    unknown_icao_codes = pd.DataFrame(columns=['code', 'name', 'passengers'])
-    unknown_airline_codes = pd.DataFrame(columns=['code', 'name', 'passengers'])
+    unknown_icao_codes = AnomalyCollector('unknown_icao_codes', provider, ['name'])
+    unknown_airline_codes = AnomalyCollector('unknown_airline_codes', provider, ['name'])
 
     get_data(xslx_files)
 
     log.info("\n\n--- %s seconds to populate db from ANAC-Brazil---", (time.time() - start_time))
-    if len(unknown_icao_codes.index) > 0:
-        unknown_icao_codes = unknown_icao_codes.sort_values('passengers', ascending=False)
-        print("\n\n", len(unknown_icao_codes.index), "unknown airports (check the reasons why): \n", print_full(unknown_icao_codes))
-    if len(unknown_airline_codes.index) > 0:
-        unknown_airline_codes = unknown_airline_codes.sort_values('passengers', ascending=False)
-        print("\n\n", len(unknown_airline_codes.index), "unknown airlines (check the reasons why): \n",
-              print_full(unknown_airline_codes))
+    unknown_icao_codes.log_report(log, 'unknown airports')
+    unknown_airline_codes.log_report(log, 'unknown airlines')
     log.info('End')
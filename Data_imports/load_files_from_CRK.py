@@ -20,7 +20,9 @@ import logging
 from optidb.model import *
 from utils import utcnow, YearMonth
 from utils.logging_utils import BackupFileHandler
+from anomaly_report import AnomalyCollector
 import determine_airline_ref_code as ref_code
+from codes_index import get_codes_index
 
 
 logging_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -36,8 +38,8 @@ main_log.addHandler(handler)
 log = logging.getLogger('load_CRK')
 log.info('Starting to get data from CRK')
 
-unknown_airports = pd.DataFrame(columns=['code', 'passengers'])
-unknown_airlines = pd.DataFrame(columns=['code', 'passengers'])
+unknown_airports = AnomalyCollector('unknown_airports', 'CRK')
+unknown_airlines = AnomalyCollector('unknown_airlines', 'CRK')
 
 
 class External_Segment_Tmp(Model):
@@ -46,12 +48,10 @@ class External_Segment_Tmp(Model):
 
 def get_airports_codes():
     """
-    Get a dictionary of all airport codes for reference throughout import algorithm
-    :return:
+    Get a dictionary of all airports keyed by code, taken from the codes index shared by the import programs
+    :return: dict
     """
-    airports_codes = Airport.find({'code': {"$ne": None}},
-                                  {'code': 1, 'iata_code': 1, 'name': 1, '_id': 0})
-    return dict((i.code, i) for i in airports_codes if i.code)
+    return get_codes_index().by_code
 
 
 def get_airlines_codes():
@@ -65,28 +65,18 @@ def get_airlines_codes():
 
 
 def check_airport(airport, pax, airports_codes):
-    global unknown_airports
     # Check the airport code exists in Mongo. If not, skip line
     if airport not in airports_codes:
-        if airport in unknown_airports['code'].values:
-            unknown_airports.loc[unknown_airports['code'] == airport, 'pax'] += pax
-        else:
-            info = pd.Series({'code': airport, 'pax': pax})
-            unknown_airports = unknown_airports.append(info, ignore_index=True)
+        unknown_airports.add(airport, pax, 'missing')
         return False
     else:
         return True
 
 
 def check_airline(airline, pax, airlines_codes):
-    global unknown_airlines
     # Check the airport code exists in Mongo. If not, skip line
     if airline not in airlines_codes:
-        if airline in unknown_airlines['code'].values:
-            unknown_airlines.loc[unknown_airlines['code'] == airline, 'pax'] += pax
-        else:
-            info = pd.Series({'code': airline, 'pax': pax})
-            unknown_airlines = unknown_airlines.append(info, ignore_index=True)
+        unknown_airlines.add(airline, pax, 'missing')
         return False
     else:
         return True
@@ -158,7 +148,8 @@ def get_data():
                            from_filename=xlsx_f)
                 query = dict((k, dic[k]) for k in ('origin', 'destination', 'year_month', 'provider',
                                                       'data_type', 'airline'))
-                bulk.find(query).upsert().update_one({'$set': dic, '$setOnInsert': dict(inserted=now)})
+                bulk.find(query).upsert().update_one({'$set': dict(dic, modified=now),
+                                                      '$setOnInsert': dict(inserted=now)})
 
                 if row_nb % 100 == 0:
                     print('{0:.3g}'.format(row_nb / all_rows * 100) + '%')
@@ -167,9 +158,5 @@ def get_data():
 if __name__ == '__main__':
     Model.init_db(def_w=True)
     get_data()
-    if len(unknown_airports) > 0:
-        log.warning('%d unrecognized airports:')
-        log.warning(unknown_airports)
-    if len(unknown_airlines) > 0:
-        log.warning('%d unrecognized airlines:')
-        log.warning(unknown_airlines)
+    unknown_airports.log_report(log, 'unrecognized airports')
+    unknown_airlines.log_report(log, 'unrecognized airlines')
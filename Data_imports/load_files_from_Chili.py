@@ -227,6 +227,7 @@ def store_block(block, filename):
             seg = dict(data_type='airport',
                        provider='Chili',
                        inserted=now,
+                       modified=now,
                        from_filename=filename,
                        from_line=line['row'],
                        airline=[line['al_iata_code']] or [line['al_icao_code']],
@@ -25,6 +25,9 @@ from optidb.model import *
 from utils import utcnow, YearMonth
 from utils.logging_utils import BackupFileHandler
 import determine_airline_ref_code as ref_code
+from segment_accumulator import SegmentAccumulator
+from anomaly_report import AnomalyCollector
+from codes_index import get_codes_index
 import pandas as pd
 import numpy as np
 import re
@@ -47,25 +50,16 @@ class External_Segment_Tmp(Model):
 
 def get_airports_codes():
     """
-    Get a dictionary of all airport codes for reference throughout import algorithm
-    :return:
+    Get a dictionary of all airports keyed by iata_code, taken from the codes index shared by the import programs
+    :return: dict
     """
-    airports_codes = Airport.find({'iata_code': {"$ne": None}},
-                                  {'code': 1, 'iata_code': 1, 'icao_code': 1, 'country': 1, 'city': 1,
-                                   'name': 1, '_id': 0})
-    return dict((i.iata_code, i) for i in airports_codes if i.iata_code)
+    return get_codes_index().by_iata
 
 
 def check_airport(airport, city, country, pax):
     # Check the airport code exists in Mongo. If not, skip line
-    global unknown_airports
     if airport not in airport_codes:
-        if airport in unknown_airports['code'].values:
-            unknown_airports.loc[unknown_airports['code'] == airport, 'passengers'] += pax
-        else:
-            info = pd.Series({'code': airport, 'city': city, 'file_country': country, 'Optimode_country':None,
-                              'info_type': 'missing', 'passengers': pax})
-            unknown_airports = unknown_airports.append(info, ignore_index=True)
+        unknown_airports.add(airport, pax, 'missing', {'city': city, 'file_country': country, 'Optimode_country': None})
         return False
 
     return True
@@ -89,15 +83,10 @@ def get_airline_by_icao(airline_icao, airline_name, pax):
     :param airline_name: a string name
     :return: the same airline's iata_code
     """
-    global unknown_airlines
     t = AIRLINES_BY_ICAO.get(airline_icao)
 
     if t is None:
-        if airline_icao in unknown_airlines['code'].values:
-            unknown_airlines.loc[unknown_airlines['code'] == airline_icao, 'passengers'] += pax
-        else:
-            info = pd.Series({'code': airline_icao, 'name': airline_name, 'passengers': pax})
-            unknown_airlines = unknown_airlines.append(info, ignore_index=True)
+        unknown_airlines.add(airline_icao, pax, 'missing', {'name': airline_name})
         return None
     return t['iata_code']
 
@@ -189,8 +178,8 @@ def get_data(xlsx_files):
         header = np.where(xls.loc[:, :] == "Pasajeros")[0] + 1  # Look for column names
         xls = pd.read_excel(tmp_dir + "/" + xlsx_f, header=header)  # Re-load file with headers
         xls = format_columns(xls)
-        # Create a dataframe to save data line after line, so we can check later on
-        previous_data = pd.DataFrame(columns=['origin', 'destination', 'year_month', 'airline', 'airline_ref_code', 'passengers'])
+        # Sum the passengers of the lines with the same tuple, so each one is sent to the bulk only once
+        accumulator = SegmentAccumulator()
 
         with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
             for row in range(0, len(xls)):    # loop through each row (origin, destination) in file
@@ -231,22 +220,6 @@ def get_data(xlsx_files):
                 # if External_Segment_Tmp.find_one({'year_month': year_month, 'provider': provider}):
                 #     log.warning("This year_month (%s) already exists for provider %s", year_month, provider)
 
-                if ((previous_data['origin'] == airport_origin) &
-                        (previous_data['destination'] == airport_destination)
-                        & (previous_data['year_month'] == year_month)
-                        & (previous_data['airline'] == row_airline)
-                        & (previous_data['airline_ref_code'] == airline_ref_code)).any():
-                    new_row = False
-                    # Add to Excel file's total_pax the "passenger" integer you get from filtering previous_data on other columns
-                    total_pax += int(previous_data['passengers'][
-                        (previous_data['origin'] == airport_origin) &
-                        (previous_data['destination'] == airport_destination)
-                        & (previous_data['year_month'] == year_month)
-                        & (previous_data['airline'] == row_airline)
-                        & (previous_data['airline_ref_code'] == airline_ref_code)])
-                else:
-                    new_row = True
-
                 dic = dict(provider=provider,
                            data_type='airport',
                            airline=[row_airline],
@@ -262,25 +235,12 @@ def get_data(xlsx_files):
                            from_filename=xlsx_f,
                            url=full_url)
 
-                new_data = pd.Series({'origin': airport_origin, 'destination': airport_destination,
-                                      'year_month': year_month, 'airline': row_airline,
-                                      'airline_ref_code': airline_ref_code, 'passengers': total_pax}).to_frame()
-                if new_row:
-                    previous_data = previous_data.append(new_data.T, ignore_index=True)
-                else:
-                    # Update the previous_data data frame with the new passengers count
-                    previous_data['passengers'][
-                        (previous_data['origin'] == airport_origin) &
-                        (previous_data['destination'] == airport_destination) &
-                        (previous_data['airline'] == row_airline) &
-                        (previous_data['airline_ref_code'] == airline_ref_code) &
-                        (previous_data['year_month'] == year_month)] = total_pax
-
-                query = dict((k, dic[k]) for k in ('origin', 'destination', 'year_month', 'provider',
-                                                   'data_type', 'airline'))
-                bulk.find(query).upsert().update_one({'$set': dic, '$setOnInsert': dict(inserted=now)})
+                accumulator.add((airport_origin, airport_destination, year_month, row_airline, airline_ref_code),
+                                total_pax, dic)
                 if row % 1000 == 0:
                     print('{0:.3g}'.format(float(row) / float(len(xls)) * 100) + '%')
+
+            accumulator.upsert(bulk, now)
         log.info('stored: %r', bulk.nresult)
 
 
@@ -317,8 +277,8 @@ if __name__ == '__main__':
 
     year_months = p.year_months[0].split(', ')
     year = list(set([ym[0:4] for ym in p.year_months]))
-    unknown_airports = pd.DataFrame(columns=['code', 'city', 'file_country', 'Optimode_country', 'info_type', 'passengers'])
-    unknown_airlines = pd.DataFrame(columns=['code', 'name', 'passengers'])
+    unknown_airports = AnomalyCollector('unknown_airports', provider, ['city', 'file_country', 'Optimode_country'])
+    unknown_airlines = AnomalyCollector('unknown_airlines', provider, ['name'])
     AIRLINES_BY_ICAO = get_airline_codes()
     airport_codes = get_airports_codes()
 
@@ -328,12 +288,6 @@ if __name__ == '__main__':
     get_data(xlsx_files, year_months)
 
     log.info("\n\n--- %s seconds to populate db from Aeronautica Civil de Colombia---", (time.time() - start_time))
-    if len(unknown_airports.index) > 0:
-        unknown_airports = unknown_airports.sort_values('passengers', ascending=False)
-        log.warning("%s wrong or unknown airports (check the reasons why): \n%s", len(unknown_airports.index),
-                    print_full(unknown_airports))
-    if len(unknown_airlines.index) > 0:
-        unknown_airlines = unknown_airlines.sort_values('passengers', ascending=False)
-        log.warning("%s wrong or unknown airlines (check the reasons why): \n%s", len(unknown_airlines.index),
-                    print_full(unknown_airlines))
+    unknown_airports.log_report(log, 'wrong or unknown airports')
+    unknown_airlines.log_report(log, 'wrong or unknown airlines')
     log.info("End")
\ No newline at end of file
@@ -25,6 +25,9 @@ import logging
 from optidb.model import *
 from utils import utcnow, YearMonth
 from utils.logging_utils import BackupFileHandler
+from anomaly_report import AnomalyCollector
+from codes_index import get_codes_index
+from cached_download import fetch_all
 
 
 provider = 'Eurostat'
@@ -56,13 +59,10 @@ class External_Segment_Tmp(Model):
 
 def get_airports_codes():
     """
-    Get a dictionary of all airport codes for reference throughout import algorithm
-    :return:
+    Get a dictionary of all airports keyed by icao_code, taken from the codes index shared by the import programs
+    :return: dict
     """
-    airports_codes = Airport.find({'icao_code': {"$ne": None}},
-                                  {'code': 1, 'iata_code': 1, 'icao_code': 1, 'country': 1, 'state': 1,
-                                   'city': 1, 'name': 1, '_id': 0})
-    return dict((i.icao_code, i) for i in airports_codes if i.icao_code)
+    return get_codes_index().by_icao
 
 
 def get_airport_by_icao(airport_icao_code):
@@ -71,58 +71,43 @@ def get_airport_by_icao(airport_icao_code):
     :param airport_icao_code: code
     :return: iata_code
     """
-    for e in airports_codes:
-        if airports_codes.get(e).get('icao_code') == airport_icao_code:
-            return airports_codes.get(e).get('iata_code')
+    return get_codes_index().icao_to_iata(airport_icao_code)
 
 
-def check_airport(airport, country, pax):
+def check_airport_columns(segments, side):
     """
-    Multiple checks for each airports:
+    Multiple checks for all the origins (side='origin') or destinations (side='destination') of a file at once:
     - that the airport code exists in database
     - that it is located in the same country as the Eurostat's file
-    Each failed test is recorded in a dataframe, along with the number of passengers concerned (for information on the
-    importance of the airport).
-    :param airport: icao_code
-    :param country: string (ISO2 country code)
-    :param pax: integer
-    :return:
+    Each failed test is recorded in wrong_airports, along with the number of passengers concerned (for information on
+    the importance of the airport).
+    :param segments: DataFrame returned by get_segments
+    :param side: 'origin' or 'destination'
+    :return: boolean Series, True for the rows whose airport exists in database
     """
-    global wrong_airports
-    global airports_codes
-    # Check the airport code exists in Mongo. If not, skip line
-    if airport not in airports_codes:
-        if airport in wrong_airports['code'].values:
-            wrong_airports.loc[wrong_airports['code'] == airport, 'passengers'] += pax
-        else:
-            info = pd.Series({'code': airport, 'Eurostat_country': country,
-                              'Optimode_country': None,
-                              'info_type': 'missing', 'passengers': pax})
-            wrong_airports = wrong_airports.append(info, ignore_index=True)
-        return False
-
-    # Check that airports are in the same country as in the database (only if we have the country in our database)
+    code = segments[side + '_icao']
+    country = segments[side + '_country']
+    known = code.isin(airports_codes.keys())
+    # French overseas territories are stored under their own code, so transpose them to FR
+    db_country = code.map(dict((c, a.get('country')) for c, a in airports_codes.items()))
+    db_country = db_country.replace(dict((c, 'FR') for c in ['RE', 'MQ', 'GP', 'GF', 'BL', 'YT', 'MF']))
     # Wikipedia: The European Commission generally uses ISO 3166-1 alpha-2 codes with two exceptions:
     # EL (not GR) is used to represent Greece, and UK (not GB) is used to represent the United Kingdom.
-    if airports_codes.get(airport).get('country'):
-        if country == 'EL':
-            country = 'GR'
-        if country == 'UK':
-            country = 'GB'
-        # French overseas territories are stored under their own code, so transpose them to FR
-        if airports_codes.get(airport).get('country') in ['RE', 'MQ', 'GP', 'GF', 'BL', 'YT', 'MF']:
-            airports_codes[airport]['country'] = 'FR'
-        if not country == airports_codes.get(airport).get('country'):
-            if airport in wrong_airports['code'].values:
-                wrong_airports.loc[wrong_airports['code'] == airport, 'passengers'] += pax
-            else:
-                info = pd.Series({'code': airport, 'Eurostat_country': country,
-                                  'Optimode_country': airports_codes.get(airport).get('country'),
-                                  'info_type': 'country', 'passengers': pax})
-                wrong_airports = wrong_airports.append(info, ignore_index=True)
-        return True
-    else:
-        return True
+    iso_country = country.replace({'EL': 'GR', 'UK': 'GB'})
+
+    # Check that airports are in the same country as in the database (only if we have the country in our database)
+    wrong_country = known & db_country.notnull() & (db_country != iso_country)
+    anomalies = pd.concat([
+        pd.DataFrame({'code': code, 'Eurostat_country': country, 'Optimode_country': None,
+                      'info_type': 'missing'})[~known],
+        pd.DataFrame({'code': code, 'Eurostat_country': iso_country, 'Optimode_country': db_country,
+                      'info_type': 'country'})[wrong_country]])
+    if len(anomalies.index) > 0:
+        anomalies['passengers'] = segments['total_pax']
+        anomalies = anomalies.sort_index(kind='mergesort').groupby(['code', 'info_type'], sort=False).agg(
+            {'Eurostat_country': 'first', 'Optimode_country': 'first', 'passengers': 'sum'}).reset_index()
+        wrong_airports.add_frame(anomalies)
+    return known
 
 
 def print_full(x):
@@ -131,9 +116,73 @@ def print_full(x):
     pd.reset_option('display.max_rows')
 
 
-def populate_db(year_months):
+def read_country_file(path):
+    """
+    Load a country file, keeping the description and the monthly columns only
+    :param path: path of the downloaded avia_par_XX.tsv.gz file
+    :return: DataFrame
+    """
+    dict_reader = pd.read_csv(path, compression='gzip', sep='\t')
+    # First column's name is not easy to use with its specific format
+    dict_reader.rename(index=str, columns={u'unit,tra_meas,airp_pr\\time': 'description'}, inplace=True)
+    # Replace ': ' values with missing values
+    dict_reader = dict_reader.replace(': ', np.NaN)
+    # Remove columns that do not concern months (years or quarters)
+    cols_to_keep = ['description']
+    cols_to_keep.extend([x for x in dict_reader.columns if 'M' in x])
+    return dict_reader[cols_to_keep]
+
+
+def get_segments(dict_reader, year_months):
+    """
+    Turn a country file (one row per airport pair and way, one column per month) into one row per airport pair and
+    requested month. The description is split once for the whole file, and the airports are swapped for arrivals.
+    :param dict_reader: DataFrame returned by read_country_file
+    :param year_months: list of year_months (YYYY-MM)
+    :return: DataFrame with 'from_line', 'year_month', 'total_pax', 'origin_icao', 'origin_country',
+    'destination_icao', 'destination_country' columns (None if there is nothing to import)
+    """
+    # only keep rows with pax information
+    lines = dict_reader[dict_reader['description'].str.contains('PAS_BRD_DEP|PAS_BRD_ARR')]
+    # Month columns are named like '2017M03 ': restrict to the requested year_month(s)
+    month_columns = dict()
+    for key in lines.columns[1:]:
+        ym = str(key).strip().split('M')[0] + '-' + str(key).strip().split('M')[1]
+        if ym in year_months:
+            month_columns[key] = ym
+    if len(lines.index) == 0 or len(month_columns) == 0:
+        return None
+
+    # description is like 'PAS,PAS_BRD_DEP,BE_EBBR_ES_LEMD'
+    airports = lines['description'].str.split(',').str[2]
+    # way: 'ARR' or 'DEP', meaning the airports will have to be swapped depending on the case
+    dep = (lines['description'].str.split(',').str[1].str[-3:] == 'DEP').values
+    icao_1, country_1 = airports.str[3:7].values, airports.str[0:2].values
+    icao_2, country_2 = airports.str[-4:].values, airports.str[8:10].values
+    lines = pd.DataFrame({'origin_icao': np.where(dep, icao_1, icao_2),
+                          'origin_country': np.where(dep, country_1, country_2),
+                          'destination_icao': np.where(dep, icao_2, icao_1),
+                          'destination_country': np.where(dep, country_2, country_1)},
+                         index=lines.index).join(lines[list(month_columns)])
+    lines.index.name = 'from_line'
+
+    segments = pd.melt(lines.reset_index(), id_vars=['from_line', 'origin_icao', 'origin_country',
+                                                     'destination_icao', 'destination_country'],
+                       value_vars=list(month_columns), var_name='month_column', value_name='total_pax')
+    segments = segments[segments['total_pax'].notnull()]
+    segments['total_pax'] = segments['total_pax'].astype(str).str.strip().astype(float).astype(int)
+    segments['year_month'] = segments['month_column'].map(month_columns)
+    return segments.drop('month_column', axis=1)
+
+
+def populate_db(year_months, mirror_dir=None, nb_workers=8):
     """
-    Populate the database with data extract in urls list
+    Populate the database with data extract in urls list.
+    Files are downloaded in parallel into tmp_dir (only if they changed since the last run), and each file is
+    processed as soon as it is available.
+    :param year_months: list of year_months (YYYY-MM)
+    :param mirror_dir: directory holding a copy of the avia_par_XX.tsv.gz files, used instead of Eurostat's website
+    :param nb_workers: number of parallel downloads
     :return:
     """
     def log_bulk(self):
@@ -141,98 +190,57 @@ def populate_db(year_months):
 
     now = utcnow()
 
-    # urls = ['http://ec.europa.eu/eurostat/estat-navtree-portlet-prod/BulkDownloadListing?file=data/avia_par_be.tsv.gz']
-    for url in urls:  # loop through each file
-            log.info('******************** processed file:  %s' % url.split(url_template)[1])
-            file_name = url.split('/')[-1][:-3]
-            provider_country = file_name.split('_')[2].split('.')[0]
-            full_provider = provider + "-" + provider_country
-            dict_reader = pd.read_csv(url, compression='gzip', sep='\t')
-            # First column's name is not easy to use with its specific format
-            dict_reader.rename(index=str, columns={u'unit,tra_meas,airp_pr\\time': 'description'}, inplace=True)
-            # Replace ': ' values with missing values
-            dict_reader = dict_reader.replace(': ', np.NaN)
-            # Remove columns that do not concern months (years or quarters)
-            cols_to_keep = ['description']
-            cols_to_keep.extend([x for x in dict_reader.columns if 'M' in x])
-            dict_reader = dict_reader[cols_to_keep]
-            # only keep rows with pax information
-            dict_reader = dict_reader[(dict_reader['description'].str.contains("PAS_BRD_DEP")) | \
-                                      (dict_reader['description'].str.contains("PAS_BRD_ARR"))]
-
-            with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
-                # loop through each row (origin, destination) in file
-                row_nb = 0
-                for row_index, row in dict_reader.iterrows():
-                    row_nb +=1
-                    if int(row_nb) % 1000 == 0:
-                        print('** {0:.3g}'.format(int(row_nb) / len(dict_reader) * 100) + '% **')
-                    # loop through each column (except the first one, which is the description) for passengers count
-                    for key in row.keys()[1:len(row)]:
-                        total_pax = row[key]
-                        if pd.isnull(total_pax):
-                            continue
-                        else:
-                            total_pax = int(total_pax)
-
-                        #convert key to year_month
-                        newkey = (str(key).strip().split('M')[0] + '-' + str(key).strip().split('M')[1])
-                        ym = newkey
-                        # Restrict to the requested year_month(s)
-                        if str(ym) not in year_months:
-                            continue
-                        row[newkey] = row.pop(key)
-
-                        # way: 'ARR' or 'DEP', meaning the airports will have to be swapped depending on the case
-                        way = row['description'].split(',')[1][-3:]
-                        icao_1 = row['description'].split(',')[2][3:7]
-                        country_1 = row['description'].split(',')[2][0:2]
-                        icao_2 = row['description'].split(',')[2][-4:]
-                        country_2 = row['description'].split(',')[2][8:10]
-
-                        if way == 'DEP':
-                            origin_icao = icao_1
-                            origin_country = country_1
-                            destination_icao = icao_2
-                            destination_country = country_2
-                        else:
-                            origin_icao = icao_2
-                            origin_country = country_2
-                            destination_icao = icao_1
-                            destination_country = country_1
-                        if check_airport(origin_icao, origin_country, total_pax):
-                            origin = get_airport_by_icao(origin_icao)
-                        else:
-                            continue
-                        if check_airport(destination_icao, destination_country, total_pax):
-                            destination = get_airport_by_icao(destination_icao)
-                        else:
-                            continue
-
-                        raw_rec = row.dropna()
-
-                        dic = dict(provider=full_provider,
-                                   data_type='airport',
-                                   origin=[origin],
-                                   destination=[destination],
-                                   airline=['*'],
-                                   airline_ref_code=['*'],
-                                   year_month=[ym],
-                                   total_pax=total_pax,
-                                   raw_rec=dict(raw_rec),
-                                   both_ways=False,
-                                   from_line=row_index,
-                                   from_filename=file_name,
-                                   url=url)
-                        query = dict((k, dic[k]) for k in ('origin', 'destination', 'year_month', 'provider',
-                                                           'data_type', 'airline'))
-                        bulk.find(query).upsert().update_one({'$set': dic, '$setOnInsert': dict(inserted=now)})
-            log.info('stored: %r', bulk.nresult)
+    failed_urls = []
+    for url, path, error in fetch_all(zip(urls, base_filename_list), tmp_dir, nb_workers, mirror_dir):
+        if error is not None:
+            failed_urls.append(url)
+            continue
+        log.info('******************** processed file:  %s' % url.split(url_template)[1])
+        file_name = url.split('/')[-1][:-3]
+        provider_country = file_name.split('_')[2].split('.')[0]
+        full_provider = provider + "-" + provider_country
+        dict_reader = read_country_file(path)
+        segments = get_segments(dict_reader, year_months)
+        if segments is None:
+            log.info('no data for %s', year_months)
+            continue
+        # Destinations are only checked for known origins
+        segments = segments[check_airport_columns(segments, 'origin')]
+        segments = segments[check_airport_columns(segments, 'destination')]
+        log.info('%d segments to store', len(segments.index))
+
+        raw_recs = dict_reader.loc[segments['from_line'].unique()].to_dict('index')
+        with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
+            for rec in segments.to_dict('records'):
+                raw_rec = dict((k, v) for k, v in raw_recs[rec['from_line']].items() if not pd.isnull(v))
+                dic = dict(provider=full_provider,
+                           data_type='airport',
+                           origin=[get_airport_by_icao(rec['origin_icao'])],
+                           destination=[get_airport_by_icao(rec['destination_icao'])],
+                           airline=['*'],
+                           airline_ref_code=['*'],
+                           year_month=[rec['year_month']],
+                           total_pax=int(rec['total_pax']),
+                           raw_rec=raw_rec,
+                           both_ways=False,
+                           from_line=rec['from_line'],
+                           from_filename=file_name,
+                           url=url)
+                query = dict((k, dic[k]) for k in ('origin', 'destination', 'year_month', 'provider',
+                                                   'data_type', 'airline'))
+                bulk.find(query).upsert().update_one({'$set': dict(dic, modified=now),
+                                                      '$setOnInsert': dict(inserted=now)})
+        log.info('stored: %r', bulk.nresult)
+    if failed_urls:
+        log.error('%d files could not be downloaded: %s', len(failed_urls), failed_urls)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Load data from Eurostat')
     parser.add_argument('year_months', type=str, nargs='+', help='Year_month(s) to download ([YYYY-MM, YYYY-MM...]')
+    parser.add_argument('-m', '--mirror', dest='mirror_dir', default=None,
+                        help='Directory with a copy of the avia_par_XX.tsv.gz files, used instead of the website')
+    parser.add_argument('-w', '--workers', dest='nb_workers', type=int, default=8, help='Number of parallel downloads')
     p = parser.parse_args()
 
     logging_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -249,16 +257,13 @@ if __name__ == '__main__':
     log.info('Starting to get data from Eurostat - version %s - %r', __version__, p)
 
     start_time = time.time()
-    wrong_airports = pd.DataFrame(columns=['code', 'Eurostat_country', 'Optimode_country', 'passengers', 'info_type'])
+    wrong_airports = AnomalyCollector('wrong_airports', provider, ['Eurostat_country', 'Optimode_country'])
 
     Model.init_db(def_w=True)
     year_months = p.year_months[0].split(', ')
     airports_codes = get_airports_codes()
 
-    populate_db(year_months)
+    populate_db(year_months, p.mirror_dir, p.nb_workers)
 
     log.info("\n\n--- %s seconds to populate db with %d files---" % ((time.time() - start_time), len(urls)))
-    if len(wrong_airports.index) > 0:
-        wrong_airports = wrong_airports.sort_values('passengers', ascending=False)
-        log.warning("%s wrong or unknown airports (check the reasons why): \n%s", len(wrong_airports.index),
-                    print_full(wrong_airports))
+    wrong_airports.log_report(log, 'wrong or unknown airports')
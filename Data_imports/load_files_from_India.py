@@ -15,7 +15,6 @@ from __future__ import print_function
 import argparse
 import time
 import datetime
-from selenium import webdriver
 from selenium.common.exceptions import NoSuchElementException
 import locale
 import logging
@@ -26,6 +25,9 @@ sys.path.append('../')
 from optidb.model import *
 from utils import utcnow
 from utils.logging_utils import BackupFileHandler
+from download_watcher import list_files, wait_for_download, DownloadTimeout
+from browser_pool import browser_session
+from airport_names import get_airport_names
 import pandas as pd
 import numpy as np
 from unidecode import unidecode
@@ -33,8 +35,10 @@ import re
 
 locale.setlocale(locale.LC_TIME, "en_US.utf8") # Make sure the months are expressed in English
 provider = {'international': 'India-intl', 'domestic': 'India-domestic'}
-provider_tag = 'query_providers.%s' % provider
-__version__ = 'V1.0.1'
+# Key of the names of the airports used by the files of India (query_providers.<key>), for both perimeters
+query_provider = 'India'
+provider_tag = 'query_providers.%s' % query_provider
+__version__ = 'V1.0.2'
 unknown_airports = pd.DataFrame(columns=['city_name', 'passengers'])
 no_capa = list()
 tmp_dir = '/tmp/india'
@@ -56,41 +60,37 @@ def get_month_domestic_file(year, month):
     month_name = datetime.date(1900, month, 1).strftime('%B')
     end_name = "India_domestic_%s-%s.xlsx" % (month, year)
     if end_name not in os.listdir(tmp_dir):
-        # Set chrome options and reach the website
-        options = webdriver.ChromeOptions()
-        options.add_experimental_option("prefs", {
-            "download.default_directory": tmp_dir,
-            "download.prompt_for_download": False,
-        })
-        driver = webdriver.Chrome(chrome_options=options)
-        driver.implicitly_wait(10)
-        driver.get(base_url)
-
-        # Select the demanded year for domestic files
-        dom_link = 'href="month-stats/%s/DOM%20MONTHLY%20CITYPAIR%20DATA.htm"', year
-        driver.find_element_by_xpath(
-            '//a[@href="month-stats/%d/DOM%sMONTHLY%sCITYPAIR%sDATA.htm"]' % (year, "%20", "%20", "%20")).click()
-        # Depending on the year, either click on the link that has the month_name in its address, or
-        # Select the line in the table where the requested month is, and click on the second link (excel file)
-        try:
-            month_position = driver.find_element_by_xpath("//*[contains(text(), '%s')]" % month_name.upper())
-        except NoSuchElementException:
-            driver.find_element_by_xpath("//*[contains(text(), '%s')]/../following-sibling::td[2]" % month_name).click()
-            log.info("File for year_month %d-%d not available", (year, month))
-
-        # Click on the Excel file download link
-        try:
-            month_position.find_element_by_xpath("./a[2]").click()
-        except Exception:
-            pass
-
-        time.sleep(5) # Wait until file has finished downloading
-        # Identify latest downloaded excel file name, and rename to "India_domestic_month-year.xlsx"
-        xlsx_name = max([tmp_dir + "/" + f for f in os.listdir(tmp_dir)], key=os.path.getctime)
-        os.rename(os.path.join(tmp_dir, xlsx_name), os.path.join(tmp_dir, end_name))
-        log.info("%s downloaded", end_name)
-
-        driver.close()
+        # Reach the website with a browser of the pool
+        with browser_session(tmp_dir) as driver:
+            driver.get(base_url)
+
+            # Select the demanded year for domestic files
+            dom_link = 'href="month-stats/%s/DOM%20MONTHLY%20CITYPAIR%20DATA.htm"', year
+            driver.find_element_by_xpath(
+                '//a[@href="month-stats/%d/DOM%sMONTHLY%sCITYPAIR%sDATA.htm"]' % (year, "%20", "%20", "%20")).click()
+            # Depending on the year, either click on the link that has the month_name in its address, or
+            # Select the line in the table where the requested month is, and click on the second link (excel file)
+            try:
+                month_position = driver.find_element_by_xpath("//*[contains(text(), '%s')]" % month_name.upper())
+            except NoSuchElementException:
+                driver.find_element_by_xpath("//*[contains(text(), '%s')]/../following-sibling::td[2]" % month_name).click()
+                log.info("File for year_month %d-%d not available", (year, month))
+
+            # Click on the Excel file download link
+            before = list_files(tmp_dir)
+            try:
+                month_position.find_element_by_xpath("./a[2]").click()
+            except Exception:
+                pass
+
+            # Wait until file has finished downloading, and rename it to "India_domestic_month-year.xlsx"
+            try:
+                xlsx_name = wait_for_download(tmp_dir, before, timeout=300)
+            except DownloadTimeout:
+                log.warning("File for year_month %d-%d was not downloaded", year, month)
+            else:
+                os.rename(xlsx_name, os.path.join(tmp_dir, end_name))
+                log.info("%s downloaded", end_name)
 
 
 def get_quarter_international_file(year, month):
@@ -102,37 +102,32 @@ def get_quarter_international_file(year, month):
     # Only download the Quarter's file once
     if end_name not in os.listdir(tmp_dir):
 
-        # Set chrome options and reach the website
-        options = webdriver.ChromeOptions()
-        options.add_experimental_option("prefs", {
-            "download.default_directory": tmp_dir,
-            "download.prompt_for_download": False,
-        })
-        driver = webdriver.Chrome(chrome_options=options)
-        driver.implicitly_wait(10)
-        driver.get(base_url)
-
-        # Click on the international section link
-        driver.find_elements_by_xpath("//*[contains(text(), 'International Traffic')]")[0].click()
-
-        try:
-            driver.find_element_by_xpath("//a[contains(@href, '%s') and contains(@href, '%s')]" % (quarter_name, year))
-        except:
-            log.info("File for quarter %d of year %d not available", (quarter_name, year))
-            driver.close()
-            pass
-        else:
-            # Click on the right quarter's link
-            driver.find_element_by_xpath("//a[contains(@href, '%s') and contains(@href, '%s')]" % (quarter_name, year)).click()
-            # Download the city pairwise excel file (4.xlsx)
-            driver.find_element_by_xpath("//a[contains(@href, '4.xlsx')]").click()
-            time.sleep(5)  # Wait until file has finished downloading
-            # Identify latest downloaded excel file name, and rename to "India_international_quarter-year.xlsx"
-            xlsx_name = max([tmp_dir + "/" + f for f in os.listdir(tmp_dir)], key=os.path.getctime)
-            os.rename(os.path.join(tmp_dir, xlsx_name), os.path.join(tmp_dir, end_name))
-            log.info("%s downloaded", end_name)
-
-            driver.close()
+        # Reach the website with a browser of the pool
+        with browser_session(tmp_dir) as driver:
+            driver.get(base_url)
+
+            # Click on the international section link
+            driver.find_elements_by_xpath("//*[contains(text(), 'International Traffic')]")[0].click()
+
+            try:
+                driver.find_element_by_xpath("//a[contains(@href, '%s') and contains(@href, '%s')]" % (quarter_name, year))
+            except:
+                log.info("File for quarter %d of year %d not available", (quarter_name, year))
+                pass
+            else:
+                # Click on the right quarter's link
+                driver.find_element_by_xpath("//a[contains(@href, '%s') and contains(@href, '%s')]" % (quarter_name, year)).click()
+                # Download the city pairwise excel file (4.xlsx)
+                before = list_files(tmp_dir)
+                driver.find_element_by_xpath("//a[contains(@href, '4.xlsx')]").click()
+                # Wait until file has finished downloading, and rename it to "India_international_quarter-year.xlsx"
+                try:
+                    xlsx_name = wait_for_download(tmp_dir, before, timeout=300)
+                except DownloadTimeout:
+                    log.warning("File for quarter %s of year %d was not downloaded", quarter_name, year)
+                else:
+                    os.rename(xlsx_name, os.path.join(tmp_dir, end_name))
+                    log.info("%s downloaded", end_name)
 
 
 def download_month(year, month):
@@ -168,28 +163,15 @@ def find_airports_by_name(name, perimeter):
     """
     This function looks up the name of an airport or city in the Excel file based on the Mexico-specific
     field of "provider_query", or on "query_names".
+    The names are looked up in the index of the airports' names, loaded once (see airport_names).
     Failures of this function are reported at the end of the algorithm to enrich (manually) the "provider_query" with
     the help of submit_query_providers() function.
     :param name: an upper case string
     :param tab_name: name of the excel file's tab (indication of international or mexican-only airports)
     :return: airport code (or None)
     """
-    if perimeter == "domestic":
-        city_clean = name.lower().replace('.', '').split('-')[0].split('/')[0].split(',')[0].strip()
-        airports = pd.DataFrame.from_records(list(Airport.find({'query_names': city_clean, 'code_type': {'$in': ['city','airport']}, 'country': 'IN'},
-                                                  {'_id': 0, 'code': 1, 'name': 1, 'city': 1})))
-        if airports.empty:
-            airports = pd.DataFrame.from_records(list(Airport.find({provider_tag: name.strip(), 'code_type': {'$in': ['city','airport']}, 'country': 'IN'},
-                                                      {'_id': 0, 'code': 1, 'name': 1, 'city': 1})))
-    else:
-        city_clean = name.lower().replace('.', '').split('-')[0].split('/')[0].split(',')[0].strip()
-        airports = pd.DataFrame.from_records(list(Airport.find({'query_names': city_clean, 'code_type': {'$in': ['city','airport']}},
-                                                  {'_id': 0, 'code': 1, 'name': 1, 'city': 1})))
-        if airports.empty:
-            airports = pd.DataFrame.from_records(
-                list(Airport.find({provider_tag: name.strip(), 'code_type': {'$in': ['city','airport']}},
-                                  {'_id': 0, 'code': 1, 'name': 1, 'city': 1})))
-    return set(airports['code']) if not airports.empty else None
+    country = 'IN' if perimeter == "domestic" else None
+    return get_airport_names(query_provider).find(name, country)
 
 
 def update_unknown_airports(city, pax_to, pax_from):
@@ -334,7 +316,8 @@ def get_data(xlsx_files):
                               url=full_url)
                 query = dict((k, dic_to[k]) for k in ('origin', 'destination', 'year_month', 'provider',
                                                       'data_type', 'airline'))
-                bulk.find(query).upsert().update_one({'$set': dic_to, '$setOnInsert': dict(inserted=now)})
+                bulk.find(query).upsert().update_one({'$set': dict(dic_to, modified=now),
+                                                      '$setOnInsert': dict(inserted=now)})
 
                 # Then save data from city 2 to city 1
                 dic_from = dict(provider=provider_label,
@@ -353,7 +336,8 @@ def get_data(xlsx_files):
                                 url=full_url)
                 query = dict((k, dic_from[k]) for k in ('origin', 'destination', 'year_month', 'provider',
                                                         'data_type', 'airline'))
-                bulk.find(query).upsert().update_one({'$set': dic_from, '$setOnInsert': dict(inserted=now)})
+                bulk.find(query).upsert().update_one({'$set': dict(dic_from, modified=now),
+                                                      '$setOnInsert': dict(inserted=now)})
                 if row % 100 == 0:
                     print('{0:.3g}'.format(float(row) / float(all_rows) * 100) + '%')
         log.info('stored: %r', bulk.nresult)
@@ -362,6 +346,8 @@ def get_data(xlsx_files):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Load data from India')
     parser.add_argument('year_months', type=str, nargs='+', help='Year_month(s) to download ([YYYY-MM, YYYY-MM...]')
+    parser.add_argument('--fuzzy_names', dest='fuzzy_names', action='store_true',
+                        help='If present, match the unknown airport names to the closest known names')
 
     p = parser.parse_args()
 
@@ -382,6 +368,7 @@ if __name__ == '__main__':
 
     start_time = time.time()
     Model.init_db(def_w=True)
+    get_airport_names(query_provider, fuzzy=p.fuzzy_names)
     year = list(set([ym[0:4] for ym in p.year_months]))
     month = list(set([ym[5:7] for ym in p.year_months]))
     # submit_query_providers()   # update "provider_query" tags with previously unidentified airports
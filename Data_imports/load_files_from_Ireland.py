@@ -24,8 +24,10 @@
 # -------------------------------------------------------------------------------
 
 from __future__ import division, print_function
-from selenium import webdriver
 from selenium.webdriver.support.ui import Select
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.common.by import By
 import argparse
 import time
 import pandas as pd
@@ -40,6 +42,10 @@ from optidb.model import *
 import csv
 from utils import utcnow
 from utils.logging_utils import BackupFileHandler
+from anomaly_report import AnomalyCollector
+from download_watcher import list_files, wait_for_download
+from browser_pool import browser_session
+from codes_index import get_codes_index
 
 optidb.optimode.USE_NEW_AGGREGATE = True
 
@@ -49,7 +55,7 @@ provider = 'Ireland'
 provider_tag = 'query_providers.%s' % provider
 tmp_dir = '/tmp/Ireland'
 url = 'http://www.cso.ie/px/pxeirestat/statire/SelectVarVal/Define.asp?Maintable=CTM01&PLanguage=0'
-unknown_airports = pd.DataFrame(columns=['code', 'pax'])
+unknown_airports = AnomalyCollector('unknown_airports', provider)
 
 if not os.path.isdir(tmp_dir):
      os.mkdir(tmp_dir)
@@ -102,72 +108,58 @@ def download_file(year_months):
         # Transform 'YYYY-MM' to 'YYYY"M"MM'
         year_months_IRE = [ym.replace('-', 'M') for ym in year_months]
 
-        # Set chrome options and reach the website
-        options = webdriver.ChromeOptions()
-        options.add_experimental_option("prefs", {
-            "download.default_directory": tmp_dir,
-            "download.prompt_for_download": False,
-        })
-        driver = webdriver.Chrome(chrome_options=options)
-        driver.implicitly_wait(10)
-        driver.get(url)
-        assert "Passenger" in driver.title
-
-        # Select the way in and way out
-        select_ways = Select(driver.find_element_by_name('var1'))
-        for label in ['Inward', 'Outward']:
-            select_ways.select_by_visible_text(label)
-        # Select all the foreign airports
-        Select(driver.find_element_by_name('grouping2')).select_by_visible_text('Select all')
-        # Select all the irish airports
-        Select(driver.find_element_by_name('grouping3')).select_by_visible_text('Select all')
-        # Deselect the default year_month, then select the requested year_months
-        Select(driver.find_element_by_name('grouping4')).select_by_visible_text('Deselect all')
-        select_year_months = Select(driver.find_element_by_name('var4'))
-        for ym in year_months_IRE:
-            select_year_months.select_by_value(ym)
-        # Go to next page
-        driver.find_element_by_name('Forward').click()
-        log.info('Waiting for download page to load...')
-        time.sleep(120)
-
-        # Edit the options to get the table with only codes instead of a mix of text with codes inside
-        Select(driver.find_element_by_name('pivot')).select_by_visible_text('Show only codes')
-        time.sleep(30)
-        # Download file
-        driver.find_element_by_name('run').click()
-
-        # Wait for file to be downloaded
-        log.info('Waiting for file to be downloaded')
-        time.sleep(30)
-        driver.close()
-
-        # Identify the downloaded csv file name, and rename to "Ireland_Segments-year.csv"
-        csv_name = max([tmp_dir + "/" + f for f in os.listdir(tmp_dir)], key=os.path.getctime)
-        os.rename(os.path.join(tmp_dir, csv_name), os.path.join(tmp_dir, end_name))
+        # Reach the website with a browser of the pool
+        with browser_session(tmp_dir) as driver:
+            driver.get(url)
+            assert "Passenger" in driver.title
+
+            # Select the way in and way out
+            select_ways = Select(driver.find_element_by_name('var1'))
+            for label in ['Inward', 'Outward']:
+                select_ways.select_by_visible_text(label)
+            # Select all the foreign airports
+            Select(driver.find_element_by_name('grouping2')).select_by_visible_text('Select all')
+            # Select all the irish airports
+            Select(driver.find_element_by_name('grouping3')).select_by_visible_text('Select all')
+            # Deselect the default year_month, then select the requested year_months
+            Select(driver.find_element_by_name('grouping4')).select_by_visible_text('Deselect all')
+            select_year_months = Select(driver.find_element_by_name('var4'))
+            for ym in year_months_IRE:
+                select_year_months.select_by_value(ym)
+            # Go to next page
+            driver.find_element_by_name('Forward').click()
+            log.info('Waiting for download page to load...')
+            WebDriverWait(driver, 300).until(expected_conditions.presence_of_element_located((By.NAME, 'pivot')))
+
+            # Edit the options to get the table with only codes instead of a mix of text with codes inside
+            Select(driver.find_element_by_name('pivot')).select_by_visible_text('Show only codes')
+            time.sleep(30)
+            # Download file
+            before = list_files(tmp_dir)
+            driver.find_element_by_name('run').click()
+
+            # Wait for file to be downloaded
+            log.info('Waiting for file to be downloaded')
+            csv_name = wait_for_download(tmp_dir, before)
+
+        # Rename the downloaded csv file to "Ireland_Segments.csv"
+        os.rename(csv_name, os.path.join(tmp_dir, end_name))
         log.info("%s downloaded", end_name)
     return end_name
 
 
 def get_airports_codes():
     """
-    Get a dictionary of all airport codes for reference throughout import algorithm
-    :return:
+    Get a dictionary of all airports keyed by code, taken from the codes index shared by the import programs
+    :return: dict
     """
-    airports_codes = Airport.find({'code': {"$ne": None}},
-                                  {'code': 1, 'iata_code': 1, 'name': 1, '_id': 0})
-    return dict((i.code, i) for i in airports_codes if i.code)
+    return get_codes_index().by_code
 
 
 def check_airport(airport, pax):
-    global unknown_airports
     # Check the airport code exists in Mongo. If not, skip line
     if airport not in airports_codes:
-        if airport in unknown_airports['code'].values:
-            unknown_airports.loc[unknown_airports['code'] == airport, 'pax'] += pax
-        else:
-            info = pd.Series({'code': airport, 'pax': pax})
-            unknown_airports = unknown_airports.append(info, ignore_index=True)
+        unknown_airports.add(airport, pax, 'missing')
         return False
     else:
         return True
@@ -243,7 +235,8 @@ def update_routes(csv_file, year_months):
                            from_line=row_index, from_filename=csv_file, url=url)
                 query = dict((k, dic[k]) for k in ('origin', 'destination', 'year_month', 'provider',
                                                    'data_type', 'airline'))
-                bulk.find(query).upsert().update_one({'$set': dic, '$setOnInsert': dict(inserted=now)})
+                bulk.find(query).upsert().update_one({'$set': dict(dic, modified=now),
+                                                      '$setOnInsert': dict(inserted=now)})
                 if row_index % 1000 == 0:
                     print('{0:.3g}'.format(row_index / len(xls.index) * 100) + '%')
     log.info('stored: %r', bulk.nresult)
@@ -277,7 +270,6 @@ if __name__ == '__main__':
 
     update_routes(csv_file, year_months)
 
-    if len(unknown_airports) > 0:
-        log.warning("%s unknown airports (check the reasons why): \n%s", len(unknown_airports.index), print_full(unknown_airports))
+    unknown_airports.log_report(log, 'unknown airports')
     log.info('End')
 
@@ -20,13 +20,17 @@ from unidecode import unidecode
 import logging
 import logging.handlers
 import os
-from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
 import sys
 sys.path.append('../')
 from optidb.model import *
 from utils import utcnow
 from utils.logging_utils import BackupFileHandler
+from segment_accumulator import SegmentAccumulator
+from download_watcher import list_files, wait_for_download
+from browser_pool import browser_session
+from capacity_cube import get_capacity_cube
+from airport_names import get_airport_names
 
 
 provider = 'Mexico'
@@ -67,34 +71,26 @@ def download_single_file(year):
     end_name = "Mexico-%s.xlsx" % year
     if end_name not in os.listdir(tmp_dir):
 
-        # Set chrome options and reach the website
-        options = webdriver.ChromeOptions()
-        options.add_experimental_option("prefs", {
-            "download.default_directory": tmp_dir,
-            "download.prompt_for_download": False,
-        })
-        driver = webdriver.Chrome(chrome_options=options)
-        driver.implicitly_wait(10)
-        driver.get(base_url + end_url)
-
-        # Select the demanded year and month
-        file_link = driver.find_element_by_xpath("//*[contains(text(), 'origen-destino')]")
-        if year in file_link.get_attribute('href'):
-            file_link.click()
-        else:
-            driver.find_element_by_xpath("//*[contains(text(), '1992')]").send_keys(Keys.CONTROL + Keys.SHIFT + Keys.ENTER)
-            driver.switch_to.window(driver.window_handles[1])
-            driver.find_element_by_xpath("//*[contains(text(), 'Monthly Traffic Statistics')]").click()
-            driver.find_element_by_xpath(
-                "//a[contains(text(), '%s') and contains(text(), 'destino')]" % year).click()
-
-        time.sleep(10)  # Wait until file has finished downloading
-        # Identify latest downloaded excel file name, and rename to "Mexico-year.xlsx"
-        xlsx_name = max([tmp_dir + "/" + f for f in os.listdir(tmp_dir)], key=os.path.getctime)
-        os.rename(os.path.join(tmp_dir, xlsx_name), os.path.join(tmp_dir, end_name))
-        log.info("%s downloaded", end_name)
-
-        driver.quit()
+        # Reach the website with a browser of the pool
+        with browser_session(tmp_dir) as driver:
+            driver.get(base_url + end_url)
+
+            # Select the demanded year and month
+            before = list_files(tmp_dir)
+            file_link = driver.find_element_by_xpath("//*[contains(text(), 'origen-destino')]")
+            if year in file_link.get_attribute('href'):
+                file_link.click()
+            else:
+                driver.find_element_by_xpath("//*[contains(text(), '1992')]").send_keys(Keys.CONTROL + Keys.SHIFT + Keys.ENTER)
+                driver.switch_to.window(driver.window_handles[1])
+                driver.find_element_by_xpath("//*[contains(text(), 'Monthly Traffic Statistics')]").click()
+                driver.find_element_by_xpath(
+                    "//a[contains(text(), '%s') and contains(text(), 'destino')]" % year).click()
+
+            # Wait until file has finished downloading, and rename it to "Mexico-year.xlsx"
+            xlsx_name = wait_for_download(tmp_dir, before)
+            os.rename(xlsx_name, os.path.join(tmp_dir, end_name))
+            log.info("%s downloaded", end_name)
     return end_name
 
 
@@ -110,27 +106,17 @@ def get_capa(year_month, origin, destination):
     """
     For international flights, select airports of origin/destination which have capacity between them for the selected
     year_month. If None, select all.
+    The routes with capacity of the year_month are loaded once (see capacity_cube), and the pairs of airports are
+    checked in memory.
     :param year_month: 
     :param origin: list of airport codes 
     :param destination: list of airport codes
     :return: both lists of airport codes, filtered on existence of capacity
     """
-    filtered_origin = set()
-    filtered_destination = set()
-    for o in origin:
-        for d in destination:
-            capa = CapacityInitialData.aggregate([
-                {'$match': {'origin': o, 'destination': d, 'year_month': year_month, 'active_rec': True}},
-                {'$group': {
-                    '_id': {'origin': '$origin', 'destination': '$destination'}, 'capa': {'$sum': '$capacity'}
-                }}
-            ])
-            cap = list(capa)
-            if cap == []:
-                continue
-            else:
-                filtered_destination.add(cap[0].get('_id').get('destination'))
-                filtered_origin.add(cap[0].get('_id').get('origin'))
+    routes = get_capacity_cube(CapacityInitialData).routes(year_month)
+    pairs = [(o, d) for o in origin for d in destination if (o, d) in routes]
+    filtered_origin = set(o for o, _ in pairs)
+    filtered_destination = set(d for _, d in pairs)
 
     if len(filtered_origin) > 0:
         if len(filtered_destination) > 0:
@@ -148,30 +134,15 @@ def find_airports_by_name(name, tab_name):
     """
     This function looks up the name of an airport or city in the Excel file based on the Mexico-specific
     field of "provider_query", or on "query_names".
+    The names are looked up in the index of the airports' names, loaded once (see airport_names).
     Failures of this function are reported at the end of the algorithm to enrich (manually) the "provider_query" with
     the help of submit_query_providers() function.
     :param name: an upper case string
     :param tab_name: name of the excel file's tab (indication of international or mexican-only airports)
     :return: set of airport codes (or None)
     """
-    city_clean = name.lower().replace('.', '').split('-')[0].split('/')[0].split(',')[0].strip()
-    if 'NAC' in tab_name:
-        airports = dict((i.code, i) for i in
-                        Airport.find({'query_names': city_clean, 'code_type': {'$in': ['city','airport']}, 'country': 'MX'},
-                                     {'_id': 0, 'code': 1, 'name': 1, 'city': 1}) if i.code)
-        if len(airports) == 0:
-            airports = dict((i.code, i) for i in
-                            Airport.find({provider_tag: name.strip(), 'code_type': {'$in': ['city','airport']}, 'country': 'MX'},
-                                         {'_id': 0, 'code': 1, 'name': 1, 'city': 1}) if i.code)
-    else:
-        airports = dict((i.code, i) for i in
-                        Airport.find({'query_names': city_clean, 'code_type': {'$in': ['city','airport']}},
-                                     {'_id': 0, 'code': 1, 'name': 1, 'city': 1}) if i.code)
-        if len(airports) == 0:
-            airports = dict((i.code, i) for i in
-                            Airport.find({provider_tag: name.strip(), 'code_type': {'$in': ['city','airport']}},
-                                         {'_id': 0, 'code': 1, 'name': 1, 'city': 1}) if i.code)
-    return set([a for a in airports.iterkeys()]) if len(airports) > 0 else None
+    country = 'MX' if 'NAC' in tab_name else None
+    return get_airport_names(provider).find(name, country)
 
 
 def update_unknown_airports(city, pax):
@@ -254,8 +225,9 @@ def get_data(xlsx_files, year_months):
     for xlsx_f in xlsx_files:  # loop through each file
         print('******************** processing Excel file:', xlsx_f)
         xl = pd.ExcelFile(tmp_dir + "/" + xlsx_f)
-        # Create a data frame to save data line after line, so we can check later on and add values to each other
-        previous_data = pd.DataFrame(columns=['origin', 'destination', 'year_month', 'passengers'])
+        # Sum the passengers of the lines with the same tuple (over all the tabs), so each one is sent only once
+        accumulator = SegmentAccumulator()
+        checked_year_months = set()
 
         for tab in xl.sheet_names:  # loop in all sheets of the excel file
             print('Starting', tab, 'tab in the Excel file')
@@ -266,92 +238,70 @@ def get_data(xlsx_files, year_months):
             xls = format_file(xls)
             xls['tab'] = tab
 
-            with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
-
-                for indx, row in xls.iterrows():  # loop through each row (origin, destination) in file
-                    # Skip empty rows (no text in Origin column, or year Total = 0)
-                    if isinstance(row['Origin'], float) or row['Total'] == 0:
+            for indx, row in xls.iterrows():  # loop through each row (origin, destination) in file
+                # Skip empty rows (no text in Origin column, or year Total = 0)
+                if isinstance(row['Origin'], float) or row['Total'] == 0:
+                    continue
+                # Stop at the end of the table (indicated by "T O T A L")
+                if "".join(row['Origin'].split(" ")).upper() == "TOTAL":
+                    break
+                origin = unidecode(row['Origin']).upper()
+                destination = unidecode(row['Destination']).upper()
+                airport_origin = find_airports_by_name(origin, tab)
+                airport_destination = find_airports_by_name(destination, tab)
+                if airport_origin is None:
+                    update_unknown_airports(origin, row['Total'])
+                    continue
+                if airport_destination is None:
+                    update_unknown_airports(destination, row['Total'])
+                    continue
+
+                for colname, colvalue in row.iteritems():   # loop through rows
+                    # Only look at month columns
+                    if colname not in months.keys():
                         continue
-                    # Stop at the end of the table (indicated by "T O T A L")
-                    if "".join(row['Origin'].split(" ")).upper() == "TOTAL":
-                        break
-                    origin = unidecode(row['Origin']).upper()
-                    destination = unidecode(row['Destination']).upper()
-                    airport_origin = find_airports_by_name(origin, tab)
-                    airport_destination = find_airports_by_name(destination, tab)
-                    if airport_origin is None:
-                        update_unknown_airports(origin, row['Total'])
+                    # skip cells with no pax
+                    if np.isnan(colvalue) or colvalue == "" or int(colvalue) == 0:
                         continue
-                    if airport_destination is None:
-                        update_unknown_airports(destination, row['Total'])
+                    year_month = str(year) + "-" + months.get(colname)
+                    total_pax = int(colvalue)
+
+                    # Only treat the requested year_months
+                    if year_month not in year_months:
                         continue
 
-                    for colname, colvalue in row.iteritems():   # loop through rows
-                        # Only look at month columns
-                        if colname not in months.keys():
-                            continue
-                        # skip cells with no pax
-                        if np.isnan(colvalue) or colvalue == "" or int(colvalue) == 0:
-                            continue
-                        year_month = str(year) + "-" + months.get(colname)
-                        total_pax = int(colvalue)
+                    if year_month not in checked_year_months:
+                        checked_year_months.add(year_month)
+                        if External_Segment_Tmp.find_one({'year_month': year_month, 'provider': provider}):
+                            log.warning("This year_month (%s) already exists for provider %s", year_month, provider)
 
-                        # Only treat the requested year_months
-                        if year_month not in year_months:
+                    # For international flights, only keep the airports for which capacity exists on that year_month
+                    if 'INT' in tab:
+                        airport_origin, airport_destination = get_capa(year_month, airport_origin, airport_destination)
+                        if airport_destination is None or airport_origin is None:
+                            no_capa.append({'year_month': year_month, 'origin': origin, 'destination': destination})
                             continue
 
-                        if year_month not in previous_data['year_month'].values:
-                            if External_Segment_Tmp.find_one({'year_month': year_month, 'provider': provider}):
-                                log.warning("This year_month (%s) already exists for provider %s", year_month, provider)
-
-                        # For international flights, only keep the airports for which capacity exists on that year_month
-                        if 'INT' in tab:
-                            airport_origin, airport_destination = get_capa(year_month, airport_origin, airport_destination)
-                            if airport_destination is None or airport_origin is None:
-                                no_capa.append({'year_month': year_month, 'origin': origin, 'destination': destination})
-                                continue
-
-                        if ((previous_data['origin'] == airport_origin) &
-                                (previous_data['destination'] == airport_destination) &
-                                (previous_data['year_month'] == year_month)).any():
-                            new_row = False
-                            # Add to Excel file's total_pax the "passenger" integer you get from filtering previous_data on other columns
-                            total_pax += int(previous_data['passengers'][
-                                                 (previous_data['origin'] == airport_origin) &
-                                                 (previous_data['destination'] == airport_destination) &
-                                                 (previous_data['year_month'] == year_month)])
-                        else:
-                            new_row = True
-
-                        dic = dict(provider=provider,
-                                   data_type='airport',
-                                   airline=['*'],
-                                   airline_ref_code=['*'],
-                                   origin=[', '.join(airport_origin)],
-                                   destination=[', '.join(airport_destination)],
-                                   year_month=[year_month],
-                                   total_pax=total_pax,
-                                   raw_rec=dict(row),
-                                   both_ways=False,
-                                   from_line=indx,
-                                   from_filename=xlsx_f,
-                                   url=base_url+end_url)
-
-                        new_data = pd.Series({'origin': airport_origin, 'destination': airport_destination,
-                                              'year_month': year_month, 'passengers': total_pax}).to_frame()
-                        if new_row:
-                            previous_data = previous_data.append(new_data.T, ignore_index=True)
-                        else:
-                            # Update the previous_data data frame with the new passengers count
-                            previous_data['passengers'][
-                                (previous_data['origin'] == airport_origin) &
-                                (previous_data['destination'] == airport_destination) &
-                                (previous_data['year_month'] == year_month)] = total_pax
-
-                        query = dict((k, dic[k]) for k in ('origin', 'destination', 'year_month', 'provider',
-                                                           'data_type', 'airline'))
-                        bulk.find(query).upsert().update_one({'$set': dic, '$setOnInsert': dict(inserted=now)})
-            log.info('stored: %r', bulk.nresult)
+                    dic = dict(provider=provider,
+                               data_type='airport',
+                               airline=['*'],
+                               airline_ref_code=['*'],
+                               origin=[', '.join(airport_origin)],
+                               destination=[', '.join(airport_destination)],
+                               year_month=[year_month],
+                               total_pax=total_pax,
+                               raw_rec=dict(row),
+                               both_ways=False,
+                               from_line=indx,
+                               from_filename=xlsx_f,
+                               url=base_url+end_url)
+
+                    accumulator.add((tuple(sorted(airport_origin)), tuple(sorted(airport_destination)),
+                                     year_month), total_pax, dic)
+
+        with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
+            accumulator.upsert(bulk, now)
+        log.info('stored: %r', bulk.nresult)
 
 
 def print_full(x):
@@ -363,6 +313,8 @@ def print_full(x):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Load data from Mexico')
     parser.add_argument('year_months', type=str, nargs='+', help='Year_month(s) to download ([YYYY-MM, YYYY-MM...]')
+    parser.add_argument('--fuzzy_names', dest='fuzzy_names', action='store_true',
+                        help='If present, match the unknown airport names to the closest known names')
 
     p = parser.parse_args()
 
@@ -384,6 +336,7 @@ if __name__ == '__main__':
     start_time = time.time()
 
     Model.init_db(def_w=True)
+    get_airport_names(provider, fuzzy=p.fuzzy_names)
 
     year_months = p.year_months[0].split(', ')
     year = list(set([ym[0:4] for ym in p.year_months]))
@@ -94,7 +94,7 @@ def get_data():
                           from_filename=xlsx_f)
             query = dict((k, dic[k]) for k in ('origin', 'destination', 'year_month', 'provider',
                                                   'data_type', 'airline'))
-            bulk.find(query).upsert().update_one({'$set': dic, '$setOnInsert': dict(inserted=now)})
+            bulk.find(query).upsert().update_one({'$set': dict(dic, modified=now), '$setOnInsert': dict(inserted=now)})
 
             if row % 100 == 0:
                 print('{0:.3g}'.format(row / all_rows * 100) + '%')
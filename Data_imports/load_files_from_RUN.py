@@ -19,6 +19,8 @@ import logging
 from optidb.model import *
 from utils import utcnow, YearMonth
 from utils.logging_utils import BackupFileHandler
+from anomaly_report import AnomalyCollector
+from codes_index import get_codes_index
 import pandas as pd
 
 
@@ -35,7 +37,7 @@ main_log.addHandler(handler)
 log = logging.getLogger('load_RUN')
 log.info('Starting to get data from RUN')
 
-wrong_airports = pd.DataFrame(columns=['code', 'passengers'])
+wrong_airports = AnomalyCollector('wrong_airports', 'RUN')
 
 
 class External_Segment_Tmp(Model):
@@ -44,24 +46,17 @@ class External_Segment_Tmp(Model):
 
 def get_airports_codes():
     """
-    Get a dictionary of all airport codes for reference throughout import algorithm
-    :return:
+    Get a dictionary of all airports keyed by code, taken from the codes index shared by the import programs
+    :return: dict
     """
-    airports_codes = Airport.find({'code': {"$ne": None}},
-                                  {'code': 1, 'iata_code': 1, 'city': 1, 'name': 1, '_id': 0})
-    return dict((i.code, i) for i in airports_codes if i.code)
+    return get_codes_index().by_code
 
 
 def check_airport(airport, pax):
-    global wrong_airports
     global airports_codes
     # Check the airport code exists in Mongo. If not, skip line
     if airport not in airports_codes:
-        if airport in wrong_airports['code'].values:
-            wrong_airports.loc[wrong_airports['code'] == airport, 'passengers'] += pax
-        else:
-            info = pd.Series({'code': airport, 'passengers': pax})
-            wrong_airports = wrong_airports.append(info, ignore_index=True)
+        wrong_airports.add(airport, pax, 'missing')
         return False
     else:
         return True
@@ -129,7 +124,8 @@ def get_data():
                 now = utcnow()
                 query = dict((k, dic_to[k]) for k in ('origin', 'destination', 'year_month', 'provider',
                                                       'data_type', 'airline'))
-                bulk.find(query).upsert().update_one({'$set': dic_to, '$setOnInsert': dict(inserted=now)})
+                bulk.find(query).upsert().update_one({'$set': dict(dic_to, modified=now),
+                                                      '$setOnInsert': dict(inserted=now)})
 
             # Then save data from city 2 to city 1
             if not pd.isnull(full_row['Departures']):
@@ -148,7 +144,8 @@ def get_data():
                                 from_filename=xlsx_f)
                 query = dict((k, dic_from[k]) for k in ('origin', 'destination', 'year_month', 'provider',
                                                         'data_type', 'airline'))
-                bulk.find(query).upsert().update_one({'$set': dic_from, '$setOnInsert': dict(inserted=now)})
+                bulk.find(query).upsert().update_one({'$set': dict(dic_from, modified=now),
+                                                      '$setOnInsert': dict(inserted=now)})
             if row % 100 == 0:
                 print('{0:.3g}'.format(row / all_rows * 100) + '%')
     log.info('stored: %r', bulk.nresult)
@@ -157,3 +154,4 @@ if __name__ == '__main__':
     Model.init_db(def_w=True)
     airports_codes = get_airports_codes()
     get_data()
+    wrong_airports.log_report(log, 'unknown airports')
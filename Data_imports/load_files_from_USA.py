@@ -17,7 +17,6 @@ import logging
 import logging.handlers
 import csv
 import pandas as pd
-from selenium import webdriver
 import os
 import time
 import zipfile
@@ -25,15 +24,22 @@ import sys
 sys.path.append('../')
 from optidb.model import *
 from utils import utcnow, YearMonth
+from utils.threads import ThreadPool
 from utils.logging_utils import BackupFileHandler
 import determine_airline_ref_code as ref_code
+from segment_accumulator import SegmentAccumulator
+from anomaly_report import AnomalyCollector
+from download_watcher import list_files, wait_for_download
+from browser_pool import browser_session, get_browser_pool
+import bts_download
+from codes_index import get_codes_index
 
 __version__ = 'V1.0.1'
 provider = 'USA'
 tmp_dir = '/tmp/USA'
-wrong_airports = pd.DataFrame(columns=['code', 'city', 'DOT_country/state', 'Optimode_country/state',
-                                           'info_type', 'passengers'])
-unknown_airlines = pd.DataFrame(columns=['code', 'name', 'passengers'])
+wrong_airports = AnomalyCollector('wrong_airports', provider,
+                                  ['city', 'DOT_country/state', 'Optimode_country/state'])
+unknown_airlines = AnomalyCollector('unknown_airlines', provider, ['name'])
 airports_codes = dict()
 # full_url = 'http://www.transtats.bts.gov/DL_SelectFields.asp?Table_ID=292'   Another type of file, for O&D (without via)
 full_url = 'http://www.transtats.bts.gov/DL_SelectFields.asp?Table_ID=293'   # Download file by selecting all fields
@@ -41,6 +47,18 @@ full_url = 'http://www.transtats.bts.gov/DL_SelectFields.asp?Table_ID=293'   # D
 if not os.path.isdir(tmp_dir):
      os.mkdir(tmp_dir)
 
+# Some codes are incorrect in the files from the FAA, "replacements" are the corrected codes):
+airport_replacement = {"JQF": "USA", "JRV": "NRR", "1G4": "GCW", "L41": "MYH", "7AK": "KQA", "UXR": "GMW",
+                       "NYL": "YUM", "YR1": "YRC", "PBX": "PVL", "ZXA": "ROZ", "ZXU": "OQU", "NZC": "VQQ",
+                       "FAQ": "FTI"}
+airline_replacements = {"09Q": "Q7", "SEB": "BB", "TQQ": "TA", "1BQ": "2D", "0MQ": "3E", "1YQ": "F4", "KAH": "M5",
+                        "0JQ": "V2", "1DQ": "IS", "23Q": "5K", "1AQ": "VC", "1WQ": "UE", "J5": "J5", "FCQ": "6F",
+                        "04Q": "TJ", "1RQ": "6G", "1QQ": "V9", "PBQ": "PV", "3F": "3F", "AMQ": "7Z", "3SD": "3S",
+                        "20Q": "O5", "28Q": "ZB", "AAT": "YI", "AJQ": "4A", "2HQ": "7Q", "NLQ": "N5", "02Q": "ZT",
+                        "07Q": "F8", "GCH": "ZS", "4EQ": "4E", "15Q": "6I"}
+# Some FAA codes are incorrect and have existing IATA equivalent, so they should be skipped:
+airport_exclusions = {"XWA", "NAD", "QMA", "ZXM", "ZXN", "RMN", "MQJ", "QMN", "QSO"}
+
 
 class External_Segment_Tmp(Model):
     __collection__ = 'external_segment_laurent_tests'
@@ -48,13 +66,10 @@ class External_Segment_Tmp(Model):
 
 def get_airports_codes():
     """
-    Get a dictionary of all airport codes for reference throughout import algorithm
-    :return:
+    Get a dictionary of all airports keyed by code, taken from the codes index shared by the import programs
+    :return: dict
     """
-    airports_codes = Airport.find({'code': {"$ne": None}},
-                                  {'code': 1, 'iata_code': 1, 'icao_code': 1, 'country': 1, 'state': 1,
-                                   'city': 1, 'name': 1, '_id': 0})
-    return dict((i.code, i) for i in airports_codes if i.code)
+    return get_codes_index().by_code
 
 
 def get_airline_codes():
@@ -71,71 +86,120 @@ def download_one(month, year):
     """
     Download a single year_month's flights. It is not easy to identify where the files are located, so this function
     mimics a user filling the form, selecting year and month as well as all variables, and clicking download.
+    Each download gets its own directory, so that several months can be downloaded at the same time.
     :param month: integer
     :param year: integer
     :return: a single renamed csv file
     """
     end_name = "US_Segments_%s-%s.csv" % (month, year)
     if end_name not in os.listdir(tmp_dir):
+        download_dir = os.path.join(tmp_dir, 'download_%s-%s' % (month, year))
+
+        # Reach the website with a browser of the pool
+        with browser_session(download_dir) as driver:
+            driver.get(full_url)
+            assert "RITA" in driver.title
+
+            # Select the demanded year and month (don't select months if "All", because default value is "All Months")
+            driver.find_element_by_xpath("//select[@id='XYEAR']/option[@value=%s]" % year).click()
+            if not month == "All":
+                driver.find_element_by_xpath("//select[@id='FREQUENCY']/option[@value=%s]" % month).click()
+
+            # Click the "select all variables checkbox", then click download
+            driver.find_element_by_name('AllVars').click()
+            before = list_files(download_dir)
+            driver.find_element_by_name("Download").click()
 
-        # Set chrome options and reach the website
-        options = webdriver.ChromeOptions()
-        options.add_experimental_option("prefs", {
-            "download.default_directory": tmp_dir,
-            "download.prompt_for_download": False,
-        })
-        driver = webdriver.Chrome(chrome_options=options)
-        driver.implicitly_wait(10)
-        driver.get(full_url)
-        assert "RITA" in driver.title
-
-        # Select the demanded year and month (don't select months if "All", because default value is "All Months")
-        driver.find_element_by_xpath("//select[@id='XYEAR']/option[@value=%s]" % year).click()
-        if not month == "All":
-            driver.find_element_by_xpath("//select[@id='FREQUENCY']/option[@value=%s]" % month).click()
-
-        # Click the "select all variables checkbox", then click download
-        driver.find_element_by_name('AllVars').click()
-        driver.find_element_by_name("Download").click()
-
-        # Wait for file to be downloaded
-        time.sleep(120)
-        driver.close()
-
-        # Identify downloaded zip file, then unzip its content and delete zip file
-        zip_name = max([tmp_dir + "/" + f for f in os.listdir(tmp_dir)], key=os.path.getctime)
+            # Wait for file to be downloaded
+            zip_name = wait_for_download(download_dir, before)
+
+        # Unzip the downloaded file's content and delete zip file
         zip_ref = zipfile.ZipFile(zip_name, 'r')
-        zip_ref.extractall(tmp_dir)
+        csv_name = [f for f in zip_ref.namelist() if f.lower().endswith('.csv')][0]
+        zip_ref.extract(csv_name, download_dir)
         zip_ref.close()
         os.remove(zip_name)
 
-        # Identify csv file name, and rename to "US_Segment_month-year.csv"
-        csv_name = max([tmp_dir + "/" + f for f in os.listdir(tmp_dir)], key=os.path.getctime)
-        os.rename(os.path.join(tmp_dir, csv_name), os.path.join(tmp_dir, end_name))
+        # Rename csv file to "US_Segment_month-year.csv"
+        os.rename(os.path.join(download_dir, csv_name), os.path.join(tmp_dir, end_name))
         log.info("%s downloaded", end_name)
     return end_name
 
 
 def robot_download(months, years):
     """
-    Depending on whether month and/or year are single or multiple values, iterate to download the relevant files
+    Depending on whether month and/or year are single or multiple values, iterate to download the relevant files.
+    Files are downloaded in parallel, with as many threads as browsers in the pool. The first download that failed
+    is raised once all the downloads have ended.
     :param months: list of strings
     :param years: list of strings
     :return: list of downloaded csv files
     """
-    csv_files = []
+    requested = []
+    # (month, year) -> (csv file, exception), set by the threads (the pool does not return their results)
+    downloads = dict()
+
+    def download_task(m, y):
+        try:
+            downloads[(m, y)] = (download_one(m, y), None)
+        except Exception as e:
+            log.exception('Download of %s-%s failed', m, y)
+            downloads[(m, y)] = (None, e)
+
+    with ThreadPool(get_browser_pool().size) as pool:
+        for y in years:
+            for m in months:
+                if External_Segment_Tmp.find_one(
+                        {'year_month': y + "-" + m, 'provider': provider}):
+                    log.warning("This year_month (%s) already exists for provider %s",
+                                y + "-" + m, provider)
+            if sorted(months) == ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']:
+                files_months = ["All"]
+            else:
+                files_months = months
+            for m in files_months:
+                requested.append((m, y))
+                pool.add_task(download_task, m, y)
+
+    for key in requested:
+        csv_file, error = downloads.get(key, (None, None))
+        if error is not None:
+            raise error
+        if csv_file is None:
+            raise IOError('Download of %s-%s did not end' % key)
+    return [downloads[key][0] for key in requested]
+
+
+def http_download(months, years):
+    """
+    Alternative to robot_download, without browser: the BTS form is submitted with plain HTTP requests, one per
+    year_month, and the zip files are kept as they are in tmp_dir (their csv member is read directly by the import)
+    :param months: list of strings
+    :param years: list of strings
+    :return: list of downloaded zip files
+    """
+    zip_files = []
+    form = None
     for y in years:
         for m in months:
-            if External_Segment_Tmp.find_one(
-                    {'year_month': y + "-" + m, 'provider': provider}):
-                log.warning("This year_month (%s) already exists for provider %s",
-                            y + "-" + m, provider)
-        if months == ['01','02','03','04','05','06','07','08','09','10','11','12']:
-            csv_files.append(download_one("All", y))
-        else:
-            csv_files.append(download_one(m, y))
+            if External_Segment_Tmp.find_one({'year_month': y + "-" + m, 'provider': provider}):
+                log.warning("This year_month (%s) already exists for provider %s", y + "-" + m, provider)
+            end_name = "US_Segments_%s-%s.zip" % (m, y)
+            if end_name not in os.listdir(tmp_dir):
+                form = form or bts_download.get_form(full_url)
+                bts_download.download_month(y, m, os.path.join(tmp_dir, end_name), form)
+            zip_files.append(end_name)
+    return zip_files
+
 
-    return csv_files
+def open_segments_file(csv_f):
+    """
+    :param csv_f: name of a csv file in tmp_dir, or of a zip file downloaded by http_download
+    :return: file object of the csv data
+    """
+    if csv_f.endswith('.zip'):
+        return bts_download.open_csv_member(os.path.join(tmp_dir, csv_f))
+    return open(os.path.join(tmp_dir, csv_f))
 
 
 def check_airport(airport, city, country, state, pax):
@@ -144,8 +208,8 @@ def check_airport(airport, city, country, state, pax):
     - that the airport code exists in database
     - that it is located in the same country as the DOT's file
     - that it is located in the same state as the DOT's file (for US airports)
-    Each failed test is recorded in a dataframe, along with the number of passengers concerned (for information on the
-    importance of the airport).
+    Each failed test is recorded in wrong_airports, along with the number of passengers concerned (for information on
+    the importance of the airport).
     :param airport: code
     :param city: name
     :param country: name
@@ -153,40 +217,25 @@ def check_airport(airport, city, country, state, pax):
     :param pax: integer
     :return:
     """
-    global wrong_airports
     global airports_codes
     # Check the airport code exists in Mongo. If not, skip line
     if airport not in airports_codes:
-        if airport in wrong_airports['code'].values:
-            wrong_airports.loc[wrong_airports['code'] == airport, 'passengers'] += pax
-        else:
-            info = pd.Series({'code': airport, 'city': city, 'DOT_country/state/state': country + ':' + state,
-                              'Optimode_country/state': None,
-                              'info_type': 'missing', 'passengers': pax})
-            wrong_airports = wrong_airports.append(info, ignore_index=True)
+        wrong_airports.add(airport, pax, 'missing', {'city': city, 'DOT_country/state': country + ':' + state,
+                                                     'Optimode_country/state': None})
         return False
 
     # Check that airports are in the same country as in the database
     if airports_codes.get(airport).get('country'):
         if not country == airports_codes.get(airport).get('country'):
-            if airport in wrong_airports['code'].values:
-                wrong_airports.loc[wrong_airports['code'] == airport, 'passengers'] += pax
-            else:
-                info = pd.Series({'code': airport, 'city': city, 'DOT_country/state': country,
-                                  'Optimode_country/state': airports_codes.get(airport).get('country'),
-                                  'info_type': 'country', 'passengers': pax})
-                wrong_airports = wrong_airports.append(info, ignore_index=True)
+            wrong_airports.add(airport, pax, 'country',
+                               {'city': city, 'DOT_country/state': country,
+                                'Optimode_country/state': airports_codes.get(airport).get('country')})
 
     # For US airports, check that airports are in the same state as in the database
     if country == 'US' and airports_codes.get(airport).get('country') == 'US' and \
             not state == airports_codes.get(airport).get('state'):
-        if airport in wrong_airports['code'].values:
-            wrong_airports.loc[wrong_airports['code'] == airport, 'passengers'] += pax
-        else:
-            info = pd.Series({'code': airport, 'city': city, 'DOT_country/state': state,
-                              'Optimode_country/state': airports_codes.get(airport).get('state'),
-                              'info_type': 'state', 'passengers': pax})
-            wrong_airports = wrong_airports.append(info, ignore_index=True)
+        wrong_airports.add(airport, pax, 'state', {'city': city, 'DOT_country/state': state,
+                                                   'Optimode_country/state': airports_codes.get(airport).get('state')})
     return True
 
 
@@ -202,38 +251,26 @@ def get_data(csv_files):
     :param csv_files: list of files
     :return:
     """
-    global unknown_airlines
     global airports_codes
     now = utcnow()
     ref_code.init_cache()
     airports_codes = get_airports_codes()
     airline_codes = get_airline_codes()
-    # Some codes are incorrect in the files from the FAA, "replacements" are the corrected codes):
-    airport_replacement = {"JQF": "USA", "JRV": "NRR", "1G4": "GCW", "L41": "MYH", "7AK": "KQA", "UXR": "GMW",
-                           "NYL": "YUM", "YR1": "YRC", "PBX": "PVL", "ZXA": "ROZ", "ZXU": "OQU", "NZC": "VQQ",
-                           "FAQ": "FTI"}
-    airline_replacements = {"09Q": "Q7", "SEB": "BB", "TQQ": "TA", "1BQ": "2D", "0MQ": "3E", "1YQ": "F4", "KAH": "M5",
-                            "0JQ": "V2", "1DQ": "IS", "23Q": "5K", "1AQ": "VC", "1WQ": "UE", "J5": "J5", "FCQ": "6F",
-                            "04Q": "TJ", "1RQ": "6G", "1QQ": "V9", "PBQ": "PV", "3F": "3F", "AMQ": "7Z", "3SD": "3S",
-                            "20Q": "O5", "28Q": "ZB", "AAT": "YI", "AJQ": "4A", "2HQ": "7Q", "NLQ": "N5", "02Q": "ZT",
-                            "07Q": "F8", "GCH": "ZS", "4EQ": "4E", "15Q": "6I"}
-    # Some FAA codes are incorrect and have existing IATA equivalent, so they should be skipped:
-    airport_exclusions = {"XWA", "NAD", "QMA", "ZXM", "ZXN", "RMN", "MQJ", "QMN", "QSO"}
-
     def log_bulk(self):
         log.info('store external_segment: %r', self.nresult)
 
     for csv_f in csv_files:  # loop through each file
             print('******************** processed csv:  ', csv_f)
-            with open('%s/%s' % (tmp_dir, csv_f)) as csv_file:
+            with open_segments_file(csv_f) as csv_file:
                 dict_reader = csv.DictReader(csv_file)
                 row_nb = 0
-                previous_data = pd.DataFrame(columns=['origin', 'destination', 'year_month', 'airline', 'passengers'])
-                all_rows = len(list(csv.DictReader(open('%s/%s' % (tmp_dir, csv_f)))))
+                with open_segments_file(csv_f) as count_file:
+                    all_rows = sum(1 for _ in csv.DictReader(count_file))
                 """
-                In previous_data, we store all the lines that are sent to bulk, to refer to for next lines.
-                This allows sum of passengers for similar origin/destination/year_month/airline tuples.
+                In accumulator, we store all the lines read in the file, keyed by origin/destination/year_month/airline.
+                This allows sum of passengers for similar tuples, each tuple being sent to bulk only once per file.
                 """
+                accumulator = SegmentAccumulator()
 
                 with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
 
@@ -260,11 +297,7 @@ def get_data(csv_files):
                             airport_destination = airport_replacement.get(airport_destination)
 
                         if row_airline not in airline_codes:  # Check airline
-                            if row_airline in unknown_airlines['code'].values:
-                                unknown_airlines.loc[unknown_airlines['code'] == row_airline, 'passengers'] += passengers
-                            else:
-                                info = pd.Series({'code': row_airline, 'name': row['CARRIER_NAME'], 'passengers': passengers})
-                                unknown_airlines = unknown_airlines.append(info, ignore_index=True)
+                            unknown_airlines.add(row_airline, passengers, info={'name': row['CARRIER_NAME']})
                             continue
 
 
@@ -279,20 +312,6 @@ def get_data(csv_files):
                         airline_ref_code = ref_code.get_airline_ref_code(row_airline, airport_origin,
                                                                          airport_destination,
                                                                          YearMonth(year_month))
-                        if ((previous_data['origin'] == airport_origin) &
-                                (previous_data['destination'] == airport_destination)
-                                & (previous_data['year_month'] == year_month)
-                                & (previous_data['airline'] == row_airline)).any():
-                            new_row = False
-                            # Add to Excel file's total_pax the "passenger" integer you get from filtering
-                            # previous_data on other columns
-                            passengers += int(previous_data['passengers'][
-                                (previous_data['origin'] == airport_origin) &
-                                (previous_data['destination'] == airport_destination) &
-                                (previous_data['year_month'] == year_month) &
-                                (previous_data['airline'] == row_airline)])
-                        else:
-                            new_row = True
 
                         dic = dict(provider=provider,
                                    data_type='airport',
@@ -306,29 +325,147 @@ def get_data(csv_files):
                                    raw_rec=dict(row), both_ways=False,
                                    from_line=row_nb, from_filename=csv_f, url=full_url)
 
-                        new_data = pd.Series({'origin': airport_origin, 'destination': airport_destination,
-                                              'year_month': year_month, 'airline': row_airline,
-                                              'passengers': passengers}).to_frame()
-                        if new_row:
-                            previous_data = previous_data.append(new_data.T, ignore_index=True)
-                        else:
-                            previous_data['passengers'][
-                                (previous_data['origin'] == airport_origin) &
-                                (previous_data['destination'] == airport_destination) &
-                                (previous_data['airline'] == row_airline) &
-                                (previous_data['year_month'] == year_month)] = passengers  # Modify previous_data's pax
-
-                        query = dict((k, dic[k]) for k in ('origin', 'destination', 'year_month', 'provider',
-                                                           'data_type', 'airline'))
-                        bulk.find(query).upsert().update_one({'$set': dic, '$setOnInsert': dict(inserted=now)})
+                        # Add the passengers to the ones of previous lines with the same tuple
+                        accumulator.add((airport_origin, airport_destination, year_month, row_airline), passengers, dic)
                         if row_nb % 1000 == 0:
                             print('{0:.3g}'.format(row_nb / all_rows * 100) + '%')
+
+                    log.info('%d summed lines out of %d rows', len(accumulator), row_nb)
+                    accumulator.upsert(bulk, now)
                 log.info('stored: %r', bulk.nresult)
 
 
+def check_airport_columns(xls, side):
+    """
+    Columnar version of check_airport, applied to all the origins (side='ORIGIN') or destinations (side='DEST')
+    of the file at once. Failed tests are recorded in wrong_airports, summed per airport code and type of failure.
+    :param xls: DataFrame of the csv file, with the corrected codes in 'origin' and 'destination' columns
+    :param side: 'ORIGIN' or 'DEST'
+    :return: boolean Series, True for the rows whose airport exists in database
+    """
+    code = xls['origin' if side == 'ORIGIN' else 'destination']
+    country = xls[side + '_COUNTRY']
+    state = xls[side + '_STATE_ABR']
+    known = code.isin(airports_codes.keys())
+    db_country = code.map(dict((c, a.get('country')) for c, a in airports_codes.items()))
+    db_state = code.map(dict((c, a.get('state')) for c, a in airports_codes.items()))
+
+    wrong_country = known & db_country.notnull() & (db_country != country)
+    wrong_state = known & (country == 'US') & (db_country == 'US') & (db_state != state)
+    anomalies = pd.concat([
+        pd.DataFrame({'code': code, 'DOT_country/state': country + ':' + state,
+                      'Optimode_country/state': None, 'info_type': 'missing'})[~known],
+        pd.DataFrame({'code': code, 'DOT_country/state': country,
+                      'Optimode_country/state': db_country, 'info_type': 'country'})[wrong_country],
+        pd.DataFrame({'code': code, 'DOT_country/state': state,
+                      'Optimode_country/state': db_state, 'info_type': 'state'})[wrong_state]])
+    if len(anomalies.index) > 0:
+        anomalies['city'] = xls[side + '_CITY_NAME']
+        anomalies['passengers'] = xls['passengers']
+        # Keep the first line met in the file for each code and type of failure, along with the sum of passengers
+        anomalies = anomalies.sort_index(kind='mergesort').groupby(['code', 'info_type'], sort=False).agg(
+            {'city': 'first', 'DOT_country/state': 'first', 'Optimode_country/state': 'first',
+             'passengers': 'sum'}).reset_index()
+        wrong_airports.add_frame(anomalies)
+    return known
+
+
+def read_segments_file(csv_f):
+    """
+    Load a T-100 segment csv file in a single typed pass, and apply the code corrections and exclusions on whole
+    columns.
+    :param csv_f: file name in tmp_dir (csv file, or zip file containing the csv file)
+    :return: DataFrame with the raw columns of the file, plus 'from_line', 'passengers', 'airline', 'origin',
+    'destination' and 'year_month'. Rows without passengers or with excluded airports are removed.
+    """
+    with open_segments_file(csv_f) as csv_file:
+        xls = pd.read_csv(csv_file, dtype=str, keep_default_na=False)
+    # Files end each line with a comma, which csv.DictReader reads as an empty field name
+    xls.columns = ['' if col.startswith('Unnamed:') else col for col in xls.columns]
+    xls = xls.replace(':', '')
+    xls['from_line'] = range(1, len(xls.index) + 1)
+
+    xls['passengers'] = pd.to_numeric(xls['PASSENGERS'].str.split('.').str[0], errors='coerce').fillna(0).astype(int)
+    xls = xls[xls['passengers'] > 0]  # skip rows with no pax
+    xls = xls[~(xls['ORIGIN'].isin(airport_exclusions) | xls['DEST'].isin(airport_exclusions))].copy()  # skip exclusions
+
+    # correct the wrong codes
+    xls['airline'] = xls['UNIQUE_CARRIER'].replace(airline_replacements)
+    xls['origin'] = xls['ORIGIN'].replace(airport_replacement)
+    xls['destination'] = xls['DEST'].replace(airport_replacement)
+    xls['year_month'] = xls['YEAR'].astype(int).map('{:04d}'.format) + '-' + \
+        xls['MONTH'].astype(int).map('{:02d}'.format)
+    return xls
+
+
+def get_data_grouped(csv_files):
+    """
+    Populate the database with data from csv files, working on whole columns instead of row by row:
+    corrections, airline and airport checks are vectorized, and passengers are summed per
+    origin/destination/year_month/airline with a single groupby. Stored records are the same as with get_data.
+    :param csv_files: list of files
+    :return:
+    """
+    global airports_codes
+    now = utcnow()
+    ref_code.init_cache()
+    airports_codes = get_airports_codes()
+    airline_codes = get_airline_codes()
+    keys = ['origin', 'destination', 'year_month', 'airline']
+
+    def log_bulk(self):
+        log.info('store external_segment: %r', self.nresult)
+
+    for csv_f in csv_files:  # loop through each file
+        print('******************** processed csv:  ', csv_f)
+        xls = read_segments_file(csv_f)
+        raw_columns = [col for col in xls.columns if col not in keys + ['from_line', 'passengers']]
+
+        # Check airlines, then origins on the remaining rows, then destinations
+        known_airline = xls['airline'].isin(airline_codes.keys())
+        if not known_airline.all():
+            unknown = xls[~known_airline].groupby('airline', sort=False).agg(
+                {'CARRIER_NAME': 'first', 'passengers': 'sum'}).reset_index()
+            unknown.columns = [{'airline': 'code', 'CARRIER_NAME': 'name'}.get(c, c) for c in unknown.columns]
+            unknown_airlines.add_frame(unknown)
+        xls = xls[known_airline]
+        xls = xls[check_airport_columns(xls, 'ORIGIN')]
+        xls = xls[check_airport_columns(xls, 'DEST')]
+
+        # Sum passengers per tuple, and keep the raw record of the last line of each tuple
+        totals = xls.groupby(keys, sort=False).agg({'passengers': 'sum', 'from_line': 'max'}).reset_index()
+        raw_recs = xls.set_index('from_line')[raw_columns].loc[totals['from_line']].to_dict('records')
+        log.info('%d summed lines out of %d valid rows', len(totals.index), len(xls.index))
+
+        with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
+            for total, raw_rec in zip(totals.itertuples(index=False), raw_recs):
+                airline_ref_code = ref_code.get_airline_ref_code(total.airline, total.origin, total.destination,
+                                                                 YearMonth(total.year_month))
+                dic = dict(provider=provider,
+                           data_type='airport',
+                           airline=[total.airline],
+                           airline_ref_code=[airline_ref_code],
+                           total_pax=int(total.passengers),
+                           overlap=[],
+                           origin=[total.origin],
+                           destination=[total.destination],
+                           year_month=[total.year_month],
+                           raw_rec=raw_rec, both_ways=False,
+                           from_line=int(total.from_line), from_filename=csv_f, url=full_url)
+                query = dict((k, dic[k]) for k in ('origin', 'destination', 'year_month', 'provider',
+                                                   'data_type', 'airline'))
+                bulk.find(query).upsert().update_one({'$set': dict(dic, modified=now),
+                                                      '$setOnInsert': dict(inserted=now)})
+        log.info('stored: %r', bulk.nresult)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Load data from USA')
     parser.add_argument('year_months', type=str, nargs='+', help='Year_month(s) to download ([YYYY-MM, YYYY-MM...]')
+    parser.add_argument('--mode', dest='mode', choices=['groupby', 'rows'], default='groupby',
+                        help='groupby: vectorized import of whole files (default), rows: row by row import')
+    parser.add_argument('--download', dest='download', choices=['browser', 'http'], default='browser',
+                        help='browser: fill the BTS form with Chrome (default), http: submit the form without browser')
 
     p = parser.parse_args()
 
@@ -352,20 +489,18 @@ if __name__ == '__main__':
     years = list(set([ym[0:4] for ym in p.year_months]))
     months = list(set([ym[5:7] for ym in p.year_months]))
 
-    csv_files = robot_download(months, years)
+    if p.download == 'http':
+        csv_files = http_download(months, years)
+    else:
+        csv_files = robot_download(months, years)
     # csv_files = os.listdir(tmp_dir)
 
-    get_data(csv_files)
+    if p.mode == 'groupby':
+        get_data_grouped(csv_files)
+    else:
+        get_data(csv_files)
 
     log.info("\n\n--- %s seconds to populate db with %d files---" % ((time.time() - start_time), len(csv_files)))
-    global wrong_airports
-    global unknown_airlines
-    if len(wrong_airports.index) > 0:
-        wrong_airports = wrong_airports.sort_values('passengers', ascending=False)
-        log.warning("%s wrong or unknown airports (check the reasons why): \n%s", len(wrong_airports.index),
-                    print_full(wrong_airports))
-    if len(unknown_airlines.index) > 0:
-        unknown_airlines = unknown_airlines.sort_values('passengers', ascending=False)
-        log.warning("%s unknown airlines (check the reasons why): \n%s", len(unknown_airlines.index),
-                    print_full(unknown_airlines))
+    wrong_airports.log_report(log, 'wrong or unknown airports')
+    unknown_airlines.log_report(log, 'unknown airlines')
     log.info('End')
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / overlap_index
+# Purpose:     Find the overlapping scopes (origin, destination, airline) of external lines in memory.
+#              The lines are indexed by airline, origin and destination (including the '*' wildcard), so that the
+#              candidates of each line are only looked for among the lines sharing one of its codes, then checked
+#              with the same rules as the former query sent to the database for each line:
+#              - at least one common year_month
+#              - if the line has airlines, the other line has one of them or '*'
+#              - if the line has an origin or a destination, the other line has the same ones (or '*') in the same
+#                direction, or in the opposite direction when one of the two lines is both ways
+#              The overlapping lines form a graph, resolved component by component to keep the lines of the most
+#              trusted providers (resolve_overlaps).
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+from collections import defaultdict
+
+# Fields needed to find the overlaps (the names of the airline/origin/destination fields are given to OverlapIndex)
+projection_fields = ('provider', 'year_month', 'both_ways')
+
+
+def intersects(values, allowed):
+    """
+    :param values: list of the codes of a line
+    :param allowed: set of codes
+    :return: True if at least one code is allowed (same as a {'$in': allowed} query on a list)
+    """
+    return any(v in allowed for v in values)
+
+
+class OverlapIndex(object):
+    """
+    Lines of one year_month, indexed by their codes
+    """
+    def __init__(self, lines, airline_key='airline', origin_key='origin', destination_key='destination'):
+        """
+        :param lines: iterable of dict-like records with '_id', 'year_month', 'both_ways', and the 3 keys below
+        :param airline_key: name of the airlines field (ex: 'children_airlines')
+        :param origin_key: name of the origins field (ex: 'origin_city_airports')
+        :param destination_key: name of the destinations field (ex: 'destination_city_airports')
+        """
+        self.airline_key = airline_key
+        self.origin_key = origin_key
+        self.destination_key = destination_key
+        self.lines = dict()
+        self.by_code = dict((k, defaultdict(list)) for k in (airline_key, origin_key, destination_key))
+        for line in lines:
+            self.lines[line['_id']] = line
+            for key, index in self.by_code.items():
+                for code in set(line.get(key) or []):
+                    index[code].append(line['_id'])
+
+    def __len__(self):
+        return len(self.lines)
+
+    def candidates(self, key, codes):
+        """
+        :param key: airline, origin or destination key
+        :param codes: list of codes (without '*')
+        :return: list of the ids of the lines having one of the codes or '*' for this key
+        """
+        index = self.by_code[key]
+        ids = []
+        for code in set(codes) | {'*'}:
+            ids.extend(index.get(code, ()))
+        return ids
+
+    def nb_candidates(self, key, codes):
+        index = self.by_code[key]
+        return sum(len(index.get(code, ())) for code in set(codes) | {'*'})
+
+    def rules(self, source):
+        """
+        Codes allowed for the other lines by a source line, as lists of (field of the other line, allowed codes)
+        :return: tuple (year_months, airline rules, same direction rules, opposite direction rules)
+        """
+        def allowed(key):
+            return set(source[key]) | {'*'}
+        airline = [(self.airline_key, allowed(self.airline_key))] if source[self.airline_key][0] != '*' else []
+        direct = [(k, allowed(k)) for k in (self.origin_key, self.destination_key) if source[k][0] != '*']
+        opposite = [(k, allowed(r)) for k, r in ((self.origin_key, self.destination_key),
+                                                (self.destination_key, self.origin_key)) if source[r][0] != '*']
+        return set(source['year_month']), airline, direct, opposite
+
+    def matches(self, source, target, rules=None):
+        """
+        Same rules as the query of a source line over the other lines
+        :param rules: result of self.rules(source), if already computed
+        :return: True if target overlaps source
+        """
+        year_months, airline, direct, opposite = rules or self.rules(source)
+        if target['_id'] == source['_id']:
+            return False
+        if not intersects(target.get('year_month') or [], year_months):
+            return False
+        if not all(intersects(target.get(k) or [], codes) for k, codes in airline):
+            return False
+        if not direct:
+            return True
+        if all(intersects(target.get(k) or [], codes) for k, codes in direct):
+            return True
+        if not source.get('both_ways') and target.get('both_ways') is not True:
+            return False
+        return all(intersects(target.get(k) or [], codes) for k, codes in opposite)
+
+    def source_candidates(self, source):
+        """
+        Ids of the lines that may overlap the source: the lines sharing its origin or destination (in both directions),
+        or its airline if it has no origin nor destination
+        """
+        od = [k for k in (self.origin_key, self.destination_key) if source[k][0] != '*']
+        if od:
+            # Same direction, using the most selective of origin/destination
+            key = min(od, key=lambda k: self.nb_candidates(k, source[k]))
+            ids = set(self.candidates(key, source[key]))
+            # Opposite direction: the origin of the other line is the destination of the source, and vice versa
+            reverse = {self.origin_key: self.destination_key, self.destination_key: self.origin_key}
+            key = min(od, key=lambda k: self.nb_candidates(reverse[k], source[k]))
+            ids.update(self.candidates(reverse[key], source[key]))
+            return ids
+        if source[self.airline_key][0] != '*':
+            return set(self.candidates(self.airline_key, source[self.airline_key]))
+        return set(self.lines)
+
+    def overlaps(self, sources=None):
+        """
+        :param sources: ids of the source lines (all the lines by default)
+        :return: dict {target id: set of the ids of the sources overlapping it}, the value that was added to the
+        'overlap' field of the target by the former queries
+        """
+        result = defaultdict(set)
+        for source_id in (sources if sources is not None else self.lines):
+            source = self.lines[source_id]
+            rules = self.rules(source)
+            for target_id in self.source_candidates(source):
+                if self.matches(source, self.lines[target_id], rules):
+                    result[target_id].add(source_id)
+        return result
+
+
+def overlap_components(lines):
+    """
+    :param lines: dict {id: line}, the lines with an 'overlap' field (list of the ids of the lines they overlap)
+    :return: tuple (dict {id: set of the ids of the overlapping lines}, in both directions and restricted to the given
+    lines, list of the connected components of this graph, as lists of ids)
+    """
+    neighbours = dict((line_id, set()) for line_id in lines)
+    for line_id, line in lines.items():
+        for other_id in line.get('overlap') or []:
+            if other_id in neighbours and other_id != line_id:
+                neighbours[line_id].add(other_id)
+                neighbours[other_id].add(line_id)
+
+    components = []
+    seen = set()
+    for line_id in sorted(lines):
+        if line_id in seen:
+            continue
+        seen.add(line_id)
+        component, stack = [], [line_id]
+        while stack:
+            current = stack.pop()
+            component.append(current)
+            for other_id in neighbours[current]:
+                if other_id not in seen:
+                    seen.add(other_id)
+                    stack.append(other_id)
+        components.append(component)
+    return neighbours, components
+
+
+def resolve_overlaps(lines, confidence):
+    """
+    Choose the lines to keep among overlapping lines. In each connected component of the overlap graph, the lines are
+    taken by decreasing confidence of their provider (then by id), and a line is kept if none of the lines it overlaps
+    has been kept already: the lines of the most trusted providers are kept, and no two kept lines overlap.
+    :param lines: dict {id: line}, the lines with 'provider' and 'overlap' fields
+    :param confidence: dict {provider: confidence index}
+    :return: tuple (set of the ids of the lines to keep, list of the connected components)
+    """
+    neighbours, components = overlap_components(lines)
+
+    def priority(line_id):
+        index = confidence.get(lines[line_id]['provider'])
+        return index is None, -(index or 0), line_id
+
+    kept = set()
+    for component in components:
+        for line_id in sorted(component, key=priority):
+            if not neighbours[line_id] & kept:
+                kept.add(line_id)
+    return kept, components
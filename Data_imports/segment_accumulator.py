@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / segment_accumulator
+# Purpose:     Sum passengers of the lines of a file that share the same (origin, destination, year_month, airline)
+#              tuple, and send each summed line to the bulk only once per file.
+#              Replaces the 'previous_data' DataFrame that was scanned and appended for each row of the files.
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+
+query_keys = ('origin', 'destination', 'year_month', 'provider', 'data_type', 'airline')
+
+
+class SegmentAccumulator(object):
+    """
+    Dictionary of the lines already read in a file, keyed by a hashable tuple (usually origin, destination,
+    year_month, airline, and possibly the airline_ref_code).
+    For each key, keep the summed passengers and the record of the latest line, which is the one that would have
+    ended up in the database with the former row-by-row upserts.
+    """
+    def __init__(self):
+        self.records = dict()
+        self.passengers = dict()
+
+    def __contains__(self, key):
+        return key in self.passengers
+
+    def __len__(self):
+        return len(self.passengers)
+
+    def get(self, key, default=0):
+        """
+        :param key: tuple
+        :param default: value returned if the key was never added
+        :return: summed passengers for the key
+        """
+        return self.passengers.get(key, default)
+
+    def add(self, key, pax, record):
+        """
+        Add the passengers of a line to the ones already stored for the same key, and keep its record
+        :param key: tuple
+        :param pax: integer
+        :param record: dict to be upserted in external_segment (its 'total_pax' is overwritten by the sum)
+        :return: the summed passengers for the key
+        """
+        total_pax = self.passengers.get(key, 0) + pax
+        self.passengers[key] = total_pax
+        self.records[key] = record
+        return total_pax
+
+    def iter_records(self):
+        """
+        :return: generator of the records, with 'total_pax' set to the sum of all the lines of the key
+        """
+        for key, record in self.records.items():
+            record['total_pax'] = self.passengers[key]
+            yield record
+
+    def upsert(self, bulk, now):
+        """
+        Send all the summed records to the bulk, one upsert per key
+        :param bulk: bulk of the external_segment collection
+        :param now: datetime of the import
+        :return: number of records sent
+        """
+        nb = 0
+        for dic in self.iter_records():
+            query = dict((k, dic[k]) for k in query_keys)
+            bulk.find(query).upsert().update_one({'$set': dict(dic, modified=now), '$setOnInsert': dict(inserted=now)})
+            nb += 1
+        return nb
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / segment_totals
+# Purpose:     Passengers and revenue of the segments of new_segment_initial_data, summed once per
+#              (year_month, operating_airline, leg_origin, leg_destination) with a single aggregation, and kept in
+#              memory to answer the sums that were asked to the database for each external line.
+#              Sums are resolved from the same match dictionaries (see get_match in treat_sources_scope), so that
+#              the results are identical to an aggregation with these matches.
+#              SegmentGroups also keeps the segments themselves (passengers, revenue and dates of the updates already
+#              applied), to join the external lines to the segments they are spread over.
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import logging
+import math
+from collections import defaultdict
+
+log = logging.getLogger('segment_totals')
+
+key_fields = ('year_month', 'operating_airline', 'leg_origin', 'leg_destination')
+# Fields of the segments loaded by SegmentGroups
+segment_fields = key_fields + ('passengers', 'segment_revenue_usd', 'updated.data_date')
+
+
+class SegmentTotals(object):
+    """
+    Summed passengers and revenue per (year_month, operating_airline, leg_origin, leg_destination), indexed by
+    year_month, by (year_month, origin), by (year_month, destination) and by (year_month, origin, destination)
+    """
+    def __init__(self, totals):
+        """
+        :param totals: iterable of dicts with the key_fields, 'pax' and 'revenue'
+        """
+        self.totals = dict()
+        self.by_ym = defaultdict(list)
+        self.by_origin = defaultdict(list)
+        self.by_destination = defaultdict(list)
+        self.by_od = defaultdict(list)
+        for total in totals:
+            key = tuple(total[k] for k in key_fields)
+            ym, _, origin, destination = key
+            self.totals[key] = (total.get('pax') or 0, total.get('revenue') or 0)
+            self.by_ym[ym].append(key)
+            self.by_origin[(ym, origin)].append(key)
+            self.by_destination[(ym, destination)].append(key)
+            self.by_od[(ym, origin, destination)].append(key)
+
+    def __len__(self):
+        return len(self.totals)
+
+    @classmethod
+    def from_db(cls, segment_model, year_months):
+        """
+        :param segment_model: model of the new_segment_initial_data collection
+        :param year_months: list of year_months (YYYY-MM)
+        :return: SegmentTotals of the segments (record_ok) of the year_months
+        """
+        group = {'_id': dict((k, '$%s' % k) for k in key_fields),
+                 'pax': {'$sum': '$passengers'}, 'revenue': {'$sum': '$segment_revenue_usd'}}
+        totals = segment_model.aggregate([
+            {'$match': {'record_ok': True, 'year_month': {'$in': list(year_months)}}},
+            {'$group': group}
+        ])
+
+        def process_total(total):
+            total.update(total.pop('_id'))
+            return total
+
+        result = cls(process_total(total) for total in totals)
+        log.info('%d segment totals loaded for %s', len(result), year_months)
+        return result
+
+    def branch_keys(self, ym, branch):
+        """
+        :param ym: year_month
+        :param branch: dict with optional 'leg_origin' and 'leg_destination' {'$in': [...]} conditions
+        :return: list of the keys of the year_month satisfying the conditions
+        """
+        origins = branch.get('leg_origin', {}).get('$in')
+        destinations = branch.get('leg_destination', {}).get('$in')
+        if origins is not None and destinations is not None:
+            return [key for o in set(origins) for d in set(destinations) for key in self.by_od.get((ym, o, d), ())]
+        if origins is not None:
+            return [key for o in set(origins) for key in self.by_origin.get((ym, o), ())]
+        if destinations is not None:
+            return [key for d in set(destinations) for key in self.by_destination.get((ym, d), ())]
+        return self.by_ym.get(ym, [])
+
+    def keys(self, match):
+        """
+        :param match: dict returned by get_match(unique) (for segments, without ref_code)
+        :return: set of the keys of the segments satisfying the match
+        """
+        unsupported = set(match) - {'record_ok', 'year_month', 'operating_airline', 'leg_origin', 'leg_destination',
+                                    '$or'}
+        if unsupported:
+            raise ValueError('Unsupported conditions in match: %s' % sorted(unsupported))
+        if '$or' in match:
+            branches = match['$or']
+        else:
+            branches = [dict((k, v) for k, v in match.items() if k in ('leg_origin', 'leg_destination'))]
+        airlines = set(match['operating_airline']['$in']) if 'operating_airline' in match else None
+
+        keys = set()
+        for ym in set(match['year_month']['$in']):
+            for branch in branches:
+                keys.update(key for key in self.branch_keys(ym, branch) if airlines is None or key[1] in airlines)
+        return keys
+
+    def sums(self, match):
+        """
+        :param match: dict returned by get_match(unique)
+        :return: tuple (passengers, revenue) summed over the matching segments, or None if no segment matches
+        """
+        keys = self.keys(match)
+        if not keys:
+            return None
+        pax = sum(self.totals[key][0] for key in keys)
+        revenue = math.fsum(self.totals[key][1] for key in keys)
+        return pax, revenue
+
+
+class SegmentGroups(SegmentTotals):
+    """
+    Segments grouped per (year_month, operating_airline, leg_origin, leg_destination), with their totals
+    """
+    def __init__(self, segments):
+        """
+        :param segments: iterable of dict-like records with '_id' and the segment_fields
+        """
+        self.segments = defaultdict(list)
+        for segment in segments:
+            self.segments[tuple(segment[k] for k in key_fields)].append(segment)
+        super(SegmentGroups, self).__init__(
+            dict(zip(key_fields, key),
+                 pax=sum(s.get('passengers') or 0 for s in group),
+                 revenue=math.fsum(s.get('segment_revenue_usd') or 0 for s in group))
+            for key, group in self.segments.items())
+
+    @classmethod
+    def from_db(cls, segment_model, year_months, query=None):
+        """
+        :param segment_model: model of the new_segment_initial_data collection
+        :param year_months: list of year_months (YYYY-MM)
+        :param query: optional additional conditions on the segments
+        :return: SegmentGroups of the segments (record_ok) of the year_months
+        """
+        segments = segment_model.find(dict(query or {}, record_ok=True, year_month={'$in': list(year_months)}),
+                                      dict((k, 1) for k in segment_fields))
+        result = cls(segments)
+        log.info('%d segments loaded in %d groups for %s', sum(len(g) for g in result.segments.values()),
+                 len(result), year_months)
+        return result
+
+    def matching(self, match):
+        """
+        :param match: dict returned by get_match(unique)
+        :return: list of the segments satisfying the match
+        """
+        return [segment for key in self.keys(match) for segment in self.segments[key]]
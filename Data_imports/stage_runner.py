@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# -------------------------------------------------------------------------------
+# Name:        Optimode / stage_runner
+# Purpose:     Run the stages of a long program with their progress saved in the database, so that an interrupted run
+#              can be started again from where it stopped:
+#              - a stage done in full is recorded when it ends, and skipped when the run is resumed
+#              - a stage working on many records processes them in batches, in the order of their _id, and records
+#                the last _id of each batch once the batch is saved: a resumed stage starts after this _id
+#              The throughput and the estimated end of the running stage are logged and saved with the progress.
+#
+# Author:      berder
+#
+# Created:     18/10/2026
+# Copyright:   (c) Arsynet 2015
+# Licence:     Tous droits réservés
+# -------------------------------------------------------------------------------
+
+from __future__ import print_function, division
+import logging
+import time
+from datetime import timedelta
+from utils import utcnow
+
+log = logging.getLogger('stage_runner')
+
+
+class StageRunner(object):
+    """
+    Progress of a run, saved in a document of the runs collection:
+        {<run keys>, name, status, started, stages: {<stage>: {status, nb_items, nb_done, last_id, throughput, eta...}}}
+    """
+    def __init__(self, run_model, run, name=None, restart=False):
+        """
+        :param run_model: model of the collection where the runs are saved
+        :param run: dict of the keys of the run (ex: {'program': 'treat_sources_scope', 'year_month': '2016-01'})
+        :param name: name of the run. A run with this name is resumed (if finished, all its stages are skipped).
+        Without name, the last unfinished run with the same keys is resumed, or a new run is started.
+        :param restart: if True, start a new run even if an unfinished one exists
+        """
+        self.run_model = run_model
+        existing = None
+        if name is not None:
+            existing = run_model.find_one(dict(run, name=name))
+        elif not restart:
+            existing = run_model.find_one(dict(run, status={'$in': ['running', 'failed']}))
+        if existing and restart:
+            run_model.update(query=dict(run, name=name), update={'$set': {'stages': {}}})
+            existing['stages'] = {}
+        if existing:
+            self.query = dict(run, name=existing['name'])
+            self.stages = existing.get('stages') or {}
+            log.info('Resuming run %r, stages done: %s', existing['name'],
+                     [k for k, v in self.stages.items() if v.get('status') == 'done'])
+        else:
+            self.query = dict(run, name=name or utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'))
+            self.stages = {}
+            log.info('New run %r', self.query['name'])
+        run_model.update(query=self.query, update={'$set': {'status': 'running'},
+                                                   '$setOnInsert': {'started': utcnow(), 'stages': {}}}, upsert=True)
+
+    def save(self, stage, **values):
+        self.stages.setdefault(stage, {}).update(values)
+        self.run_model.update(query=self.query,
+                              update={'$set': dict(('stages.%s.%s' % (stage, k), v) for k, v in values.items())})
+
+    def is_done(self, stage):
+        return self.stages.get(stage, {}).get('status') == 'done'
+
+    def run_stage(self, stage, function, *args):
+        """
+        Run function(*args), unless the stage is already done in this run
+        :return: result of the function, None if skipped
+        """
+        if self.is_done(stage):
+            log.info('Stage %s already done, skipped', stage)
+            return None
+        start = time.time()
+        self.save(stage, status='running', started=utcnow())
+        try:
+            result = function(*args)
+        except Exception as e:
+            self.save(stage, status='failed', error=repr(e))
+            raise
+        self.save(stage, status='done', finished=utcnow(), wall_time=time.time() - start)
+        return result
+
+    def interrupted(self, stage):
+        """
+        :return: True if the stage was started by a former execution of the run, and did not finish
+        """
+        return self.stages.get(stage, {}).get('status') in ('running', 'failed')
+
+    def split(self, stage, items):
+        """
+        :param items: list of records with an '_id'
+        :return: tuple (items done by the former executions of the run, items to do), sorted by _id
+        """
+        items = sorted(items, key=lambda item: item['_id'])
+        if self.is_done(stage):
+            return items, []
+        last_id = self.stages.get(stage, {}).get('last_id')
+        if last_id is None:
+            return [], items
+        return [item for item in items if item['_id'] <= last_id], [item for item in items if item['_id'] > last_id]
+
+    def run_batches(self, stage, items, process_batch, batch_size=1000):
+        """
+        Process the items in batches, in the order of their _id. process_batch(batch) must have saved all its changes
+        when it returns: the batch is then recorded as done, and will not be processed again if the run is resumed.
+        :param items: list of records with an '_id'
+        :param process_batch: function(list of records)
+        :param batch_size: number of items per batch
+        """
+        if self.is_done(stage):
+            log.info('Stage %s already done, skipped', stage)
+            return
+        done, todo = self.split(stage, items)
+        nb_done, nb_items = len(done), len(done) + len(todo)
+        if nb_done:
+            log.info('Stage %s resumed after %d of %d items', stage, nb_done, nb_items)
+        self.save(stage, status='running', nb_items=nb_items, nb_done=nb_done,
+                  started=self.stages.get(stage, {}).get('started') or utcnow())
+
+        start = time.time()
+        for i in range(0, len(todo), batch_size):
+            batch = todo[i:i + batch_size]
+            try:
+                process_batch(batch)
+            except Exception as e:
+                self.save(stage, status='failed', error=repr(e))
+                raise
+            nb_done += len(batch)
+            throughput = (i + len(batch)) / max(time.time() - start, 1e-6)
+            eta = utcnow() + timedelta(seconds=(nb_items - nb_done) / throughput)
+            self.save(stage, last_id=batch[-1]['_id'], nb_done=nb_done, throughput=throughput, eta=eta)
+            log.info('%s: %d/%d (%.1f%%), %.1f items/s, end expected at %s', stage, nb_done, nb_items,
+                     nb_done / max(nb_items, 1) * 100, throughput, eta.strftime('%H:%M:%S'))
+        self.save(stage, status='done', finished=utcnow())
+
+    def finish(self, status='done'):
+        self.run_model.update(query=self.query, update={'$set': {'status': status, 'finished': utcnow()}})
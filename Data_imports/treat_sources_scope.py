@@ -4,6 +4,7 @@
 # Name:        Optimode / treat_sources_scope
 # Purpose:     For a given year_month, check all external sources, calculate ratio for non-overlapping data,
 #              spread mass to calculate new passenger counts and revenues, and save in new_segments_initial_data.
+#              A range of year_months can be treated at once, several year_months at the same time.
 #
 # Author:      berder
 #
@@ -17,19 +18,27 @@ import time
 import argparse
 import logging
 import logging.handlers
+import multiprocessing
 import os
+import numpy as np
 import pandas as pd
 import sys
+import traceback
+from collections import defaultdict
 sys.path.append('../')
 from optidb.model import *
 from utils import YearMonth, utcnow
-from utils.threads import Lock, ThreadPool
 from utils.logging_utils import BackupFileHandler
+from overlap_index import OverlapIndex, overlap_components, projection_fields, resolve_overlaps
+from segment_totals import SegmentGroups, SegmentTotals
+from capacity_cube import get_capacity_cube
+from stage_runner import StageRunner
+from bulk_writer import BulkWriter
+from change_journal import ChangeJournal
 
 now = utcnow()
-lock = Lock()
 
-__version__ = 'V1.0.2'
+__version__ = 'V1.4.0'
 
 
 class External_Segment_Tmp(Model):
@@ -44,6 +53,14 @@ class Scopes_Tmp(Model):
     __collection__ = 'external_sources_scopes'
 
 
+class Scope_Journal(Model):
+    __collection__ = 'external_sources_scope_journal'
+
+
+class Scope_Run(Model):
+    __collection__ = 'external_sources_scope_runs'
+
+
 def reset_overlaps(year_month, providers):
     """
     If 'reset_overlap' argument is given, delete all the values of overlap on the corresponding year_month for the
@@ -55,130 +72,202 @@ def reset_overlaps(year_month, providers):
     log.info("Resetting all overlaps")
     reset = External_Segment_Tmp.update({'year_month': year_month,
                                          'provider': {'$in': providers}},
-                                        {'$unset': {'overlap': 1}}, multi=True)
+                                        {'$unset': {'overlap': 1, 'overlap_group': 1}}, multi=True)
     log.info("Number of records reset: %r", reset)
 
 
+def reset_and_identify_overlaps(year_month, providers, reset):
+    """
+    Identify overlaps, after deleting all previously identified ones if reset
+    """
+    if reset:
+        reset_overlaps(year_month, providers)
+    identify_overlaps(year_month, providers)
+
+
+def load_overlaps(year_month, providers):
+    """
+    Load the lines of the year_month (and of the other year_months of these lines) and find their overlaps in memory
+    (see overlap_index)
+    :param year_month: string (YYYY-MM)
+    :param providers: list
+    :return: tuple (list of the lines of the year_month, dict {target id: set of the ids of the lines overlapping it})
+    """
+    keys = ('airline', 'origin', 'destination')
+    projection = dict((k, 1) for k in keys + projection_fields + ('overlap_group', 'inserted', 'modified'))
+    query = {'year_month': year_month, 'provider': {'$in': providers}}
+    lines = list(External_Segment_Tmp.find(query, projection))
+    sources = [line['_id'] for line in lines]
+    log.info("Identifying overlaps over %d new lines", len(sources))
+    # The lines of the other year_months of the sources (if any) can also be overlapped
+    other_lines = []
+    other_year_months = list(set(ym for line in lines for ym in line['year_month']) - {year_month})
+    if other_year_months:
+        query = {'year_month': {'$in': other_year_months, '$ne': year_month}, 'provider': {'$in': providers}}
+        other_lines = list(External_Segment_Tmp.find(query, projection))
+
+    start = utcnow()
+    index = OverlapIndex(lines + other_lines, *keys)
+    overlaps = index.overlaps(sources)
+    log.info('%d lines overlapped by %d overlaps (%s)', len(overlaps), sum(len(v) for v in overlaps.values()),
+             utcnow() - start)
+    return lines, overlaps
+
+
 def identify_overlaps(year_month, providers):
     """
-    For each line, check if there are overlapping scopes (origin, destination, airline) with the following lines
+    For each line, check if there are overlapping scopes (origin, destination, airline) with the other lines
     and if so, associate the records' id to each other.
-    Only do so for the shortlisted providers
+    Only do so for the shortlisted providers.
+    The lines are loaded once and indexed by their codes to find the overlaps in memory (see overlap_index), then
+    the 'overlap' arrays are written in a single bulk.
     :param year_month: string (YYYY-MM)
     :param providers: list
     :return:
     """
-    query = {'year_month': year_month, 'provider': {'$in': providers}}
-    sources_cursor = External_Segment_Tmp.find(query)
-    nb_sources = sources_cursor.count()
-    pct_sources = nb_sources / 100
-    log.info("Identifying overlaps over %d new lines", nb_sources)
-
-    with ThreadPool(20) as pool:
-        def process_source(source, i):
-            # build query
-            start = utcnow()
-            query = dict(provider={'$in': providers},
-                         year_month={'$in': source.year_month},
-                         _id={'$ne': source._id},
-                         )
-
-            if source.airline[0] != '*':
-                query['airline'] = {'$in': source.airline + ['*']}
-
-            query_od = dict((k, {'$in': source[k] + ['*']})
-                            for k in ('origin', 'destination')
-                            if source[k][0] != '*')
-
-            if query_od:
-                query_od_return = dict((k, {'$in': source[r] + ['*']})
-                                       for k, r in (('origin', 'destination'), ('destination', 'origin'))
-                                       if source[r][0] != '*')
-                if not source.both_ways:
-                    query_od_return['both_ways'] = True
-
-                query['$or'] = [query_od, query_od_return]
-
-            update = {'$addToSet': dict(overlap=source._id)}
-            result = External_Segment_Tmp.update(query, update, multi=True)
-            end = utcnow()
-            log.info('Update overlaps %d (%ss) - %r', i, end-start, result)
-
-        for i, source in enumerate(sources_cursor, 1):
-            if i % 1000 == 0:
-                log.info('Processed %dk records (%.1f%%)', i // 1000, i / pct_sources)
-            # Parallelize process 20 times
-            pool.add_task(process_source, source, i)
+    _, overlaps = load_overlaps(year_month, providers)
+
+    def log_bulk(self):
+        log.info('  store overlaps: %r', self.nresult)
+
+    with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
+        for target_id, source_ids in overlaps.items():
+            bulk.find({'_id': target_id}).update_one({'$addToSet': {'overlap': {'$each': list(source_ids)}}})
 
     log.info('end identify_overlap')
     return
 
 
+def get_providers_confidence(year_month):
+    """
+    :return: dict {provider: confidence index} of the providers having an index for the year_month
+    """
+    return dict((x['provider'], x['index']['confidence'])
+                for x in Provider.find({'index.ym_start': {'$lte': year_month}}))
+
+
 def treat_overlaps(year_month, providers):
     """
-    Loop over all the records marked as overlaps, compare record's providers and their confidence index,
-    and remove the 'overlap' mark on the records coming from the most trusted sources.
+    Compare the providers of the records marked as overlaps and their confidence index, and remove the 'overlap' mark
+    on the records coming from the most trusted sources.
+    The overlaps form a graph, resolved in memory component by component (see overlap_index.resolve_overlaps): the
+    result does not depend on the order of the records.
+    The lines of a group of overlapping lines (component) are marked with the same 'overlap_group', used by the
+    incremental treatment to find the lines to treat again when one of them changes.
     :param year_month: string (YYYY-MM)
     :param providers: list
     :return:
     """
-    providers_confidence = dict((x['provider'], x['index']['confidence'])
-                                for x in Provider.find({'index.ym_start': {'$lte': year_month}}))
+    providers_confidence = get_providers_confidence(year_month)
     query = {'year_month': year_month, 'provider': {'$in': providers}, 'overlap': {'$ne': None}}
-    overlaps_dict = dict((x._id, x) for x in External_Segment_Tmp.find(query))
+    overlaps_dict = dict((x['_id'], x) for x in External_Segment_Tmp.find(query, {'provider': 1, 'overlap': 1}))
+
+    kept, components = resolve_overlaps(overlaps_dict, providers_confidence)
+    log.info('%d overlapping records in %d groups (largest: %d), %d kept', len(overlaps_dict), len(components),
+             max(len(c) for c in components) if components else 0, len(kept))
 
     def log_bulk(self):
         log.info('  treating overlaps: %r', self.nresult)
 
-    with External_Segment_Tmp.unordered_bulk(100, execute_callback=log_bulk) as bulk:
-
-        for record in overlaps_dict.values():
-            # Skip the lines that were already treated
-            if record['overlap'] is None:
-                continue
-            # If it's a one-for-one overlap, only keep the data from the higher indexed source
-            # (remove the 'overlap' from this record)
-            if len(record['overlap']) == 1:
-                # Get the confidence index of both providers to compare
-                other_provider = overlaps_dict.get(record['overlap'][0])['provider']
-                if providers_confidence.get(record['provider']) >=  providers_confidence.get(other_provider):
-                    # Delete the 'overlap' mention (effectively keeping this data for further integration)
-                    bulk.find({'_id': record['_id']}).update_one({'$unset': {'overlap': 1}})
-                    # Mark the other record to be skipped
-                    overlaps_dict.get(record['overlap'][0])['overlap'] = None
-                # else:
-                    # Delete the 'overlap' mention (effectively keeping this data for further integration) of the other record
-                    bulk.find({'_id': overlaps_dict.get(record['overlap'][0])['overlap']}).update_one({'$unset': {'overlap': 1}})
-
-            # For one-to-many overlaps, first check if the current one has a higher indexed source
-            else:
-                # Store in a list all the lines concerned by the overlap:
-                grouped_routes = [External_Segment_Tmp.find_one({'_id': n}) for n in record['overlap']]
-                grouped_routes.append(record)
-
-                # Look for the providers and determine which one has the highest confidence index
-                concerned_providers = [overlaps_dict.get(n)['provider'] for n in record['overlap']]
-                concerned_providers.append(record['provider'])
-                concerned_providers = set(concerned_providers)
-                indexes = [providers_confidence.get(n) for n in concerned_providers]
-
-                if not any(providers_confidence.get(record['provider']) < providers_confidence.get(x) for x in
-                           concerned_providers):
-                    # Delete the 'overlap' mention (effectively keeping this data for further integration)
-                    bulk.find({'_id': record['_id']}).update_one({'$unset': {'overlap': 1}})
-                    # Mark the other record to be skipped
-                    for ov in record['overlap']:
-                        overlaps_dict.get(ov)['overlap'] = None
-                else:
-                    # If the higher indexed source is the current one, then then remove 'overlap' from the others
-                    bulk.find({'_id': {'$in': record['overlap']}}).update_one({'$unset': {'overlap': 1}})
-                    # Mark the other records to be skipped
-                    for ov in record['overlap']:
-                        overlaps_dict.get(ov)['overlap'] = None
-                    continue
+    with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
+        for component in components:
+            for record_id in sorted(component):
+                bulk.find({'_id': record_id}).update_one(overlap_update(record_id, None, kept, component))
     log.info('end treatment of overlaps: %r', bulk.nresult)
 
 
+def overlap_update(record_id, overlap, kept, component):
+    """
+    :param record_id: id of a line
+    :param overlap: list of the ids of the lines overlapping it, to save if it is not kept (None: left as is)
+    :param kept: set of the ids of the lines kept
+    :param component: list of the ids of the group of overlapping lines of the line
+    :return: update of the line
+    """
+    update = {'$set': {}, '$unset': {}}
+    if record_id in kept:
+        # Delete the 'overlap' mention (effectively keeping this data for further integration)
+        update['$unset']['overlap'] = 1
+    elif overlap is not None:
+        update['$set']['overlap'] = overlap
+    if len(component) > 1:
+        update['$set']['overlap_group'] = min(component)
+    else:
+        update['$unset']['overlap_group'] = 1
+    return dict((k, v) for k, v in update.items() if v)
+
+
+def last_successful_run(year_month):
+    """
+    :param year_month: string (YYYY-MM)
+    :return: start date of the last run of the year_month that finished successfully, None if there is none
+    """
+    result = list(Scope_Run.aggregate([
+        {'$match': {'program': 'treat_sources_scope', 'year_month': year_month, 'status': 'done'}},
+        {'$group': {'_id': None, 'started': {'$max': '$started'}}}
+    ]))
+    return result[0]['started'] if result else None
+
+
+def treat_changed_overlaps(year_month, providers, since, run):
+    """
+    Incremental version of identify_overlaps and treat_overlaps: only the groups of overlapping lines that contain a
+    line inserted or modified since the last run are resolved again, with the groups these lines belonged to before
+    (their 'overlap_group'). The 'overlap' field of the lines of these groups is replaced by the overlaps found now.
+    :param year_month: string (YYYY-MM)
+    :param providers: list
+    :param since: date of the last successful run
+    :param run: name of the run, for the journal of the segments removed
+    :return: list of the ids of the lines of the groups treated, whose ratios and segments must be treated again
+    """
+    lines, overlaps = load_overlaps(year_month, providers)
+    changed = set(line['_id'] for line in lines
+                  if any(line.get(k) and line[k] >= since for k in ('inserted', 'modified')))
+    former_groups = set(line['overlap_group'] for line in lines
+                        if line['_id'] in changed and line.get('overlap_group') is not None)
+    seeds = changed | set(line['_id'] for line in lines if line.get('overlap_group') in former_groups)
+    log.info('%d lines changed since %s, %d lines with their former groups', len(changed), since, len(seeds))
+
+    # Same graph as treat_overlaps: the lines overlapped by other lines
+    graph = dict((line['_id'], dict(provider=line['provider'], overlap=sorted(overlaps[line['_id']])))
+                 for line in lines if overlaps.get(line['_id']))
+    _, components = overlap_components(graph)
+    components = [component for component in components if seeds.intersection(component)]
+    in_graph = set(line_id for component in components for line_id in component)
+    kept, components = resolve_overlaps(dict((line_id, graph[line_id]) for line_id in in_graph),
+                                        get_providers_confidence(year_month))
+    # The seeds that do not overlap any line any more are kept alone
+    for line_id in sorted(seeds - in_graph):
+        kept.add(line_id)
+        components.append([line_id])
+    ids = sorted(line_id for component in components for line_id in component)
+    log.info('%d lines in %d groups to treat again, %d kept', len(ids), len(components), len(kept))
+
+    def log_bulk(self):
+        log.info('  treating changed overlaps: %r', self.nresult)
+
+    with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
+        for component in components:
+            for line_id in sorted(component):
+                overlap = graph[line_id]['overlap'] if line_id in graph else None
+                bulk.find({'_id': line_id}).update_one(overlap_update(line_id, overlap, kept, component))
+
+    # The updates of the segments by the lines that are not kept any more are not undone here (see undo)
+    dropped = [line_id for line_id in ids if line_id not in kept]
+    nb_updated = NewSegmentInitialData.find({'updated.external_record._id': {'$in': dropped}}).count() if dropped else 0
+    if nb_updated:
+        log.warning('%d segments were updated by %d lines that are now overlapped by more trusted lines',
+                    nb_updated, len(dropped))
+
+    # The segments created by the lines are created again when spreading
+    with ChangeJournal(Scope_Journal, run, year_month) as journal:
+        result = journal.remove(NewSegmentInitialData,
+                                {'source': 'external_source',
+                                 'loaded_from_record': {'$in': [{'_id': line_id} for line_id in ids]}})
+    log.info('Removed the segments created by the lines treated again: %r', result)
+    return ids
+
+
 def get_match(unique, for_segments=True, with_ref_code=False):
     """
     Determine query match for different cases in this program
@@ -215,120 +304,113 @@ def get_airlines_parents():
     return dict((c.code, c.parent) for c in Company.find(query))
 
 
-def calculate_ratios():
+def calculate_ratios(ids=None):
     """
     For all the external segment lines that do not contain overlap, compare the sum of passengers (and revenue if existing)
     to the sum of passengers (and revenue) of the existing segments that the line will have an impact on.
     Calculate the ratio between the sums, and save in the external_segment line
+    :param ids: ids of the lines to treat (incremental run), all the lines of the year_month by default
     :return:
     """
-    uniques_cursor = External_Segment_Tmp.find({'year_month': year_month,
-                                                'overlap': {'$in': [None, []]},
-                                                'provider': {'$in': providers}})
+    query = {'year_month': year_month, 'overlap': {'$in': [None, []]}, 'provider': {'$in': providers}}
+    if ids is not None:
+        query['_id'] = {'$in': ids}
+    uniques_cursor = External_Segment_Tmp.find(query)
     log.info("Calculating ratios on %d non-overlapping data", uniques_cursor.count())
 
     def log_bulk(self):
         log.info('  saving ratios: %r', self.nresult)
 
-    with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk, ThreadPool(20) as pool:
+    uniques = list(uniques_cursor)
+    # Segments summed once per (year_month, airline, origin, destination), instead of one aggregation per line
+    totals = SegmentTotals.from_db(NewSegmentInitialData, {ym for unique in uniques for ym in unique['year_month']})
 
-        def calculate_single_ratio(unique):
+    # The ratios are written by the thread of the writer while the next ones are calculated
+    with BulkWriter(External_Segment_Tmp, 1000, execute_callback=log_bulk) as bulk:
+        for unique in uniques:
             ratio = {}
-            match = get_match(unique)
-
-            sum_pax = list(NewSegmentInitialData.aggregate([
-                {'$match': match},
-                {'$group': {
-                    '_id': None,
-                    'pax': {'$sum': '$passengers'}, 'revenue': {'$sum': '$segment_revenue_usd'}
-                }
-                }
-            ]))
-            if len(sum_pax) == 0 or sum_pax[0].get('pax') == 0:
+            sums = totals.sums(get_match(unique))
+            if sums is None or sums[0] == 0:
                 ratio['pax_ratio'] = None
             else:
-                ratio['pax_ratio'] = unique['total_pax'] / sum_pax[0].get('pax')
-                if not unique.get('revenue') or unique.get('revenue') == 0:
+                ratio['pax_ratio'] = unique['total_pax'] / sums[0]
+                if not unique.get('revenue') or unique.get('revenue') == 0 or sums[1] == 0:
                     ratio['rev_ratio'] = None
                 else:
-                    ratio['rev_ratio'] = unique['revenue'] / sum_pax[0].get('revenue')
-
-            with lock:
-                bulk.find(unique.__id_dict__).update_one({'$set': {'ratio': ratio}})
+                    ratio['rev_ratio'] = unique['revenue'] / sums[1]
 
-        for unique in uniques_cursor:
-            pool.add_task(calculate_single_ratio, unique)
+            bulk.find(unique.__id_dict__).update_one({'$set': {'ratio': ratio}})
 
     log.info('end calculate ratios: %r', bulk.nresult)
 
 
 def aggregate_capa(dat):
+    """
+    :param dat: a line of external_segment
+    :return: list of the positive capacities of the line, summed per origin, destination, operating_airline_ref_code,
+    operating_airline and year_month (taken from the capacity cube of the run)
+    """
     match = get_match(dat, for_segments=False, with_ref_code=True)
     match.update(active_rec=True, capacity={'$gt': 0})
+    return get_capacity_cube(CapacityInitialData).capacities(match)
 
-    group = {'_id': {'origin': '$origin',
-                     'destination': '$destination',
-                     'operating_airline_ref_code': '$operating_airline_ref_code',
-                     'operating_airline': '$operating_airline',
-                     'year_month': '$year_month'},
-             'capacity': {'$sum': '$capacity'}}
 
-    capas = CapacityInitialData.aggregate([
-        {'$match': match},
-        {'$group': group}
-    ])
-
-    def process_capa(capa):
-        id = capa.pop('_id')
-        capa.update(id)
-        return capa
-
-    return [process_capa(capa) for capa in capas]
-
-
-def spread_mass_update(unique, bulk):
+def spread_mass_update(unique, segments, bulk, journal):
     """
     For routes that already exist in new_segment_initial_data and to which lines of external_segment make reference,
     apply the calculated ratio to save the new number of passengers and revenue.
+    The segments are taken from the ones loaded once for the run, and the history of the segments refers to the line
+    (external_record) instead of containing a copy of it.
     :param unique: a line of external_segment
+    :param segments: SegmentGroups of the year_months of the lines
     :param bulk: bulk
+    :param journal: ChangeJournal of the run
     :return:
     """
     log.info('        update')
     rev_ratio = unique.ratio.get('rev_ratio') or unique.ratio.get('pax_ratio')
 
-    for segment in NewSegmentInitialData.find(get_match(unique)):
-        # Check that this specific update has not been applied already
-        # (based on the date of import from external source file)
-        if segment.get('updated') and unique['inserted'] in [d.get('data_date') for d in segment.get('updated')]:
-            continue
-        else:
-            new_pax = max(1, int(segment.passengers * unique.ratio['pax_ratio'] + .5))
-            new_rev = max(1, int(segment.get('segment_revenue_usd', 0) * rev_ratio + .5))
-            new_record = dict(passengers=new_pax, segment_revenue_usd=new_rev)
-            initial_record = dict((k, segment[k]) for k in new_record.keys())
-
-            updated = dict(on=now,
-                           data_date=unique['inserted'],
-                           data_type='updated_by_external_source',
-                           initial_record=initial_record,
-                           new_record=new_record,
-                           external_provider=unique['provider'],
-                           ratio=unique['ratio'],
-                           full_record=unique)
-            with lock:
-                pass
-                bulk.find(segment.__id_dict__).update_one({'$set': new_record, '$push': dict(updated=updated)})
-
-
-def spread_mass_create(unique, bulk, not_placed):
+    # Check that this specific update has not been applied already
+    # (based on the date of import from external source file, the last one if the line was imported again)
+    data_date = unique.get('modified') or unique['inserted']
+    matched = [segment for segment in segments.matching(get_match(unique))
+               if data_date not in [d.get('data_date') for d in segment.get('updated') or []]]
+    if not matched:
+        return
+
+    passengers = np.array([segment['passengers'] for segment in matched], dtype=float)
+    revenues = np.array([segment.get('segment_revenue_usd') or 0 for segment in matched], dtype=float)
+    new_pax = np.maximum(1, (passengers * unique.ratio['pax_ratio'] + .5).astype(int)).tolist()
+    new_rev = np.maximum(1, (revenues * rev_ratio + .5).astype(int)).tolist()
+    external_record = dict(collection=External_Segment_Tmp.__collection__, _id=unique['_id'])
+
+    for segment, pax, rev in zip(matched, new_pax, new_rev):
+        new_record = dict(passengers=pax, segment_revenue_usd=rev)
+        initial_record = dict((k, segment.get(k)) for k in new_record.keys())
+
+        updated = dict(on=now,
+                       data_date=data_date,
+                       data_type='updated_by_external_source',
+                       initial_record=initial_record,
+                       new_record=new_record,
+                       external_provider=unique['provider'],
+                       ratio=unique['ratio'],
+                       external_record=external_record,
+                       run=journal.run)
+        journal.updated(segment['_id'], initial_record, new_record, unique['_id'])
+        bulk.find(segment.__id_dict__).update_one({'$set': new_record, '$push': dict(updated=updated)})
+
+
+def spread_mass_create(unique, segments, bulk, not_placed, journal):
     """
     For routes that did not already exist in new_segment_initial_data, save the data from the external_segment directly
     if data is sufficiently atomical.
     If not atomical enough, put the route aside for display at the end of the program
     :param unique: a line of external_segment
+    :param segments: SegmentGroups of the year_months of the lines
     :param bulk: bulk
     :param not_placed: list
+    :param journal: ChangeJournal of the run
     :return:
     """
     log.info('        create')
@@ -360,7 +442,7 @@ def spread_mass_create(unique, bulk, not_placed):
         # If there are any capacity for this specific atomic data
         if capas:
             # And if this specific atomic data has not already been saved
-            if NewSegmentInitialData.find(get_match(unique)).count() != 0:
+            if segments.keys(get_match(unique)):
                 sum_capas = sum(capa['capacity'] for capa in capas)
                 ratio_pax = unique.get('total_pax') / sum_capas
                 ratio_rev = unique.get('revenue') / sum_capas if unique.get('revenue') else None
@@ -371,12 +453,10 @@ def spread_mass_create(unique, bulk, not_placed):
                                   capa['operating_airline_ref_code'], capa['year_month'],
                                   pax, rev, unique.__id_dict__, unique['provider'],
                                   'new_segment_from_external_source_by_capa')
-                    with lock:
-                        pass
-                        bulk.insert(seg)
+                    bulk.insert(seg)
+                journal.created(unique['_id'], now)
         else:
-            with lock:
-                not_placed.append(unique)
+            not_placed.append(unique)
 
     else:
         pax = unique.get('total_pax')
@@ -390,45 +470,68 @@ def spread_mass_create(unique, bulk, not_placed):
         seg = new_seg(origin, destination, operating_airline, operating_airline_ref_code,
                       ym, pax, rev, unique.__id_dict__,
                       unique['provider'], 'new_segment_from_external_source_by_segments')
-        with lock:
-            bulk.insert(seg)
+        bulk.insert(seg)
+        journal.created(unique['_id'], now)
 
 
-def save_new_segments(providers, not_placed):
+def save_new_segments(providers, not_placed, runner, ids=None):
     """
     Check if route exists (and update it), or needs to be created, and save data.
     Store non-existing data in non-atomical format in not_placed for display at the end of the process.
+    The lines are processed in batches recorded by the runner: a resumed run starts after the last recorded batch.
+    The segments created by the lines of an interrupted batch are removed before the batch is done again (its updates
+    are skipped, since their date of import is already in the history of the segments).
+    The changes are written in the journal of the run (see undo).
     :param providers: list
     :param not_placed: empty_list
+    :param runner: StageRunner of the run
+    :param ids: ids of the lines to treat (incremental run), all the lines of the year_month by default
     :return:
     """
-    uniques_cursor = External_Segment_Tmp.find({'year_month': year_month,
-                                                'overlap': {'$in': [None, []]},
-                                                'provider': {'$in': providers}})
-    pct_uniques = uniques_cursor.count() / 100
+    stage = 'save_new_segments'
+    if runner.is_done(stage):
+        log.info('Stage %s already done, skipped', stage)
+        return
+    query = {'year_month': year_month, 'overlap': {'$in': [None, []]}, 'provider': {'$in': providers}}
+    if ids is not None:
+        query['_id'] = {'$in': ids}
+    uniques = list(External_Segment_Tmp.find(query))
+    done, todo = runner.split(stage, uniques)
+    run = runner.query['name']
+    if runner.interrupted(stage) and todo:
+        with ChangeJournal(Scope_Journal, run, year_month) as journal:
+            result = journal.remove(NewSegmentInitialData,
+                                    {'source': 'external_source',
+                                     'loaded_from_record': {'$in': [unique.__id_dict__ for unique in todo]}})
+        log.info('Removed the segments created by the interrupted batch: %r', result)
+
+    # Segments of the lines, loaded once to be joined with the lines
+    # (without the segments created by the lines already done, if the run is resumed)
+    query = {'loaded_from_record': {'$nin': [unique.__id_dict__ for unique in done]}} if done else None
+    segments = SegmentGroups.from_db(NewSegmentInitialData, {ym for unique in uniques for ym in unique['year_month']},
+                                     query)
 
     def log_bulk(self):
         log.info('  store NewSegments: %r', self.nresult)
 
-    with NewSegmentInitialData.unordered_bulk(1000, execute_callback=log_bulk) as bulk, ThreadPool(20) as pool:
-
-        def process_unique(unique):
-            log.info('origin: %r, destination: %r, airline: %r, passengers: %d, pax_ratio:%s',
-                     unique.origin, unique.destination, unique.airline, unique.total_pax,
-                     unique.get('ratio', {}).get('pax_ratio'))
-            # If we've been able to calculate a ratio between new pax count and existing pax count, update data
-            # Otherwise, create new segment if data is enough, or store line to see what went wrong at the end of program.
-            if unique.get('ratio', {}).get('pax_ratio'):
-                spread_mass_update(unique, bulk)
-            else:
-                spread_mass_create(unique, bulk, not_placed)
-
-        for i, unique in enumerate(uniques_cursor, 1):
-            if i % 1000 == 0:
-                log.info('** %.1f%% **', i / pct_uniques)
-            pool.add_task(process_unique, unique)
+    def process_batch(batch):
+        # The journal of the batch is written before the batch is recorded as done
+        with BulkWriter(NewSegmentInitialData, 1000, execute_callback=log_bulk) as bulk, \
+                ChangeJournal(Scope_Journal, run, year_month) as journal:
+            for unique in batch:
+                log.info('origin: %r, destination: %r, airline: %r, passengers: %d, pax_ratio:%s',
+                         unique.origin, unique.destination, unique.airline, unique.total_pax,
+                         unique.get('ratio', {}).get('pax_ratio'))
+                # If we've been able to calculate a ratio between new pax count and existing pax count, update data
+                # Otherwise, create new segment if data is enough, or store line to see what went wrong at the end of
+                # program.
+                if unique.get('ratio', {}).get('pax_ratio'):
+                    spread_mass_update(unique, segments, bulk, journal)
+                else:
+                    spread_mass_create(unique, segments, bulk, not_placed, journal)
+        log.info('  batch stored: %r', bulk.nresult)
 
-    log.info('end store NewSegments: %r', bulk.nresult)
+    runner.run_batches(stage, uniques, process_batch)
 
 
 def print_full(x):
@@ -437,14 +540,199 @@ def print_full(x):
     pd.reset_option('display.max_rows')
 
 
+def treat_year_month(ym, p):
+    """
+    Treat the external sources of a year_month: identify and treat overlaps, calculate ratios, then spread mass.
+    Uses the reference data of the module (providers, airline_parents), and sets the year_month of the module.
+    :param ym: year_month (YYYY-MM)
+    :param p: command line arguments
+    :return:
+    """
+    global year_month
+    year_month = ym
+    start_time = time.time()
+
+    lines = External_Segment_Tmp.find({'year_month': year_month, 'provider': {'$in': providers}})
+    nb_overall_lines = lines.count()
+
+    since = last_successful_run(year_month) if p.incremental else None
+    if p.incremental and since is None:
+        log.info('No successful run for %s yet, treating all the lines', year_month)
+
+    # Progress of the stages is saved, so that an interrupted run starts again where it stopped
+    runner = StageRunner(Scope_Run, dict(program='treat_sources_scope', year_month=year_month,
+                                         incremental=since is not None), p.run, p.restart)
+    not_placed = []
+    try:
+        if since is not None:
+            # Only the groups of overlapping lines changed since the last run, their ratios and their segments
+            def treat_changes():
+                runner.save('treat_changed_overlaps',
+                            ids=treat_changed_overlaps(year_month, providers, since, runner.query['name']))
+
+            runner.run_stage('treat_changed_overlaps', treat_changes)
+            ids = runner.stages['treat_changed_overlaps']['ids']
+            runner.run_stage('calculate_ratios', calculate_ratios, ids)
+            save_new_segments(providers, not_placed, runner, ids)
+        elif p.first_step == 1:
+            # Phase 1 - Identify overlaps (possibly after deleting all previously identified ones, then save in
+            # external_segment
+            runner.run_stage('identify_overlaps', reset_and_identify_overlaps, year_month, providers, p.reset_overlap)
+
+            pct_overlap = External_Segment_Tmp.find({'year_month': year_month, 'provider': {'$in': providers},
+                                                     'overlap': {'$nin': [None, []]}}).count() / nb_overall_lines * 100
+            log.info("%3.2f%% of overlapping data over the %d lines treated", pct_overlap, nb_overall_lines)
+
+            runner.run_stage('treat_overlaps', treat_overlaps, year_month, providers)
+            log.info("Compared overlaps and only kept the most relevent records according to confidence index")
+
+        if since is None and p.first_step <= 2:
+            # Phase 2 - Calculate ratios, then save in external_segment
+            runner.run_stage('calculate_ratios', calculate_ratios)
+
+        if since is None:
+            # Phase 3 - Spread mass, then save new passenger counts and revenues in new_segments_initial_data
+            log.info("Identifying routes corresponding to non-overlapping data, saving in database")
+            save_new_segments(providers, not_placed, runner)
+    except Exception:
+        runner.finish('failed')
+        raise
+    runner.finish()
+
+    # Reste à traiter les chevauchements
+
+    log.info("\n\n--- %s seconds to compile data from %d sources ---", time.time() - start_time,
+             len(External_Segment_Tmp.find({'year_month': year_month}).distinct('provider')))
+
+    if len(not_placed) > 0:
+        log.warning("These %d data were not placed, because of lack of atomicity, and no linked segment nor capacity:",
+                    len(not_placed))
+        not_placed = pd.DataFrame.from_records(not_placed)
+        col_to_keep = ['_id', 'origin', 'destination', 'year_month', 'airline',
+                       'airline_ref_code', 'provider', 'from_filename']
+        not_placed = not_placed[col_to_keep]
+        log.warning(print_full(not_placed))
+
+
+def year_month_range(first, last):
+    """
+    :param first: YearMonth
+    :param last: YearMonth
+    :return: list of the year_months (YYYY-MM) from first to last, included
+    """
+    year, month = int(first.year), int(first.month)
+    result = []
+    while (year, month) <= (int(last.year), int(last.month)):
+        result.append('%d-%02d' % (year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return result
+
+
+def independent_groups(year_months):
+    """
+    Group the year_months that share external lines (lines of several year_months): the year_months of a group are
+    treated one after another, the groups can be treated at the same time.
+    :param year_months: list of year_months (YYYY-MM)
+    :return: list of lists of year_months
+    """
+    group_of = dict((ym, ym) for ym in year_months)
+
+    def find(ym):
+        while group_of[ym] != ym:
+            ym = group_of[ym]
+        return ym
+
+    shared_lines = External_Segment_Tmp.find({'year_month': {'$in': year_months}, 'year_month.1': {'$exists': True},
+                                              'provider': {'$in': providers}}, {'year_month': 1})
+    for line in shared_lines:
+        roots = sorted(set(find(ym) for ym in line['year_month'] if ym in group_of))
+        for root in roots[1:]:
+            group_of[root] = roots[0]
+
+    groups = defaultdict(list)
+    for ym in year_months:
+        groups[find(ym)].append(ym)
+    return [groups[root] for root in sorted(groups)]
+
+
+def treat_year_months(year_months, p):
+    """
+    Treat year_months one after another, in a process of the pool. The reference data (providers, airline_parents)
+    are the ones of the main process.
+    :param year_months: list of year_months (YYYY-MM)
+    :param p: command line arguments
+    :return: list of dicts with the year_month, its status ('success' or 'failed'), the error if any, and the wall time
+    """
+    Model.init_db(def_w=True)
+    # One log file per process
+    root_log = logging.getLogger()
+    for handler in root_log.handlers[:]:
+        if isinstance(handler, BackupFileHandler):
+            root_log.removeHandler(handler)
+    handler = BackupFileHandler(filename='treat_sources_scope_%s.log' % year_months[0], mode='w', backupCount=20)
+    handler.setFormatter(logging.Formatter(logging_format))
+    root_log.addHandler(handler)
+
+    results = []
+    for ym in year_months:
+        start = time.time()
+        status, error = 'success', None
+        try:
+            treat_year_month(ym, p)
+        except BaseException:
+            status, error = 'failed', traceback.format_exc()
+            log.error('%s failed: %s', ym, error)
+        results.append(dict(year_month=ym, status=status, error=error, wall_time=time.time() - start))
+    return results
+
+
+def launch_year_months(year_months, p, nb_processes=4):
+    """
+    Treat year_months concurrently, in nb_processes processes at most. The year_months sharing external lines are
+    treated in the same process.
+    :param year_months: list of year_months (YYYY-MM)
+    :param p: command line arguments
+    :param nb_processes: number of year_months treated at the same time
+    :return: list of the results of treat_year_months
+    """
+    groups = independent_groups(year_months)
+    log.info('Treating %s in %d groups with %d processes', year_months, len(groups), nb_processes)
+    results = []
+    # A new process for each group: the year_month being treated is a module global
+    pool = multiprocessing.Pool(processes=nb_processes, maxtasksperchild=1)
+    try:
+        pending = [pool.apply_async(treat_year_months, (group, p)) for group in groups]
+        for async_result in pending:
+            for result in async_result.get():
+                results.append(result)
+                log.info('%(year_month)s: %(status)s, %(wall_time).0f seconds', result)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
 def cmd_line():
-    parser = argparse.ArgumentParser(description='Adjust segments based on external sources for a single year month')
-    parser.add_argument('ym', type=YearMonth, help='YearMonth (YYYY-MM) to deal with')
+    parser = argparse.ArgumentParser(description='Adjust segments based on external sources for a year month, '
+                                                 'or a range of year months')
+    parser.add_argument('ym', type=YearMonth, help='YearMonth (YYYY-MM) to deal with (first one of the range)')
+    parser.add_argument('--to', dest='to', type=YearMonth, default=None,
+                        help='Last YearMonth (YYYY-MM) of the range, the year months are treated in parallel')
+    parser.add_argument('-n', '--processes', dest='nb_processes', type=int, default=4,
+                        help='Number of year months treated at the same time')
     parser.add_argument('--first_step', dest='first_step', type=int, default=1, help='1: Start from overlaps detection,'
                                                                                      '2: Start from ratios calculation,'
                                                                                      '3: Only do the spreading')
     parser.add_argument('--reset_overlap', dest='reset_overlap', action='store_true',
                         help='If present, reset all overlaps')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help='If present, only treat again the lines inserted or modified since the last successful '
+                             'run (and the lines overlapping them), first_step is then ignored')
+    parser.add_argument('--run', dest='run', default=None,
+                        help='Name of the run, to resume it if it was interrupted (default: resume the last unfinished '
+                             'run of the year month, if any)')
+    parser.add_argument('--restart', dest='restart', action='store_true',
+                        help='If present, start again from first_step even if an unfinished run exists')
     return parser.parse_args()
 
 
@@ -464,46 +752,17 @@ if __name__ == '__main__':
     start_time = time.time()
     Model.init_db(def_w=True)
 
-    year_month = str(p.ym)
+    # Reference data, shared by all the year_months
     providers = [prov.provider for prov in Provider.find({'import_process': True})]
-
     airline_parents = get_airlines_parents()
-    lines = External_Segment_Tmp.find({'year_month': year_month, 'provider': {'$in': providers}})
-    nb_overall_lines = lines.count()
-
-    if p.first_step == 1:
-        # Phase 1 - Identify overlaps (possibly after deleting all previously identified ones, then save in external_segment
-        if p.reset_overlap:
-            reset_overlaps(year_month, providers)
-        identify_overlaps(year_month, providers)
-
-        pct_overlap = External_Segment_Tmp.find({'year_month': year_month, 'provider': {'$in': providers},
-                                                 'overlap': {'$nin': [None, []]}}).count() / nb_overall_lines * 100
-        log.info("%3.2f%% of overlapping data over the %d lines treated", pct_overlap, nb_overall_lines)
-
-        treat_overlaps(year_month, providers)
-        log.info("Compared overlaps and only kept the most relevent records according to confidence index")
-
-    if p.first_step <= 2:
-        # Phase 2 - Calculate ratios, then save in external_segment
-        calculate_ratios()
-
-    # Phase 3 - Spread mass, then save new passenger counts and revenues in new_segments_initial_data
-    not_placed = []
-    log.info("Identifying routes corresponding to non-overlapping data, saving in database")
-    save_new_segments(providers, not_placed)
-
-    # Reste à traiter les chevauchements
-
-    log.info("\n\n--- %s seconds to compile data from %d sources ---", time.time() - start_time,
-             len(External_Segment_Tmp.find({'year_month': year_month}).distinct('provider')))
 
-    if len(not_placed) > 0:
-        log.warning("These %d data were not placed, because of lack of atomicity, and no linked segment nor capacity:",
-                    len(not_placed))
-        not_placed = pd.DataFrame.from_records(not_placed)
-        col_to_keep = ['_id', 'origin', 'destination', 'year_month', 'airline',
-                       'airline_ref_code', 'provider', 'from_filename']
-        not_placed = not_placed[col_to_keep]
-        log.warning(print_full(not_placed))
+    if p.to is None:
+        treat_year_month(str(p.ym), p)
+    else:
+        results = launch_year_months(year_month_range(p.ym, p.to), p, p.nb_processes)
+        failed = [result['year_month'] for result in results if result['status'] != 'success']
+        log.info("\n\n--- %s seconds to treat %d year months ---", time.time() - start_time, len(results))
+        if failed:
+            log.error('Failed year months (start again to resume them): %s', failed)
+            sys.exit(1)
     log.info('End')
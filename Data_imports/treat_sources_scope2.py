@@ -18,18 +18,24 @@ import argparse
 import logging
 import logging.handlers
 import os
+import numpy as np
 import pandas as pd
+from collections import defaultdict
 import sys
 sys.path.append('../')
 from optidb.model import *
 from utils import YearMonth, utcnow
-from utils.threads import Lock, ThreadPool
+from utils.threads import ThreadPool
 from utils.logging_utils import BackupFileHandler
+from overlap_index import OverlapIndex, projection_fields, resolve_overlaps
+from segment_totals import SegmentGroups, SegmentTotals
+from capacity_cube import get_capacity_cube
+from bulk_writer import BulkWriter
+from change_journal import ChangeJournal
 
 now = utcnow()
-lock = Lock()
 
-__version__ = 'V1.0.2'
+__version__ = 'V1.0.3'
 
 
 class External_Segment_Tmp(Model):
@@ -44,6 +50,10 @@ class Scopes_Tmp(Model):
     __collection__ = 'external_sources_scopes'
 
 
+class Scope_Journal(Model):
+    __collection__ = 'external_sources_scope_journal'
+
+
 def reset_overlaps(year_month, providers):
     """
     If 'reset_overlap' argument is given, delete all the values of overlap on the corresponding year_month for the
@@ -61,55 +71,39 @@ def reset_overlaps(year_month, providers):
 
 def identify_overlaps(year_month, providers):
     """
-    For each line, check if there are overlapping scopes (origin, destination, airline) with the following lines
-    and if so, associate the records' id to each other.
-    Only do so for the shortlisted providers
+    For each line, check if there are overlapping scopes (children_airlines, origin_city_airports,
+    destination_city_airports) with the other lines and if so, associate the records' id to each other.
+    Only do so for the shortlisted providers.
+    The lines are loaded once and indexed by their codes to find the overlaps in memory (see overlap_index), then
+    the 'overlap' arrays are written in a single bulk.
     :param year_month: string (YYYY-MM)
     :param providers: list
     :return:
     """
+    keys = ('children_airlines', 'origin_city_airports', 'destination_city_airports')
+    projection = dict((k, 1) for k in keys + projection_fields)
     query = {'year_month': year_month, 'provider': {'$in': providers}}
-    sources_cursor = External_Segment_Tmp.find(query)
-    nb_sources = sources_cursor.count()
-    pct_sources = nb_sources / 100
-    log.info("Identifying overlaps over %d new lines", nb_sources)
-
-    with ThreadPool(20) as pool:
-        def process_source(source, i):
-            # build query
-            start = utcnow()
-            query = dict(provider={'$in': providers},
-                         year_month={'$in': source.year_month},
-                         _id={'$ne': source._id},
-                         )
-
-            if source.children_airlines[0] != '*':
-                query['children_airlines'] = {'$in': source.children_airlines + ['*']}
-
-            query_od = dict((k, {'$in': source[k] + ['*']})
-                            for k in ('origin_city_airports', 'destination_city_airports')
-                            if source[k][0] != '*')
-
-            if query_od:
-                query_od_return = dict((k, {'$in': source[r] + ['*']})
-                                       for k, r in (('origin_city_airports', 'destination_city_airports'),
-                                                    ('destination_city_airports', 'origin_city_airports'))
-                                       if source[r][0] != '*')
-                if not source.both_ways:
-                    query_od_return['both_ways'] = True
-
-                query['$or'] = [query_od, query_od_return]
-
-            update = {'$addToSet': dict(overlap=source._id)}
-            result = External_Segment_Tmp.update(query, update, multi=True)
-            end = utcnow()
-            log.info('Update overlaps %d (%ss) - %r', i, end-start, result)
-
-        for i, source in enumerate(sources_cursor, 1):
-            if i % 1000 == 0:
-                log.info('Processed %dk records (%.1f%%)', i // 1000, i / pct_sources)
-            # Parallelize process 20 times
-            pool.add_task(process_source, source, i)
+    lines = list(External_Segment_Tmp.find(query, projection))
+    sources = [line['_id'] for line in lines]
+    log.info("Identifying overlaps over %d new lines", len(sources))
+    # The lines of the other year_months of the sources (if any) can also be overlapped
+    other_year_months = list(set(ym for line in lines for ym in line['year_month']) - {year_month})
+    if other_year_months:
+        query = {'year_month': {'$in': other_year_months, '$ne': year_month}, 'provider': {'$in': providers}}
+        lines.extend(External_Segment_Tmp.find(query, projection))
+
+    start = utcnow()
+    index = OverlapIndex(lines, *keys)
+    overlaps = index.overlaps(sources)
+    log.info('%d lines overlapped by %d overlaps (%s)', len(overlaps), sum(len(v) for v in overlaps.values()),
+             utcnow() - start)
+
+    def log_bulk(self):
+        log.info('  store overlaps: %r', self.nresult)
+
+    with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
+        for target_id, source_ids in overlaps.items():
+            bulk.find({'_id': target_id}).update_one({'$addToSet': {'overlap': {'$each': list(source_ids)}}})
 
     log.info('end identify_overlap')
     return
@@ -117,8 +111,10 @@ def identify_overlaps(year_month, providers):
 
 def treat_overlaps(year_month, providers):
     """
-    Loop over all the records marked as overlaps, compare record's providers and their confidence index,
-    and remove the 'overlap' mark on the records coming from the most trusted sources.
+    Compare the providers of the records marked as overlaps and their confidence index, and remove the 'overlap' mark
+    on the records coming from the most trusted sources.
+    The overlaps form a graph, resolved in memory component by component (see overlap_index.resolve_overlaps): the
+    result does not depend on the order of the records.
     :param year_month: string (YYYY-MM)
     :param providers: list
     :return:
@@ -126,57 +122,19 @@ def treat_overlaps(year_month, providers):
     providers_confidence = dict((x['provider'], x['index']['confidence'])
                                 for x in Provider.find({'index.ym_start': {'$lte': year_month}}))
     query = {'year_month': year_month, 'provider': {'$in': providers}, 'overlap': {'$ne': None}}
-    overlaps_dict = dict((x._id, x) for x in External_Segment_Tmp.find(query))
+    overlaps_dict = dict((x['_id'], x) for x in External_Segment_Tmp.find(query, {'provider': 1, 'overlap': 1}))
+
+    kept, components = resolve_overlaps(overlaps_dict, providers_confidence)
+    log.info('%d overlapping records in %d groups (largest: %d), %d kept', len(overlaps_dict), len(components),
+             max(len(c) for c in components) if components else 0, len(kept))
 
     def log_bulk(self):
         log.info('  treating overlaps: %r', self.nresult)
 
-    with External_Segment_Tmp.unordered_bulk(100, execute_callback=log_bulk) as bulk:
-
-        for record in overlaps_dict.values():
-            # Skip the lines that were already treated
-            if record['overlap'] is None:
-                continue
-            # If it's a one-for-one overlap, only keep the data from the higher indexed source
-            # (remove the 'overlap' from this record)
-            if len(record['overlap']) == 1:
-                # Get the confidence index of both providers to compare
-                other_provider = overlaps_dict.get(record['overlap'][0])['provider']
-                if providers_confidence.get(record['provider']) >=  providers_confidence.get(other_provider):
-                    # Delete the 'overlap' mention (effectively keeping this data for further integration)
-                    bulk.find({'_id': record['_id']}).update_one({'$unset': {'overlap': 1}})
-                    # Mark the other record to be skipped
-                    overlaps_dict.get(record['overlap'][0])['overlap'] = None
-                # else:
-                    # Delete the 'overlap' mention (effectively keeping this data for further integration) of the other record
-                    bulk.find({'_id': overlaps_dict.get(record['overlap'][0])['overlap']}).update_one({'$unset': {'overlap': 1}})
-
-            # For one-to-many overlaps, first check if the current one has a higher indexed source
-            else:
-                # Store in a list all the lines concerned by the overlap:
-                grouped_routes = [External_Segment_Tmp.find_one({'_id': n}) for n in record['overlap']]
-                grouped_routes.append(record)
-
-                # Look for the providers and determine which one has the highest confidence index
-                concerned_providers = [overlaps_dict.get(n)['provider'] for n in record['overlap']]
-                concerned_providers.append(record['provider'])
-                concerned_providers = set(concerned_providers)
-                indexes = [providers_confidence.get(n) for n in concerned_providers]
-
-                if not any(providers_confidence.get(record['provider']) < providers_confidence.get(x) for x in
-                           concerned_providers):
-                    # Delete the 'overlap' mention (effectively keeping this data for further integration)
-                    bulk.find({'_id': record['_id']}).update_one({'$unset': {'overlap': 1}})
-                    # Mark the other record to be skipped
-                    for ov in record['overlap']:
-                        overlaps_dict.get(ov)['overlap'] = None
-                else:
-                    # If the higher indexed source is the current one, then then remove 'overlap' from the others
-                    bulk.find({'_id': {'$in': record['overlap']}}).update_one({'$unset': {'overlap': 1}})
-                    # Mark the other records to be skipped
-                    for ov in record['overlap']:
-                        overlaps_dict.get(ov)['overlap'] = None
-                    continue
+    with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
+        for record_id in sorted(kept):
+            # Delete the 'overlap' mention (effectively keeping this data for further integration)
+            bulk.find({'_id': record_id}).update_one({'$unset': {'overlap': 1}})
     log.info('end treatment of overlaps: %r', bulk.nresult)
 
 
@@ -216,6 +174,32 @@ def get_airlines_parents():
     return dict((c.code, c.parent) for c in Company.find(query))
 
 
+def get_airlines_children(parents):
+    """
+    :param parents: dict {airline code: parent code}, as returned by get_airlines_parents
+    :return: dict {parent code: set of the codes of its airlines}
+    """
+    children = defaultdict(set)
+    for airline, parent in parents.iteritems():
+        children[parent].add(airline)
+    return children
+
+
+def get_city_airports():
+    """
+    Airports grouped by city, from the city codes (like 'PAR:c') found in the 'codes' of the airports
+    :return: tuple of dicts ({airport code: set of city codes}, {city code: set of airport codes})
+    """
+    airport_cities = defaultdict(set)
+    city_airports = defaultdict(set)
+    for airport in Airport.find({'code': {'$ne': None}, 'codes': {'$ne': None}}, {'_id': 0, 'code': 1, 'codes': 1}):
+        for city in airport.get('codes') or []:
+            if ':c' in city and ':co' not in city:
+                airport_cities[airport['code']].add(city)
+                city_airports[city].add(airport['code'])
+    return airport_cities, city_airports
+
+
 def calculate_ratios():
     """
     For all the external segment lines that do not contain overlap, compare the sum of passengers (and revenue if existing)
@@ -231,104 +215,95 @@ def calculate_ratios():
     def log_bulk(self):
         log.info('  saving ratios: %r', self.nresult)
 
-    with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk, ThreadPool(20) as pool:
+    uniques = list(uniques_cursor)
+    # Segments summed once per (year_month, airline, origin, destination), instead of one aggregation per line
+    totals = SegmentTotals.from_db(NewSegmentInitialData, {ym for unique in uniques for ym in unique['year_month']})
 
-        def calculate_single_ratio(unique):
+    # The ratios are written by the thread of the writer while the next ones are calculated
+    with BulkWriter(External_Segment_Tmp, 1000, execute_callback=log_bulk) as bulk:
+        for unique in uniques:
             ratio = {}
-            match = get_match(unique)
-
-            sum_pax = list(NewSegmentInitialData.aggregate([
-                {'$match': match},
-                {'$group': {
-                    '_id': None,
-                    'pax': {'$sum': '$passengers'}, 'revenue': {'$sum': '$segment_revenue_usd'}
-                }
-                }
-            ]))
-            if len(sum_pax) == 0 or sum_pax[0].get('pax') == 0:
+            sums = totals.sums(get_match(unique))
+            if sums is None or sums[0] == 0:
                 ratio['pax_ratio'] = None
             else:
-                ratio['pax_ratio'] = unique['total_pax'] / sum_pax[0].get('pax')
-                if not unique.get('revenue') or unique.get('revenue') == 0:
+                ratio['pax_ratio'] = unique['total_pax'] / sums[0]
+                if not unique.get('revenue') or unique.get('revenue') == 0 or sums[1] == 0:
                     ratio['rev_ratio'] = None
                 else:
-                    ratio['rev_ratio'] = unique['revenue'] / sum_pax[0].get('revenue')
-
-            with lock:
-                bulk.find(unique.__id_dict__).update_one({'$set': {'ratio': ratio}})
+                    ratio['rev_ratio'] = unique['revenue'] / sums[1]
 
-        for unique in uniques_cursor:
-            pool.add_task(calculate_single_ratio, unique)
+            bulk.find(unique.__id_dict__).update_one({'$set': {'ratio': ratio}})
 
     log.info('end calculate ratios: %r', bulk.nresult)
 
 
 def aggregate_capa(dat):
+    """
+    :param dat: a line of external_segment
+    :return: list of the positive capacities of the line, summed per origin, destination, operating_airline_ref_code,
+    operating_airline and year_month (taken from the capacity cube of the run)
+    """
     match = get_match(dat, for_segments=False, with_ref_code=True)
     match.update(active_rec=True, capacity={'$gt': 0})
+    return get_capacity_cube(CapacityInitialData).capacities(match)
 
-    group = {'_id': {'origin': '$origin',
-                     'destination': '$destination',
-                     'operating_airline_ref_code': '$operating_airline_ref_code',
-                     'operating_airline': '$operating_airline',
-                     'year_month': '$year_month'},
-             'capacity': {'$sum': '$capacity'}}
-
-    capas = CapacityInitialData.aggregate([
-        {'$match': match},
-        {'$group': group}
-    ])
 
-    def process_capa(capa):
-        id = capa.pop('_id')
-        capa.update(id)
-        return capa
-
-    return [process_capa(capa) for capa in capas]
-
-
-def spread_mass_update(unique, bulk):
+def spread_mass_update(unique, segments, bulk, journal):
     """
     For routes that already exist in new_segment_initial_data and to which lines of external_segment make reference,
     apply the calculated ratio to save the new number of passengers and revenue.
+    The segments are taken from the ones loaded once for the run, and the history of the segments refers to the line
+    (external_record) instead of containing a copy of it.
     :param unique: a line of external_segment
+    :param segments: SegmentGroups of the year_months of the lines
     :param bulk: bulk
+    :param journal: ChangeJournal of the run
     :return:
     """
     log.info('        update')
     rev_ratio = unique.ratio.get('rev_ratio') or unique.ratio.get('pax_ratio')
 
-    for segment in NewSegmentInitialData.find(get_match(unique)):
-        # Check that this specific update has not been applied already
-        # (based on the date of import from external source file)
-        if segment.get('updated') and unique['inserted'] in [d.get('data_date') for d in segment.get('updated')]:
-            continue
-        else:
-            new_pax = max(1, int(segment.passengers * unique.ratio['pax_ratio'] + .5))
-            new_rev = max(1, int(segment.get('segment_revenue_usd', 0) * rev_ratio + .5))
-            new_record = dict(passengers=new_pax, segment_revenue_usd=new_rev)
-            initial_record = dict((k, segment[k]) for k in new_record.keys())
-
-            updated = dict(on=now,
-                           data_date=unique['inserted'],
-                           data_type='updated_by_external_source',
-                           initial_record=initial_record,
-                           new_record=new_record,
-                           external_provider=unique['provider'],
-                           ratio=unique['ratio'],
-                           full_record=unique)
-            with lock:
-                bulk.find(segment.__id_dict__).update_one({'$set': new_record, '$push': dict(updated=updated)})
-
-
-def spread_mass_create(unique, bulk, not_placed):
+    # Check that this specific update has not been applied already
+    # (based on the date of import from external source file)
+    matched = [segment for segment in segments.matching(get_match(unique))
+               if unique['inserted'] not in [d.get('data_date') for d in segment.get('updated') or []]]
+    if not matched:
+        return
+
+    passengers = np.array([segment['passengers'] for segment in matched], dtype=float)
+    revenues = np.array([segment.get('segment_revenue_usd') or 0 for segment in matched], dtype=float)
+    new_pax = np.maximum(1, (passengers * unique.ratio['pax_ratio'] + .5).astype(int)).tolist()
+    new_rev = np.maximum(1, (revenues * rev_ratio + .5).astype(int)).tolist()
+    external_record = dict(collection=External_Segment_Tmp.__collection__, _id=unique['_id'])
+
+    for segment, pax, rev in zip(matched, new_pax, new_rev):
+        new_record = dict(passengers=pax, segment_revenue_usd=rev)
+        initial_record = dict((k, segment.get(k)) for k in new_record.keys())
+
+        updated = dict(on=now,
+                       data_date=unique['inserted'],
+                       data_type='updated_by_external_source',
+                       initial_record=initial_record,
+                       new_record=new_record,
+                       external_provider=unique['provider'],
+                       ratio=unique['ratio'],
+                       external_record=external_record,
+                       run=journal.run)
+        journal.updated(segment['_id'], initial_record, new_record, unique['_id'])
+        bulk.find(segment.__id_dict__).update_one({'$set': new_record, '$push': dict(updated=updated)})
+
+
+def spread_mass_create(unique, segments, bulk, not_placed, journal):
     """
     For routes that did not already exist in new_segment_initial_data, save the data from the external_segment directly
     if data is sufficiently atomical.
     If not atomical enough, put the route aside for display at the end of the program
     :param unique: a line of external_segment
+    :param segments: SegmentGroups of the year_months of the lines
     :param bulk: bulk
     :param not_placed: list
+    :param journal: ChangeJournal of the run
     :return:
     """
     log.info('        create')
@@ -360,7 +335,7 @@ def spread_mass_create(unique, bulk, not_placed):
         # If there are any capacity for this specific atomic data
         if capas:
             # And if this specific atomic data has not already been saved
-            if NewSegmentInitialData.find(get_match(unique)).count() != 0:
+            if segments.keys(get_match(unique)):
                 sum_capas = sum(capa['capacity'] for capa in capas)
                 ratio_pax = unique.get('total_pax') / sum_capas
                 ratio_rev = unique.get('revenue') / sum_capas if unique.get('revenue') else None
@@ -371,11 +346,10 @@ def spread_mass_create(unique, bulk, not_placed):
                                   capa['operating_airline_ref_code'], capa['year_month'],
                                   pax, rev, unique.__id_dict__, unique['provider'],
                                   'new_segment_from_external_source_by_capa')
-                    with lock:
-                        bulk.insert(seg)
+                    bulk.insert(seg)
+                journal.created(unique['_id'], now)
         else:
-            with lock:
-                not_placed.append(unique)
+            not_placed.append(unique)
 
     else:
         pax = unique.get('total_pax')
@@ -389,14 +363,15 @@ def spread_mass_create(unique, bulk, not_placed):
         seg = new_seg(origin, destination, operating_airline, operating_airline_ref_code,
                       ym, pax, rev, unique.__id_dict__,
                       unique['provider'], 'new_segment_from_external_source_by_segments')
-        with lock:
-            bulk.insert(seg)
+        bulk.insert(seg)
+        journal.created(unique['_id'], now)
 
 
 def save_new_segments(providers, not_placed, query=None):
     """
     Check if route exists (and update it), or needs to be created, and save data.
     Store non-existing data in non-atomical format in not_placed for display at the end of the process.
+    The changes are written in the journal of the run, named after its start date (see undo).
     :param providers: list
     :param not_placed: empty_list
     :return:
@@ -406,12 +381,19 @@ def save_new_segments(providers, not_placed, query=None):
                                                 'provider': {'$in': providers}})
     if query:
         uniques_cursor.update(query)
-    pct_uniques = uniques_cursor.count() / 100
+    uniques = list(uniques_cursor)
+    pct_uniques = len(uniques) / 100
+    # Segments of the lines, loaded once to be joined with the lines
+    segments = SegmentGroups.from_db(NewSegmentInitialData, {ym for unique in uniques for ym in unique['year_month']})
 
     def log_bulk(self):
         log.info('  store NewSegments: %r', self.nresult)
 
-    with NewSegmentInitialData.unordered_bulk(1000, execute_callback=log_bulk) as bulk, ThreadPool(20) as pool:
+    # The threads add their operations to their own buffer, written by a dedicated thread of the writer
+    run = now.strftime('%Y-%m-%d %H:%M:%S.%f')
+    log.info('Journal of the run: %r', run)
+    with BulkWriter(NewSegmentInitialData, 1000, execute_callback=log_bulk) as bulk, \
+            ChangeJournal(Scope_Journal, run, year_month) as journal, ThreadPool(20) as pool:
 
         def process_unique(unique):
             log.info('origin: %r, destination: %r, airline: %r, passengers: %d, pax_ratio:%s',
@@ -420,11 +402,11 @@ def save_new_segments(providers, not_placed, query=None):
             # If we've been able to calculate a ratio between new pax count and existing pax count, update data
             # Otherwise, create new segment if data is enough, or store line to see what went wrong at the end of program.
             if unique.get('ratio', {}).get('pax_ratio'):
-                spread_mass_update(unique, bulk)
+                spread_mass_update(unique, segments, bulk, journal)
             else:
-                spread_mass_create(unique, bulk, not_placed)
+                spread_mass_create(unique, segments, bulk, not_placed, journal)
 
-        for i, unique in enumerate(uniques_cursor, 1):
+        for i, unique in enumerate(uniques, 1):
             if i % 1000 == 0:
                 log.info('** %.1f%% **', i / pct_uniques)
             pool.add_task(process_unique, unique)
@@ -437,6 +419,8 @@ def complement_airports_and_airlines(lines):
     Avoid missing overlaps by generalizing data:
     - Adds to airlines the airlines that belong to the same parent group of airlines
     - Adds to airports the airports in the same city
+    The airlines' families and the airports' cities are taken from the tables loaded once for the run
+    (airline_parents, airline_children, airport_cities, city_airports).
     :param lines: object
     :return: saves the new data in the fields 'children_airlines', 'origin_city_airports' and 'destination_city_airports'
     """
@@ -445,36 +429,24 @@ def complement_airports_and_airlines(lines):
     def log_bulk(self):
         log.info('  complementing airports & airlines: %r', self.nresult)
 
-    with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk, ThreadPool(20) as pool:
+    def same_city_airports(airports):
+        result = set(airports)
+        for airport in airports:
+            for city in airport_cities.get(airport, ()):
+                result.update(city_airports[city])
+        return result
 
-        def complement_single_line(line):
+    with External_Segment_Tmp.unordered_bulk(1000, execute_callback=log_bulk) as bulk:
+        for line in lines:
             children = set(line['airline'])
             for al in line['airline']:
                 parent = airline_parents.get(al)
                 if parent:
-                    children.update(k for k, v in airline_parents.iteritems() if v == parent)
-            origin_city_airports = set(line['origin'])
-            origin_city = [a for k in
-                           list(Airport.find({'code': {'$in': line['origin']}}, {'_id': 0, 'codes': 1}))
-                           for a in k.get('codes') if ':c' in a and ':co' not in a]
-            if origin_city:
-                origin_city_airports.update(k['code'] for k in Airport.find({'codes': {'$in': origin_city}},
-                                                                                 {'_id': 0, 'code': 1}))
-            destination_city_airports = set(line['destination'])
-            destination_city = [a for k in
-                                list(Airport.find({'code': {'$in': line['destination']}}, {'_id': 0, 'codes': 1}))
-                                for a in k.get('codes') if ':c' in a and ':co' not in a]
-            if destination_city:
-                destination_city_airports.update(k['code'] for k in Airport.find({'codes': {'$in': destination_city}},
-                                                                                 {'_id': 0, 'code': 1}))
-            with lock:
-                bulk.find(line.__id_dict__).update_one({'$set': {'children_airlines': list(children),
-                                                                 'origin_city_airports': list(origin_city_airports),
-                                                                 'destination_city_airports': list(
-                                                                     destination_city_airports)}})
-
-        for line in lines:
-            pool.add_task(complement_single_line, line)
+                    children.update(airline_children[parent])
+            bulk.find(line.__id_dict__).update_one({'$set': {
+                'children_airlines': list(children),
+                'origin_city_airports': list(same_city_airports(line['origin'])),
+                'destination_city_airports': list(same_city_airports(line['destination']))}})
 
     log.info('end complement airports & airlines: %r', bulk.nresult)
 
@@ -516,6 +488,8 @@ if __name__ == '__main__':
     providers = [prov.provider for prov in Provider.find({'import_process': True})]
 
     airline_parents = get_airlines_parents()
+    airline_children = get_airlines_children(airline_parents)
+    airport_cities, city_airports = get_city_airports()
     lines = External_Segment_Tmp.find({'year_month': year_month, 'provider': {'$in': providers}})
     nb_overall_lines = lines.count()
 
@@ -23,7 +23,11 @@ from optidb.model import *
 from utils import YearMonth
 from utils.logging_utils import BackupFileHandler
 import logging
-from utils.threads import ThreadPool
+from change_journal import undo_run
+
+
+class Scope_Journal(Model):
+    __collection__ = 'external_sources_scope_journal'
 
 
 def undo(year_month, date):
@@ -58,14 +62,19 @@ def undo(year_month, date):
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Undo data import updates (data created and/or updated on a specific day for a specific year_month)')
+    parser = argparse.ArgumentParser(description='Undo data import updates (data created and/or updated by a run of '
+                                                 'treat_sources_scope, or on a specific day, for a specific year_month)')
     parser.add_argument('ym', type=YearMonth, help='YYYY-MM, the year_month affected by the updates')
+    parser.add_argument('--run', type=str, default=None,
+                        help='Name of the run of treat_sources_scope to undo, replayed from its journal')
     parser.add_argument('--update_date', type=str, help='YYYY/MM/DD, the date at which the updates were made')
+    parser.add_argument('--threads', type=int, default=4, help='Number of bulks executed at the same time (--run)')
 
     p = parser.parse_args()
+    if (p.run is None) == (p.update_date is None):
+        parser.error('Give either --run or --update_date')
 
     year_month = str(p.ym)
-    update_date = datetime.strptime(p.update_date, '%Y/%m/%d')
 
     logging_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=logging_format)
@@ -82,7 +91,10 @@ if __name__ == '__main__':
 
     Model.init_db(def_w=True)
 
-    with ThreadPool(5) as pool:
-        pool.add_task(undo, year_month, update_date)
+    if p.run is not None:
+        result = undo_run(Scope_Journal, NewSegmentInitialData, p.run, year_month, p.threads)
+        log.info('undo run %r: %r', p.run, result)
+    else:
+        undo(year_month, datetime.strptime(p.update_date, '%Y/%m/%d'))
 
     log.info('The end...')
\ No newline at end of file
@@ -0,0 +1,5 @@
+// Indexes of load_factor_monthly (see load_factors.py --refresh), for the lookups per route and per airline
+db.load_factor_monthly.createIndex({'year_month': 1, 'operating_airline': 1, 'origin': 1, 'destination': 1}, {'unique': true});
+db.load_factor_monthly.createIndex({'origin': 1, 'destination': 1, 'year_month': 1});
+db.load_factor_monthly.createIndex({'operating_airline': 1, 'year_month': 1});
+db.load_factor_monthly_refresh.createIndex({'year_month': 1}, {'unique': true});
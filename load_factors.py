@@ -1,5 +1,7 @@
 from __future__ import print_function
+import argparse
 import sys
+from datetime import datetime
 import pandas as pd
 import numpy as np
 sys.path.append('../')
@@ -7,41 +9,80 @@ from optidb import Model
 from optidb.model import *
 
 
+class LoadFactorMonthly(Model):
+    __collection__ = 'load_factor_monthly'
+
+
+class LoadFactorRefresh(Model):
+    __collection__ = 'load_factor_monthly_refresh'
+
+
 def open_db():
     Model.init_db()
 
 
-def get_segments(start_date, end_date):
+key_fields = ['year_month', 'operating_airline', 'origin', 'destination']
+output_fields = key_fields + ['passengers', 'capacity', 'load_factor']
+
+
+def year_months(start_date, end_date):
     """
-    :param origin: IATA code typed in by user
-    :param destination: IATA code typed in by user
-    :param end_date: date, under format YYYY-MM.
-    :return: a data frame with pax per monthly (multiple lines) one-way segments between origin and destination
-    """
-    segment_cursor = SegmentInitialData.find(
-                {'year_month': {"$gte": start_date, "$lte": end_date}, 'record_ok': True},
-                {'leg_origin': 1, 'leg_destination': 1, 'operating_airline': 1, 'year_month': 1, 'passengers': 1, '_id': 0})
-    segment = pd.DataFrame(list(segment_cursor))
-    cols = segment.columns.values
-    cols[[i for i, item in enumerate(cols) if "origin" in item.lower()]] = "origin"
-    cols[[i for i, item in enumerate(cols) if "destination" in item.lower()]] = "destination"
-    segment.columns = cols
-    segment = segment.groupby([segment.year_month, segment.operating_airline, segment.origin, segment.destination], as_index=False).sum()
-    return segment
-
-def get_capa(start_date, end_date):
-    """
-    :param origin: IATA code typed in by user
-    :param destination: IATA code typed in by user
+    :param start_date: date, under format YYYY-MM.
     :param end_date: date, under format YYYY-MM.
-    :return: a data frame with pax per monthly (multiple lines) one-way segments between origin and destination
+    :return: list of the year_months from start_date to end_date, included
     """
-    capa_cursor = CapacityInitialData.find(
-                {'year_month': {"$gte": start_date, "$lte": end_date}, 'active_rec': True, 'record_ok': True},
-                {'origin': 1, 'destination': 1, 'operating_airline': 1, 'year_month': 1, 'capacity': 1, '_id': 0})
-    capa = pd.DataFrame(list(capa_cursor))
-    capa = capa.groupby([capa.year_month, capa.operating_airline, capa.origin, capa.destination], as_index=False).sum()
-    return capa
+    year, month = int(start_date[:4]), int(start_date[5:7])
+    result = []
+    while '%d-%02d' % (year, month) <= end_date:
+        result.append('%d-%02d' % (year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return result
+
+
+def group_sum(model, match, value_field, origin_field, destination_field):
+    """
+    Sum a field per year_month, operating_airline, origin and destination in the database (only the sums are read)
+    :param model: model of the collection
+    :param match: query of the records
+    :param value_field: field summed
+    :param origin_field: field of the origin
+    :param destination_field: field of the destination
+    :return: a data frame with the key_fields and the sum, under the name of the field
+    """
+    cursor = model.aggregate([
+        {'$match': match},
+        {'$group': {'_id': {'year_month': '$year_month', 'operating_airline': '$operating_airline',
+                            'origin': '$' + origin_field, 'destination': '$' + destination_field},
+                    value_field: {'$sum': '$' + value_field}}}
+    ])
+    columns = dict((k, []) for k in key_fields)
+    values = []
+    for group in cursor:
+        for k in key_fields:
+            columns[k].append(group['_id'].get(k))
+        values.append(group[value_field] or 0)
+    result = pd.DataFrame(columns, columns=key_fields)
+    result[value_field] = np.array(values)
+    # As with groupby, the records without a key are not counted
+    return result.dropna(subset=key_fields)
+
+
+def get_segments(year_month):
+    """
+    :param year_month: date, under format YYYY-MM.
+    :return: a data frame with pax per one-way segment (year_month, operating_airline, origin, destination)
+    """
+    return group_sum(SegmentInitialData, {'year_month': year_month, 'record_ok': True},
+                     'passengers', 'leg_origin', 'leg_destination')
+
+
+def get_capa(year_month):
+    """
+    :param year_month: date, under format YYYY-MM.
+    :return: a data frame with capacity per one-way segment (year_month, operating_airline, origin, destination)
+    """
+    return group_sum(CapacityInitialData, {'year_month': year_month, 'active_rec': True, 'record_ok': True},
+                     'capacity', 'origin', 'destination')
 
 def calculate_load_factor(segment, capa):
     load_factor = segment.merge(capa, on=['year_month', 'operating_airline', 'origin', 'destination'])
@@ -50,13 +91,151 @@ def calculate_load_factor(segment, capa):
     return load_factor
 
 
+def fingerprint(model, match, value_field):
+    """
+    :return: dict with the number of records, the sum of the field and the last _id of the records, changed by any
+    import or update of the records
+    """
+    result = list(model.aggregate([
+        {'$match': match},
+        {'$group': {'_id': None, 'count': {'$sum': 1}, 'total': {'$sum': '$' + value_field},
+                    'last_id': {'$max': '$_id'}}}
+    ]))
+    if not result:
+        return None
+    return dict(count=result[0]['count'], total=result[0]['total'], last_id=result[0]['last_id'])
+
+
+def native(value):
+    """
+    :return: the value as a python type (numpy types can not be saved in the database)
+    """
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def refresh_month(year_month, force=False):
+    """
+    Compute the load factors of a year_month again and save them in load_factor_monthly, if the segments or the
+    capacities of the year_month have changed since they were saved
+    :param year_month: date, under format YYYY-MM.
+    :param force: if True, compute the load factors even if nothing has changed
+    :return: True if the year_month was computed again
+    """
+    fingerprints = dict(segments=fingerprint(SegmentInitialData, {'year_month': year_month, 'record_ok': True},
+                                             'passengers'),
+                        capacities=fingerprint(CapacityInitialData, {'year_month': year_month, 'active_rec': True,
+                                                                     'record_ok': True}, 'capacity'))
+    saved = LoadFactorRefresh.find_one({'year_month': year_month})
+    if not force and saved and saved.get('segments') == fingerprints['segments'] and \
+            saved.get('capacities') == fingerprints['capacities']:
+        print('%s: up to date' % year_month)
+        return False
+
+    load_factor = calculate_load_factor(get_segments(year_month), get_capa(year_month))
+    LoadFactorMonthly.remove({'year_month': year_month})
+    with LoadFactorMonthly.unordered_bulk(1000) as bulk:
+        for row in load_factor.to_dict('records'):
+            bulk.insert(dict((k, native(v)) for k, v in row.items()))
+    LoadFactorRefresh.update(query={'year_month': year_month},
+                             update={'$set': dict(fingerprints, refreshed=datetime.utcnow(), nb_rows=len(load_factor))},
+                             upsert=True)
+    print('%s: %d load factors saved' % (year_month, len(load_factor)))
+    return True
+
+
+def refresh(start_date, end_date, force=False):
+    """
+    Refresh the year_months of load_factor_monthly changed by new imports or treatments of the segments or capacities
+    :param start_date: date, under format YYYY-MM.
+    :param end_date: date, under format YYYY-MM.
+    :param force: if True, compute all the year_months again
+    :return: list of the year_months computed again
+    """
+    return [year_month for year_month in year_months(start_date, end_date) if refresh_month(year_month, force)]
+
+
+def read_load_factors(start_date, end_date):
+    """
+    Load factors saved in load_factor_monthly, read month by month
+    :param start_date: date, under format YYYY-MM.
+    :param end_date: date, under format YYYY-MM.
+    :return: generator of a data frame per year_month, with the output_fields
+    """
+    for year_month in year_months(start_date, end_date):
+        cursor = LoadFactorMonthly.find({'year_month': year_month}, {'_id': 0})
+        yield pd.DataFrame(list(cursor)).reindex(columns=output_fields)
+
+
+def load_factors(start_date, end_date):
+    """
+    Load factors of the year_months, computed month by month
+    :param start_date: date, under format YYYY-MM.
+    :param end_date: date, under format YYYY-MM.
+    :return: generator of a data frame per year_month, with passengers, capacity and load factor per year_month,
+    operating_airline, origin and destination (the output_fields)
+    """
+    for year_month in year_months(start_date, end_date):
+        load_factor = calculate_load_factor(get_segments(year_month), get_capa(year_month))
+        print('%s: %d load factors' % (year_month, len(load_factor)))
+        yield load_factor.reindex(columns=output_fields)
+
+
+def write_load_factors(months, output):
+    """
+    Write the load factors month by month, so that only one month is in memory at once
+    :param months: iterable of data frames (one per year_month) with the output_fields
+    :param output: file to write, in Parquet if its extension is .parquet (one row group per month, requires
+    pyarrow), in CSV otherwise
+    :return: number of rows written
+    """
+    nb_rows = 0
+    if output.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        # Explicit schema: the types of a month cannot be inferred from its values when they are empty or missing
+        schema = pa.schema([(field, pa.string()) for field in key_fields] +
+                           [(field, pa.float64()) for field in output_fields[len(key_fields):]])
+        writer = pq.ParquetWriter(output, schema)
+        try:
+            for month in months:
+                if month.empty:
+                    continue
+                writer.write_table(pa.Table.from_pandas(month, schema=schema, preserve_index=False))
+                nb_rows += len(month)
+        finally:
+            writer.close()
+    else:
+        for i, month in enumerate(months):
+            month.to_csv(output, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            nb_rows += len(month)
+    return nb_rows
+
+
+def cmd_line():
+    parser = argparse.ArgumentParser(description='Load factors per year_month, airline, origin and destination')
+    parser.add_argument('start_date', help='First year_month (YYYY-MM)')
+    parser.add_argument('end_date', help='Last year_month (YYYY-MM)')
+    parser.add_argument('-o', '--output', default='load_factor.csv',
+                        help='File to write, in Parquet if its extension is .parquet, in CSV otherwise')
+    parser.add_argument('--refresh', action='store_true',
+                        help='If present, refresh the changed year_months of load_factor_monthly, then read the load '
+                             'factors from it')
+    parser.add_argument('--force', action='store_true',
+                        help='If present with --refresh, compute all the year_months again')
+    return parser.parse_args()
+
+
 def main():
+    p = cmd_line()
     open_db()
-    start_date = "2016-06"
-    end_date = "2016-09"
 
-    segment = get_segments(start_date, end_date)
-    capa = get_capa(start_date, end_date)
+    if p.refresh:
+        refresh(p.start_date, p.end_date, p.force)
+        months = read_load_factors(p.start_date, p.end_date)
+    else:
+        months = load_factors(p.start_date, p.end_date)
+    print('%d load factors written in %s' % (write_load_factors(months, p.output), p.output))
+
 
-    load_factor = calculate_load_factor(segment, capa)
-    load_factor.to_csv("/home/laurent/load_factor.csv", index=False)
\ No newline at end of file
+if __name__ == '__main__':
+    main()